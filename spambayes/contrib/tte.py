@@ -78,6 +78,7 @@ import datetime
 from spambayes import storage
 from spambayes import Options
 from spambayes import mboxutils
+from spambayes import tokenizer
 from spambayes.tokenizer import tokenize
 
 prog = os.path.basename(sys.argv[0])
@@ -106,6 +107,11 @@ def train(store, hambox, spambox, maxmsgs, maxrounds, tdict, reverse, verbose,
         spamcan_ = list(reversed(spamcan_))
     
     nspam, nham = len(spamcan_), len(hambone_)
+
+    # Each round tokenizes the same messages again, so unless told
+    # otherwise have the tokenizer remember the tokens for all of them.
+    if not Options.options["Tokenizer", "x-token_cache_size"]:
+        Options.options["Tokenizer", "x-token_cache_size"] = nspam + nham
     if ratio:
         rspam, rham = ratio
         # If the actual ratio of spam to ham in the database is better than
@@ -194,6 +200,11 @@ def train(store, hambox, spambox, maxmsgs, maxrounds, tdict, reverse, verbose,
             if nleft:
                 print nleft, "untrained %ss" % name[is_spam]
 
+    cache = tokenizer.global_tokenizer.token_cache
+    if verbose and cache is not None:
+        print >> sys.stderr, "token cache hit rate: %.1f%%" % \
+              (100.0 * cache.stats.hit_rate(),)
+
 def cull(mbox_name, cullext, designation, tdict):
     print "writing new %s mbox..." % designation
     n = m = 0
@@ -131,7 +131,8 @@ def main(state):
     someone hits Ctrl+Break."""
     http_server = UserInterfaceServer(state.ui_port)
     http_server.register(CoreUserInterface(state))
-    Dibbler.run(launchBrowser=state.launch_ui)
+    Dibbler.run(launchBrowser=state.launch_ui,
+                poller=options["globals", "event_loop"])
 
 # ===================================================================
 # __main__ driver.
@@ -30,12 +30,18 @@
 # be ignored.
 #
 # sb_bnserver will close itself and remove its socket after a period of
-# inactivity to ensure it does not use up resources indefinitely.
+# inactivity to ensure it does not use up resources indefinitely, unless
+# it was started with -w, in which case it keeps a pool of pre-forked
+# workers running until it is killed.
+#
+# If mailbox files are named on the command line, every message in them is
+# sent over a single connection (see the sb_bnserver docstring for the
+# protocol) and the results are written to stdout one after another.
 #
 # Author: Toby Dickenson
 #
 
-"""Usage: %(program)s [options]
+"""Usage: %(program)s [options] [FILE ...]
 
 Where:
     -h
@@ -74,7 +80,14 @@ Where:
         timeout in seconds between requests before this server terminates
     -A number
         terminate this server after this many requests
+    -w number
+        start a long-running server with this many pre-forked workers.
+        Every request that trains (including -f, if the Hammie
+        train_on_filter option is set) makes all of the workers exit
+        and be forked again, so this suits mostly filtering.
 
+    If FILEs (mailboxes) are given, all of their messages are processed,
+    otherwise a single message is read from stdin.
 """
 
 import sys, getopt, socket, errno, os, time
@@ -89,7 +102,7 @@ def usage(code, msg=''):
         
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hfgstGSd:p:o:a:A:k:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hfgstGSd:p:o:a:A:w:k:')
     except getopt.error, msg:
         usage(2, msg)
 
@@ -103,18 +116,19 @@ def main():
             usage(0)
         elif opt in ('-f', '-g', '-s', '-t', '-G', '-S'):
             action_options.append(opt)
-        elif opt in ('-d', '-p', '-o', '-a', '-A'):
+        elif opt in ('-d', '-p', '-o', '-a', '-A', '-w'):
             server_options.append(opt)
             server_options.append(arg)
         elif opt == '-k':
             filename = arg
 
-    if args:
-        usage(2)
-        
     server_options.append(filename)
     s = make_socket(server_options, filename)
-        
+
+    if args:
+        filter_files(s, action_options, args)
+        return
+
     # We have a connection to the existing shared server
     w_file = s.makefile('w')
     r_file = s.makefile('r')
@@ -157,6 +171,32 @@ def main():
     if error:
         sys.exit(error)
 
+def filter_files(s, action_options, args):
+    from spambayes import mboxutils
+    # sb_bnserver is next to this script (see fork_server).
+    from sb_bnserver import PROTOCOL_2, write_request, read_response
+    w_file = s.makefile('w')
+    r_file = s.makefile('r')
+    switches = ' '.join(action_options)
+    # announce that this connection carries more than one request
+    w_file.write(PROTOCOL_2)
+    for fname in args:
+        for msg in mboxutils.getmbox(fname):
+            body = mboxutils.as_string(msg, unixfrom=True)
+            write_request(w_file, switches, body)
+            try:
+                error, response = read_response(r_file)
+            except EOFError, e:
+                print >> sys.stderr, e
+                sys.exit(3)
+            if error:
+                sys.stderr.write(response)
+                sys.exit(error)
+            sys.stdout.write(response)
+    w_file.close()
+    s.shutdown(1)
+    sys.stdout.flush()
+
 def make_socket(server_options, filename):
     refused_count = 0
     no_server_count = 0
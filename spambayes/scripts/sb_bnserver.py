@@ -21,17 +21,48 @@ Where:
         set [section, option] in the options database to value
     -a seconds
         timeout in seconds between requests before this server terminates
+        (ignored with -w)
     -A number
-        terminate this server after this many requests
+        terminate this server after this many requests (with -w, each
+        worker is replaced after it has handled this many connections)
+    -w number
+        pre-fork this many worker processes and keep running until the
+        server is terminated, rather than exiting when idle.  Every
+        request that trains (including -f, if the Hammie train_on_filter
+        option is set) makes all of the workers exit and be forked
+        again, so this suits mostly filtering.
     FILE
         unix domain socket used on which we listen    
+
+Clients may either send one request per connection (the command line
+switches on the first line, then the message until the end of the
+stream), or send the line "SBBN 2" followed by any number of requests,
+each of which is the switches on one line, the length of the message on
+the next, and then the message itself.  Each response is the error code
+on one line, the length of the response on the next, and then the
+response.
+
+With -w, the parent process loads the database and then forks the
+workers, which share its copy of the classifier and score messages
+independently.  Requests that change the database are passed on to the
+parent, so that they are carried out one at a time; the workers are then
+replaced with fresh ones that see the new data.
 """
 
 import os, getopt, sys, SocketServer, traceback, select, socket, errno
+import signal
 
 # See Options.py for explanations of these properties
 program = sys.argv[0]
-  
+
+# The first line sent by clients that use the multiple request protocol.
+PROTOCOL_2 = 'SBBN 2\n'
+
+# Storage types whose classifier is held entirely in memory (or in a
+# read-only mapping), so that pre-forked workers can share the parent's
+# copy.  For the others, each worker opens the database itself.
+SHARED_STORAGE_TYPES = ("pickle", "packed", "mmap")
+
 
 def usage(code, msg=''):
     """Print usage message and sys.exit(code)."""
@@ -45,7 +76,7 @@ def usage(code, msg=''):
 def main():
     """Main program; parse options and go."""
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hd:p:o:a:A:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hd:p:o:a:A:w:')
     except getopt.error, msg:
         usage(2, msg)
 
@@ -75,10 +106,15 @@ def main():
                     server.timeout = float(arg)
                 elif opt == '-A':
                     server.number = int(arg)
+                elif opt == '-w':
+                    server.workers = int(arg)
             h = make_HammieFilter()
             h.dbname, h.usedb = storage.database_type(opts)
             server.hammie = h
-            server.serve_until_idle()
+            if server.workers:
+                server.serve_prefork()
+            else:
+                server.serve_until_idle()
             h.close()
         finally:
             try:
@@ -86,6 +122,41 @@ def main():
             except EnvironmentError:
                 pass
 
+
+def read_request(rfile):
+    """Read a length-prefixed request from rfile.
+
+    Return (switches, body), or None if the stream is at an end.
+    """
+    switches = rfile.readline()
+    if not switches:
+        return None
+    size = int(rfile.readline())
+    body = rfile.read(size)
+    if len(body) != size:
+        raise EOFError("request truncated")
+    return switches, body
+
+def write_request(wfile, switches, body):
+    wfile.write('%s\n%d\n' % (switches.strip(), len(body)))
+    wfile.write(body)
+    wfile.flush()
+
+def read_response(rfile):
+    """Read a response from rfile, and return (error, response)."""
+    error = int(rfile.readline())
+    size = int(rfile.readline())
+    response = rfile.read(size)
+    if len(response) != size:
+        raise EOFError("response truncated")
+    return error, response
+
+def write_response(wfile, error, response):
+    wfile.write('%d\n%d\n' % (error, len(response)))
+    wfile.write(response)
+    wfile.flush()
+
+
 class NowIdle(Exception):
     pass
         
@@ -93,6 +164,14 @@ class BNServer(SocketServer.UnixStreamServer):
     allow_reuse_address = True
     timeout = 10.0
     number = 100
+    workers = 0
+    hammie = None
+
+    # Only set in pre-forked worker processes: the files used to pass
+    # requests on to the parent, and whether the database has changed
+    # since this worker was forked.
+    master_rfile = master_wfile = None
+    stale = False
 
     def serve_until_idle(self):
         try:
@@ -107,29 +186,38 @@ class BNServer(SocketServer.UnixStreamServer):
             return self.socket.accept()
         else:
             raise NowIdle()
-        
-class BNRequest(SocketServer.StreamRequestHandler):
-    def handle(self):
-        switches = self.rfile.readline()
-        body = self.rfile.read()
+
+    def respond(self, switches, body):
+        """Carry out a request, returning (error, response)."""
         try:
-            response = self._calc_response(switches, body)
-            self.wfile.write('0\n%d\n'%(len(response),))
-            self.wfile.write(response)
+            if self.master_wfile is not None and \
+               (self.stale or self.is_training(switches)):
+                return self.forward(switches, body)
+            return 0, self.calc_response(switches, body)
         except:
             response = traceback.format_exception_only(sys.exc_info()[0],
                                                        sys.exc_info()[1])[0]
-            self.wfile.write('1\n%d\n'%(len(response),))
-            self.wfile.write(response)
-       
-    def _calc_response(self, switches, body):
-        switches = switches.split()
+            return 1, response
+
+    def parse_switches(self, switches):
+        opts, args = getopt.getopt(switches.split(), 'fgstGS')
+        return [opt for opt, arg in opts] or ['-f']
+
+    def is_training(self, switches):
+        """Return True if the request will change the database."""
+        from spambayes import Options
+        for opt in self.parse_switches(switches):
+            if opt != '-f' or \
+               Options.options["Hammie", "train_on_filter"]:
+                return True
+        return False
+
+    def calc_response(self, switches, body):
+        h = self.hammie
         actions = []
-        opts, args = getopt.getopt(switches, 'fgstGS')
-        h = self.server.hammie
-        for opt, arg in opts:
+        for opt in self.parse_switches(switches):
             if opt == '-f':
-                actions.append(h.filter)
+                actions.append(self.filter)
             elif opt == '-g':
                 actions.append(h.train_ham)
             elif opt == '-s':
@@ -140,14 +228,197 @@ class BNRequest(SocketServer.StreamRequestHandler):
                 actions.append(h.untrain_ham)
             elif opt == '-S':
                 actions.append(h.untrain_spam)
-        if actions == []:
-            actions = [h.filter]
         from spambayes import mboxutils
         msg = mboxutils.get_message(body)
         for action in actions:
             action(msg)
         return mboxutils.as_string(msg, 1)
 
+    def filter(self, msg):
+        from spambayes import Options
+        h = self.hammie
+        if self.workers and h.h is not None and \
+           not Options.options["Hammie", "train_on_filter"]:
+            # A pre-forked server opens the database once, in whatever
+            # mode it needs; don't let HammieFilter reopen it read-only.
+            return h.h.filter(msg)
+        return h.filter(msg)
+
+    # The rest is only used with -w.
+
+    def serve_prefork(self):
+        """Run the parent process of a pre-forked server.
+
+        The parent never accepts connections itself; it keeps the pool of
+        workers topped up and carries out the training requests that they
+        pass on.
+        """
+        self.shared = self.hammie.usedb in SHARED_STORAGE_TYPES
+        if self.shared:
+            self.hammie.open('c')
+        self.children = {}
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        try:
+            while True:
+                while len(self.children) < self.workers:
+                    self.spawn_worker()
+                channels = dict([(sock, pid) for pid, (sock, rfile, wfile)
+                                 in self.children.items()])
+                try:
+                    r, w, e = select.select(channels.keys(), [], [], 1.0)
+                except select.error, e:
+                    if e[0] != errno.EINTR:
+                        raise
+                    r = []
+                for sock in r:
+                    self.handle_worker(channels[sock])
+                self.reap_workers()
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            for pid in self.children.keys():
+                self.kill_worker(pid, signal.SIGTERM)
+            for pid in self.children.keys():
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def handle_sigterm(self, signum, frame):
+        raise SystemExit(0)
+
+    def spawn_worker(self):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid:
+            child_sock.close()
+            self.children[pid] = (parent_sock, parent_sock.makefile('rb'),
+                                  parent_sock.makefile('wb'))
+            return
+        # In the worker.  Never return into the parent's code, and don't
+        # let HammieFilter store the database on the way out.
+        status = 1
+        try:
+            try:
+                parent_sock.close()
+                for sock, rfile, wfile in self.children.values():
+                    sock.close()
+                self.children = {}
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, self.handle_sighup)
+                self.master_rfile = child_sock.makefile('rb')
+                self.master_wfile = child_sock.makefile('wb')
+                if not self.shared:
+                    self.hammie.h = None
+                    self.hammie.open('r')
+                self.serve_worker()
+                status = 0
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def handle_sighup(self, signum, frame):
+        self.stale = True
+
+    def serve_worker(self):
+        """Accept and handle connections until the database changes, or
+        this worker has handled its share of connections."""
+        handled = 0
+        while not self.stale and handled < self.number:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            handled += 1
+            try:
+                self.process_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def forward(self, switches, body):
+        """Pass a request on to the parent process."""
+        write_request(self.master_wfile, switches, body)
+        return read_response(self.master_rfile)
+
+    def handle_worker(self, pid):
+        """Carry out a request passed on by a worker."""
+        sock, rfile, wfile = self.children[pid]
+        try:
+            request = read_request(rfile)
+        except (EOFError, ValueError, socket.error):
+            request = None
+        if request is None:
+            # The worker has gone away; reap_workers will tidy up.
+            return
+        switches, body = request
+        try:
+            training = self.is_training(switches)
+        except getopt.error:
+            # respond will report the problem.
+            training = False
+        error, response = self.respond(switches, body)
+        if training:
+            self.trained(switches)
+        try:
+            write_response(wfile, error, response)
+        except socket.error:
+            pass
+        if training:
+            # Every worker now has an out of date classifier.  They pass
+            # on the rest of their current connection's requests to us,
+            # and then exit, and are replaced by fresh copies of this
+            # process.
+            for child in self.children.keys():
+                self.kill_worker(child, signal.SIGHUP)
+
+    def trained(self, switches):
+        h = self.hammie
+        if not self.shared:
+            # Let the new workers open the database.
+            h.close()
+        elif h.h is not None:
+            for opt in self.parse_switches(switches):
+                if opt not in ('-g', '-s', '-G', '-S'):
+                    # HammieFilter only stores after these.
+                    h.h.store()
+                    break
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def reap_workers(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if pid in self.children:
+                self.children.pop(pid)[0].close()
+
+
+class BNRequest(SocketServer.StreamRequestHandler):
+    def handle(self):
+        switches = self.rfile.readline()
+        if switches == PROTOCOL_2:
+            while True:
+                request = read_request(self.rfile)
+                if request is None:
+                    break
+                error, response = self.server.respond(*request)
+                write_response(self.wfile, error, response)
+        else:
+            body = self.rfile.read()
+            error, response = self.server.respond(switches, body)
+            write_response(self.wfile, error, response)
+
 
 def make_HammieFilter():
     # The sb_hammie script has some logic in the HammieFiler class that we need here too.
@@ -125,7 +125,9 @@ import re
 import time
 import getopt
 import types
+import Queue
 import thread
+import threading
 import email
 import email.Parser
 from getpass import getpass
@@ -161,6 +163,33 @@ class BadIMAPResponseError(Exception):
                (self.command, self.response)
 
 
+# The message info database and the classifier aren't safe to use from
+# more than one thread at once, so when several sessions are filtering
+# at the same time (see IMAPFilter.Filter), everything that touches them
+# holds this lock.
+db_lock = threading.RLock()
+
+
+def uid_set(uids):
+    """Return an IMAP message set that covers the given uids, with runs
+    of consecutive uids collapsed into ranges (e.g. "3,7:9,12")."""
+    uids = [int(uid) for uid in uids]
+    uids.sort()
+    ranges = []
+    for uid in uids:
+        if ranges and uid <= ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    parts = []
+    for first, last in ranges:
+        if first == last:
+            parts.append(str(first))
+        else:
+            parts.append("%d:%d" % (first, last))
+    return ",".join(parts)
+
+
 class IMAPSession(BaseIMAP):
     '''A class extending the IMAP4 class, with a few optimizations'''
 
@@ -457,6 +486,7 @@ class IMAPSession(BaseIMAP):
             response = (response,)
 
         data = {}
+        num = None
         for msg in response:
             msg_data = self._extract_fetch_data(msg)
             if msg_data:
@@ -466,8 +496,56 @@ class IMAPSession(BaseIMAP):
                     data[num].update(msg_data)
                 else:
                     data[num] = msg_data
+            elif num is not None and isinstance(msg, types.StringTypes):
+                # Some servers send the UID after a literal, in which
+                # case it arrives on its own (" UID 101)"), and belongs
+                # to the message before it.
+                mo = self.UID_RE.search(msg)
+                if mo is not None:
+                    data[num]["UID"] = mo.group(2)
         return data
 
+    def fetch_many(self, uids, items):
+        """Fetch the given items for many messages in the current folder.
+
+        Rather than one UID FETCH per message, the uids are split into
+        batches of options["imap", "fetch_batch_size"], and each batch is
+        fetched with a single command, using a message set.  Up to
+        options["imap", "pipeline_depth"] of those commands are sent
+        before any of their responses are read, so that we don't wait
+        for a round trip per command either.
+
+        Returns a dictionary mapping each uid (as a string) to the data
+        extract_fetch_data() found for it.  Messages that the server
+        didn't return (because they have been expunged, for example)
+        are simply missing."""
+        batch_size = max(1, options["imap", "fetch_batch_size"])
+        depth = max(1, options["imap", "pipeline_depth"])
+        # We need the UID to tell the messages apart.
+        items = "(UID %s)" % (" ".join(items),)
+        uids = list(uids)
+        sets = [uid_set(uids[i:i+batch_size])
+                for i in xrange(0, len(uids), batch_size)]
+        result = {}
+        for i in xrange(0, len(sets), depth):
+            pipelined = sets[i:i+depth]
+            tags = [self._command("UID", "FETCH", message_set, items)
+                    for message_set in pipelined]
+            # All the responses must be read before we check any of them,
+            # or the data from the rest would be left behind to confuse
+            # later commands.
+            responses = [self._command_complete("UID", tag) for tag in tags]
+            response_data = self.untagged_responses.pop("FETCH", None)
+            for message_set, response in zip(pipelined, responses):
+                self.check_response("uid fetch %s %s" % (message_set, items),
+                                    response)
+            if response_data is None:
+                continue
+            for msg_data in self.extract_fetch_data(response_data).values():
+                if "UID" in msg_data:
+                    result[msg_data["UID"]] = msg_data
+        return result
+
     # Maximum amount of data that will be read at any one time.
     MAXIMUM_SAFE_READ = 4096
     def safe_read(self, size):
@@ -494,6 +572,9 @@ class IMAPMessage(message.SBHeaderMessage):
         self.invalid = False
         self.could_not_retrieve = False
         self.imap_server = None
+        # The substance of the message, if IMAPFolder.prefetch() has
+        # already fetched it for us.
+        self.prefetched = None
 
     def extractTime(self):
         """When we create a new copy of a message, we need to specify
@@ -532,6 +613,64 @@ class IMAPMessage(message.SBHeaderMessage):
         assert self.uid, "Cannot get substance of message without an UID"
         assert self.imap_server, "Cannot do anything without IMAP connection"
 
+        rfc822_data = self.prefetched
+        if rfc822_data is None:
+            rfc822_data = self._fetch_substance()
+            if rfc822_data is None:
+                return self
+        self.prefetched = None
+
+        try:
+            new_msg = email.message_from_string(rfc822_data, IMAPMessage)
+        # We use a general 'except' because the email package doesn't
+        # always return email.Errors (it can return a TypeError, for
+        # example) if the email is invalid.  In any case, we want
+        # to keep going, and not crash, because we might leave the
+        # user's mailbox in a bad state if we do.  Better to soldier on.
+        except:
+            # Yikes!  Barry set this to return at this point, which
+            # would work ok for training (IIRC, that's all he's
+            # using it for), but for filtering, what happens is that
+            # the message ends up blank, but ok, so the original is
+            # flagged to be deleted, and a new (almost certainly
+            # unsure) message, *with only the spambayes headers* is
+            # created.  The nice solution is still to do what sb_server
+            # does and have a X-Spambayes-Exception header with the
+            # exception data and then the original message.
+            self.invalid = True
+            text, details = message.insert_exception_header(
+                rfc822_data, self.id)
+            self.invalid_content = text
+            self.got_substance = True
+
+            # Print the exception and a traceback.
+            print >> sys.stderr, details
+
+            return self            
+
+        new_msg.folder = self.folder
+        new_msg.previous_folder = self.previous_folder
+        new_msg.rfc822_command = self.rfc822_command
+        new_msg.rfc822_key = self.rfc822_key
+        new_msg.imap_server = self.imap_server
+        new_msg.uid = self.uid
+        db_lock.acquire()
+        try:
+            new_msg.setId(self.id)
+        finally:
+            db_lock.release()
+        new_msg.got_substance = True
+
+        if not new_msg.has_key(options["Headers", "mailid_header_name"]):
+            new_msg[options["Headers", "mailid_header_name"]] = self.id
+
+        if options["globals", "verbose"]:
+            sys.stdout.write(chr(8) + "*")
+        return new_msg
+
+    def _fetch_substance(self):
+        """Fetch the RFC822 message from the IMAP server, returning None
+        (and setting could_not_retrieve) if that isn't possible."""
         # First, try to select the folder that the message is in.
         try:
             self.imap_server.SelectFolder(self.folder.name)
@@ -541,7 +680,7 @@ class IMAPMessage(message.SBHeaderMessage):
             self.could_not_retrieve = True
             print >> sys.stderr, "Could not select folder %s for message " \
                   "%s (uid %s)" % (self.folder.name, self.id, self.uid)
-            return self
+            return None
 
         # Now try to fetch the substance of the message.
         try:
@@ -564,7 +703,7 @@ class IMAPMessage(message.SBHeaderMessage):
             self.could_not_retrieve = True
             print >> sys.stderr, "MemoryError with message %s (uid %s)" % \
                   (self.id, self.uid)
-            return self
+            return None
 
         command = "uid fetch %s" % (self.uid,)
         response_data = self.imap_server.check_response(command, response)
@@ -580,50 +719,7 @@ class IMAPMessage(message.SBHeaderMessage):
                 break
         if rfc822_data is None:
             raise BadIMAPResponseError("FETCH response", response_data)
-
-        try:
-            new_msg = email.message_from_string(rfc822_data, IMAPMessage)
-        # We use a general 'except' because the email package doesn't
-        # always return email.Errors (it can return a TypeError, for
-        # example) if the email is invalid.  In any case, we want
-        # to keep going, and not crash, because we might leave the
-        # user's mailbox in a bad state if we do.  Better to soldier on.
-        except:
-            # Yikes!  Barry set this to return at this point, which
-            # would work ok for training (IIRC, that's all he's
-            # using it for), but for filtering, what happens is that
-            # the message ends up blank, but ok, so the original is
-            # flagged to be deleted, and a new (almost certainly
-            # unsure) message, *with only the spambayes headers* is
-            # created.  The nice solution is still to do what sb_server
-            # does and have a X-Spambayes-Exception header with the
-            # exception data and then the original message.
-            self.invalid = True
-            text, details = message.insert_exception_header(
-                rfc822_data, self.id)
-            self.invalid_content = text
-            self.got_substance = True
-
-            # Print the exception and a traceback.
-            print >> sys.stderr, details
-
-            return self            
-
-        new_msg.folder = self.folder
-        new_msg.previous_folder = self.previous_folder
-        new_msg.rfc822_command = self.rfc822_command
-        new_msg.rfc822_key = self.rfc822_key
-        new_msg.imap_server = self.imap_server
-        new_msg.uid = self.uid
-        new_msg.setId(self.id)
-        new_msg.got_substance = True
-
-        if not new_msg.has_key(options["Headers", "mailid_header_name"]):
-            new_msg[options["Headers", "mailid_header_name"]] = self.id
-
-        if options["globals", "verbose"]:
-            sys.stdout.write(chr(8) + "*")
-        return new_msg
+        return rfc822_data
 
     def MoveTo(self, dest):
         '''Note that message should move to another folder.  No move is
@@ -807,8 +903,62 @@ class IMAPFolder(object):
 
     def __iter__(self):
         """Iterate through the messages in this IMAP folder."""
-        for key in self.keys():
-            yield self[key]
+        for batch in self.batches():
+            for msg in batch:
+                yield msg
+
+    def batches(self):
+        """Iterate through the messages in this IMAP folder, a list of
+        messages at a time.
+
+        As with __getitem__, the messages have no substance, but the
+        headers for each list are fetched together (see
+        IMAPSession.fetch_many), rather than one message at a time."""
+        keys = self.keys()
+        size = max(1, options["imap", "fetch_batch_size"]) * \
+               max(1, options["imap", "pipeline_depth"])
+        for i in xrange(0, len(keys), size):
+            uids = keys[i:i+size]
+            self.imap_server.SelectFolder(self.name)
+            data = self.imap_server.fetch_many(uids, ("RFC822.HEADER",))
+            batch = []
+            for uid in uids:
+                msg_data = data.get(uid, {})
+                if "RFC822.HEADER" not in msg_data:
+                    # The message has disappeared since we asked for the
+                    # keys (another client has expunged it, perhaps).
+                    continue
+                batch.append(self._make_message(uid,
+                                                msg_data["RFC822.HEADER"]))
+            yield batch
+
+    def prefetch(self, msgs):
+        """Fetch the substance of the given messages (which must be in
+        this folder) all together, so that get_full_message() doesn't
+        need to ask the server for each of them in turn."""
+        msgs = [msg for msg in msgs if not msg.got_substance]
+        if not msgs:
+            return
+        try:
+            self.imap_server.SelectFolder(self.name)
+            data = self.imap_server.fetch_many([msg.uid for msg in msgs],
+                                               ("BODY.PEEK[]",))
+        except (BadIMAPResponseError, MemoryError):
+            # get_full_message() will try again, one message at a time,
+            # and knows how to deal with any problems.
+            return
+        for msg in msgs:
+            msg_data = data.get(str(msg.uid), {})
+            if msg.rfc822_key in msg_data:
+                msg.prefetched = msg_data[msg.rfc822_key]
+
+    def _iter_prefetching(self, wanted):
+        """Iterate through the messages in this IMAP folder, prefetching
+        the substance of those for which wanted(msg) is true."""
+        for batch in self.batches():
+            self.prefetch([msg for msg in batch if wanted(msg)])
+            for msg in batch:
+                yield msg
 
     def keys(self):
         '''Returns *uids* for all the messages in the folder not
@@ -852,11 +1002,14 @@ class IMAPFolder(object):
                 break
         if headers is None:
             raise BadIMAPResponseError("FETCH response", response_data)
+        return self._make_message(key, headers)
 
-        # Create a new IMAPMessage object, which will be the return value.
+    def _make_message(self, uid, headers):
+        """Create an IMAPMessage (without substance) for the message with
+        the given uid and headers."""
         msg = IMAPMessage()
         msg.folder = self
-        msg.uid = key
+        msg.uid = uid
         msg.imap_server = self.imap_server
 
         # We use the MessageID header as the ID for the message, as long
@@ -865,13 +1018,12 @@ class IMAPFolder(object):
         for id_header_re in [self.custom_header_id_re, self.message_id_re]:
             mo = id_header_re.search(headers)
             if mo:
-                msg.setId(mo.group(1))
+                newid = mo.group(1)
                 break
         else:
             newid = self._generate_id()
             if options["globals", "verbose"]:
                 print >> sys.stderr, "[imapfilter] saving", msg.uid, "with new id:", newid
-            msg.setId(newid)
             # Unfortunately, we now have to re-save this message, so that
             # our id is stored on the IMAP server.  The vast majority of
             # messages have Message-ID headers, from what I can tell, so
@@ -879,6 +1031,11 @@ class IMAPFolder(object):
             # with the previous solution, anyway!
             # msg = msg.get_full_message()
             # msg.Save()
+        db_lock.acquire()
+        try:
+            msg.setId(newid)
+        finally:
+            db_lock.release()
 
         if options["globals", "verbose"]:
             sys.stdout.write(".")
@@ -900,7 +1057,8 @@ class IMAPFolder(object):
     def Train(self, classifier, isSpam):
         """Train folder as spam/ham."""
         num_trained = 0
-        for msg in self:
+        for msg in self._iter_prefetching(lambda msg:
+                                          msg.GetTrained() != isSpam):
             if msg.GetTrained() == (not isSpam):
                 msg = msg.get_full_message()
                 if msg.could_not_retrieve:
@@ -952,7 +1110,9 @@ class IMAPFolder(object):
         count["ham"] = 0
         count["spam"] = 0
         count["unsure"] = 0
-        for msg in self:
+        def wanted(msg):
+            return msg.GetClassification() is None or hamfolder is not None
+        for msg in self._iter_prefetching(wanted):
             cls = msg.GetClassification()
             if cls is None or hamfolder is not None:
                 if options["globals", "verbose"]:
@@ -970,12 +1130,16 @@ class IMAPFolder(object):
                         print >> sys.stderr, "[imapfilter] could not retrieve:", msg.uid
                     continue
                 
-                (prob, clues) = classifier.spamprob(msg.tokenize(),
-                                                    evidence=True)
-                # Add headers and remember classification.
-                msg.delSBHeaders()
-                msg.addSBHeaders(prob, clues)
-                self.stats.RecordClassification(prob)
+                db_lock.acquire()
+                try:
+                    (prob, clues) = classifier.spamprob(msg.tokenize(),
+                                                        evidence=True)
+                    # Add headers and remember classification.
+                    msg.delSBHeaders()
+                    msg.addSBHeaders(prob, clues)
+                    self.stats.RecordClassification(prob)
+                finally:
+                    db_lock.release()
 
                 cls = msg.GetClassification()
                 if cls == options["Headers", "header_ham_string"]:
@@ -1013,6 +1177,10 @@ class IMAPFilter(object):
         self.classifier = classifier
         self.imap_server = None
         self.stats = stats
+        # If set, this is called (with no arguments) to open and log in
+        # another session to the same server as imap_server, so that
+        # Filter() can use options["imap", "sessions"] of them at once.
+        self.new_session = None
 
     def Train(self):
         assert self.imap_server, "Cannot do anything without IMAP server."
@@ -1098,6 +1266,7 @@ class IMAPFilter(object):
                 print >> sys.stderr, "Cannot select ham folder.  Please check configuration."
                 sys.exit(-1)
                 
+        filter_folders = []
         for filter_folder in options["imap", "filter_folders"]:
             # Select the folder to make sure it exists.
             try:
@@ -1105,10 +1274,16 @@ class IMAPFilter(object):
             except BadIMAPResponseError:
                 print >> sys.stderr, "Cannot select", filter_folder, "... skipping." 
                 continue
+            filter_folders.append(filter_folder)
 
-            folder = IMAPFolder(filter_folder, self.imap_server, self.stats)
-            subcount = folder.Filter(self.classifier, self.spam_folder,
-                                     self.unsure_folder, self.ham_folder)
+        num_sessions = min(options["imap", "sessions"], len(filter_folders))
+        if num_sessions > 1 and self.new_session is not None:
+            subcounts = self._filter_concurrently(filter_folders,
+                                                  num_sessions)
+        else:
+            subcounts = [self._filter_folder(self.imap_server, filter_folder)
+                         for filter_folder in filter_folders]
+        for subcount in subcounts:
             for key in count.keys():
                 count[key] += subcount.get(key, 0)
 
@@ -1118,6 +1293,64 @@ class IMAPFilter(object):
                                       (count["ham"], count["spam"], count["unsure"]))
             print >> sys.stderr, "Classifying took %.4f seconds." % (time.time() - t,)
 
+    def _filter_folder(self, imap_server, folder_name):
+        folder = IMAPFolder(folder_name, imap_server, self.stats)
+        return folder.Filter(self.classifier, self.spam_folder,
+                             self.unsure_folder, self.ham_folder)
+
+    def _filter_concurrently(self, folder_names, num_sessions):
+        """Filter the named folders over num_sessions sessions at once.
+
+        Each folder is filtered entirely over one session; imap_server is
+        one of the sessions, and the others are opened with new_session()
+        and logged out again at the end.  Returns a list of the counts
+        from each folder."""
+        queue = Queue.Queue()
+        for folder_name in folder_names:
+            queue.put(folder_name)
+        counts = []
+        errors = []
+
+        def work(imap_server):
+            while True:
+                try:
+                    folder_name = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                counts.append(self._filter_folder(imap_server, folder_name))
+
+        def worker():
+            # If we can't get another session, that's no disaster: the
+            # ones we do have will take up the slack.
+            try:
+                imap_server = self.new_session()
+            except LoginFailure, e:
+                print >> sys.stderr, str(e)
+                return
+            if not imap_server.connected:
+                return
+            try:
+                try:
+                    work(imap_server)
+                finally:
+                    imap_server.logout()
+            except:
+                errors.append(sys.exc_info())
+
+        threads = []
+        for i in xrange(num_sessions - 1):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        work(self.imap_server)
+        for t in threads:
+            t.join()
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+        return counts
+
 
 def servers(promptForPass = False):
     """Returns a list containing a tuple (server,user,passwd) for each IMAP server in options.
@@ -1295,6 +1528,14 @@ def run(force_UI=False):
                         print str(e)
                         continue
                     imap_filter.imap_server = imap
+                    def new_session(server=server, imapDebug=imapDebug,
+                                    doExpunge=doExpunge, username=username,
+                                    password=password):
+                        session = IMAPSession(server, imapDebug, doExpunge)
+                        if session.connected:
+                            session.login(username, password)
+                        return session
+                    imap_filter.new_session = new_session
 
                     if doTrain:
                         if options["globals", "verbose"]:
@@ -38,17 +38,48 @@ Where OPTIONS is one or more of:
 
     -r  remove mail which was trained on (Maildir only)
 
+    -B  don't batch database updates; train on each message as it is
+        read.  Batching is quicker, particularly with dbm databases, but
+        needs memory for the word counts of a whole mailbox.
+
+    -j N
+        parse and tokenize the messages in N worker processes, while
+        this one trains on them (and writes them back).  The database
+        is the same as without -j.
+
+    -m
+        read mbox files through mmap, which is quicker; with -j, each
+        worker process reads its own share of the mbox, rather than
+        being sent the messages.  Only use this for mailboxes that no
+        other program changes during training: one that is shortened
+        while it is being read kills %(program)s (with SIGBUS).
+
     -o section:option:value
         set [section, option] in the options database to value
 """
 
+from __future__ import with_statement
+
 import sys, os, getopt, email
+import time
 import shutil
+import itertools
+import contextlib
+import collections
 from spambayes import hammie, storage, mboxutils
+from spambayes.tokenizer import tokenize
 from spambayes.Options import options, get_pathname_option
 
 program = sys.argv[0]
 loud = True
+batch = True
+processes = 1
+pool = None
+use_mmap = False
+
+# With -j, the worker processes are given this many messages at a time,
+# and a few such chunks are prepared ahead of the one being trained on.
+CHUNK_SIZE = 50
 
 def get_message(obj):
     """Return an email Message object.
@@ -70,8 +101,21 @@ def get_message(obj):
         msg = None
     return msg
 
-def msg_train(h, msg, is_spam, force):
-    """Train bayes with a single message."""
+def trained_string(is_spam):
+    """Return the value of the trained header for is_spam."""
+    if is_spam:
+        return options["Headers", "header_spam_string"]
+    else:
+        return options["Headers", "header_ham_string"]
+
+def msg_check(msg, is_spam, force):
+    """Work out whether a message needs training.
+
+    Returns None if it doesn't, and otherwise whether it has to be
+    untrained (as the other kind) first.  If it needs training, its
+    trained header is removed.
+
+    """
 
     # XXX: big hack -- why is email.Message unable to represent
     # multipart/alternative?
@@ -79,12 +123,9 @@ def msg_train(h, msg, is_spam, force):
         mboxutils.as_string(msg)
     except TypeError:
         # We'll be unable to represent this as text :(
-        return False
+        return None
 
-    if is_spam:
-        spamtxt = options["Headers", "header_spam_string"]
-    else:
-        spamtxt = options["Headers", "header_ham_string"]
+    spamtxt = trained_string(is_spam)
     oldtxt = msg.get(options["Headers", "trained_header_name"])
     if force:
         # Train no matter what.
@@ -92,16 +133,183 @@ def msg_train(h, msg, is_spam, force):
             del msg[options["Headers", "trained_header_name"]]
     elif oldtxt == spamtxt:
         # Skip this one, we've already trained with it.
-        return False
+        return None
     elif oldtxt != None:
         # It's been trained, but as something else.  Untrain.
         del msg[options["Headers", "trained_header_name"]]
+        return True
+    return False
+
+def msg_train(h, msg, is_spam, force):
+    """Train bayes with a single message."""
+
+    untrain = msg_check(msg, is_spam, force)
+    if untrain is None:
+        return False
+    if untrain:
         h.untrain(msg, not is_spam)
     h.train(msg, is_spam)
-    msg.add_header(options["Headers", "trained_header_name"], spamtxt)
+    msg.add_header(options["Headers", "trained_header_name"],
+                   trained_string(is_spam))
 
     return True
 
+def prepare_message(item, is_spam, force, from_files=False,
+                    write_all=False, unixfrom=False):
+    """Parse and tokenize a message for training.
+
+    This is the part of training that -j spreads over the worker
+    processes.  item is the text of the message, or, if from_files is
+    True, the name of the file that it is in.  Returns None if the
+    message is malformed, and otherwise (untrain, tokens, text), where
+    untrain is what msg_check() returned, tokens is a tuple of the
+    message's tokens, in order (None if it doesn't need training), and
+    text is the message with its trained header, to write back to the
+    mailbox (None if it isn't to be written back; unless write_all is
+    True, only trained messages are).
+
+    """
+
+    if from_files:
+        f = file(item, "rb")
+        msg = get_message(f)
+        f.close()
+    else:
+        msg = get_message(item)
+    if not msg:
+        return None
+    untrain = msg_check(msg, is_spam, force)
+    tokens = text = None
+    if untrain is not None:
+        # (In order, since the bigrams are made from neighbouring tokens.)
+        tokens = tuple(tokenize(msg))
+        msg.add_header(options["Headers", "trained_header_name"],
+                       trained_string(is_spam))
+    if options["Headers", "include_trained"] and \
+       (write_all or untrain is not None):
+        text = mboxutils.as_string(msg, unixfrom)
+    return untrain, tokens, text
+
+def _prepare_chunk((items, args)):
+    # Run prepare_message() in a worker process.
+    return [prepare_message(item, *args) for item in items]
+
+# The mbox that a worker process is reading with -m.
+_mapped = None
+
+def _prepare_shard((key, i, n, args)):
+    # Run prepare_message() in a worker process, for the i'th of n shards
+    # of an mbox, which is mapped once (per version of the file).
+    global _mapped
+    if _mapped is None or _mbox_key(_mapped) != key:
+        if _mapped is not None:
+            _mapped.close()
+        _mapped = mboxutils.MmapMailbox(key[0])
+    shard = _mapped.shard(i, n)
+    try:
+        return [prepare_message(text, *args) for text in shard]
+    finally:
+        shard.close()
+
+def _mbox_key(mbox):
+    return mbox.name, mbox.index.size, mbox.index.mtime
+
+def _jobs(items, args):
+    """Generate (chunk, function, argument) for each chunk of items to
+    be prepared by a worker process, which returns the prepared messages
+    when it is given function(argument).  chunk is None if the items are
+    only read by the worker."""
+
+    if isinstance(items, mboxutils.MmapMailbox):
+        n = max((len(items) + CHUNK_SIZE - 1) // CHUNK_SIZE, 1)
+        for i in xrange(n):
+            yield None, _prepare_shard, (_mbox_key(items), i, n, args)
+        return
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, CHUNK_SIZE))
+        if not chunk:
+            break
+        yield chunk, _prepare_chunk, (chunk, args)
+
+def prepared_messages(items, is_spam, force, from_files=False,
+                      write_all=False, unixfrom=False):
+    """Generate (item, prepare_message(item, ...)) for each of items.
+
+    With -j, the messages are prepared by the worker processes, a chunk
+    at a time, and a few chunks ahead (but not the whole mailbox, which
+    might not fit in memory).  They are still generated in order, so
+    they are trained in the same order as without -j.  If items is an
+    MmapMailbox, the workers read the messages from it themselves, and
+    None is generated in place of each item.
+
+    """
+
+    args = (is_spam, force, from_files, write_all, unixfrom)
+    if pool is None:
+        for item in items:
+            yield item, prepare_message(item, *args)
+        return
+
+    jobs = _jobs(items, args)
+    pending = collections.deque()
+    while True:
+        for chunk, function, argument in \
+                itertools.islice(jobs, 2 * processes - len(pending)):
+            pending.append((chunk, pool.apply_async(function, (argument,))))
+        if not pending:
+            break
+        chunk, results = pending.popleft()
+        if chunk is None:
+            chunk = itertools.repeat(None)
+        for item, prepared in itertools.izip(chunk, results.get()):
+            yield item, prepared
+
+def prepared_train(h, untrain, tokens, is_spam):
+    """Train bayes with a message prepared by prepare_message()."""
+
+    if untrain:
+        h.bayes.unlearn(tokens, not is_spam)
+    h.bayes.learn(tokens, is_spam)
+
+@contextlib.contextmanager
+def _no_batch():
+    yield
+
+def training_batch(h):
+    """Return a context manager that collects the word counts of the
+    messages trained in it, and applies them to the database at the end
+    (or, with -B, one that does nothing).
+
+    Mailboxes are only rewritten, and messages removed, once it has
+    finished, so that no message is marked as trained (or gone) unless
+    its counts are in the database.
+    """
+
+    if batch:
+        return h.bayes.bulk_update()
+    return _no_batch()
+
+def replace_messages(replaced, removetrained=False):
+    """Move each (temporary file, message file) pair in replaced into
+    place, removing the message instead if removetrained is true."""
+
+    for tfn, cfn in replaced:
+        # XXX: This will raise an exception on Windows.  Do any Windows
+        # people actually use Maildirs or MH directories?
+        os.rename(tfn, cfn)
+        if (removetrained):
+            os.unlink(cfn)
+
+def discard_messages(replaced):
+    """Remove the temporary files in replaced, after an error."""
+
+    for tfn, cfn in replaced:
+        try:
+            os.unlink(tfn)
+        except OSError:
+            pass
+
 def maildir_train(h, path, is_spam, force, removetrained):
     """Train bayes with all messages from a maildir."""
 
@@ -116,38 +324,40 @@ def maildir_train(h, path, is_spam, force, removetrained):
     counter = 0
     trained = 0
 
-    for fn in os.listdir(path):
-        cfn = os.path.join(path, fn)
-        tfn = os.path.normpath(os.path.join(path, "..", "tmp",
-                           "%d.%d_%d.%s" % (time.time(), pid,
-                                            counter, host)))
-        if (os.path.isdir(cfn)):
-            continue
-        counter += 1
-        if loud and counter % 10 == 0:
-            sys.stdout.write("\r%6d" % counter)
-            sys.stdout.flush()
-        f = file(cfn, "rb")
-        msg = get_message(f)
-        f.close()
-        if not msg:
-            print "Malformed message: %s.  Skipping..." % cfn
-            continue
-        if not msg_train(h, msg, is_spam, force):
-            continue
-        trained += 1
-        if not options["Headers", "include_trained"]:
-            continue
-        f = file(tfn, "wb")
-        f.write(mboxutils.as_string(msg))
-        f.close()
-        shutil.copystat(cfn, tfn)
-
-        # XXX: This will raise an exception on Windows.  Do any Windows
-        # people actually use Maildirs?
-        os.rename(tfn, cfn)
-        if (removetrained):
-            os.unlink(cfn)
+    names = [os.path.join(path, fn) for fn in os.listdir(path)]
+    names = [cfn for cfn in names if not os.path.isdir(cfn)]
+    # The (temporary file, message file) pairs to move into place.
+    replaced = []
+    try:
+        with training_batch(h):
+            for cfn, prepared in prepared_messages(names, is_spam, force,
+                                                   from_files=True):
+                tfn = os.path.normpath(os.path.join(path, "..", "tmp",
+                                   "%d.%d_%d.%s" % (time.time(), pid,
+                                                    counter, host)))
+                counter += 1
+                if loud and counter % 10 == 0:
+                    sys.stdout.write("\r%6d" % counter)
+                    sys.stdout.flush()
+                if not prepared:
+                    print "Malformed message: %s.  Skipping..." % cfn
+                    continue
+                untrain, tokens, text = prepared
+                if untrain is None:
+                    continue
+                prepared_train(h, untrain, tokens, is_spam)
+                trained += 1
+                if text is None:
+                    continue
+                f = file(tfn, "wb")
+                f.write(text)
+                f.close()
+                shutil.copystat(cfn, tfn)
+                replaced.append((tfn, cfn))
+    except:
+        discard_messages(replaced)
+        raise
+    replace_messages(replaced, removetrained)
 
     if loud:
         sys.stdout.write("\r%6d" % counter)
@@ -167,25 +377,37 @@ def mbox_train(h, path, is_spam, force):
     # writes in order to assert an exclusive lock.
     f = file(path, "r+b")
     fcntl.flock(f, fcntl.LOCK_EX)
-    mbox = mailbox.PortableUnixMailbox(f, get_message)
+    # (The messages are parsed by prepare_message().)
+    if use_mmap:
+        mbox = mboxutils.MmapMailbox(path)
+    else:
+        mbox = mailbox.PortableUnixMailbox(f, lambda fp: fp.read())
 
     outf = os.tmpfile()
     counter = 0
     trained = 0
 
-    for msg in mbox:
-        if not msg:
-            print "Malformed message number %d.  I can't train on this mbox, sorry." % counter
-            return
-        counter += 1
-        if loud and counter % 10 == 0:
-            sys.stdout.write("\r%6d" % counter)
-            sys.stdout.flush()
-        if msg_train(h, msg, is_spam, force):
-            trained += 1
-        if options["Headers", "include_trained"]:
-            # Write it out with the Unix "From " line
-            outf.write(mboxutils.as_string(msg, True))
+    # Every message is written out, with the Unix "From " line.
+    with training_batch(h):
+        for unused, prepared in prepared_messages(mbox, is_spam, force,
+                                                  write_all=True,
+                                                  unixfrom=True):
+            if not prepared:
+                print "Malformed message number %d.  I can't train on this mbox, sorry." % counter
+                return
+            counter += 1
+            if loud and counter % 10 == 0:
+                sys.stdout.write("\r%6d" % counter)
+                sys.stdout.flush()
+            untrain, tokens, text = prepared
+            if untrain is not None:
+                prepared_train(h, untrain, tokens, is_spam)
+                trained += 1
+            if text is not None:
+                outf.write(text)
+    if use_mmap:
+        # (Before the mbox is rewritten.)
+        mbox.close()
 
     if options["Headers", "include_trained"]:
         outf.seek(0)
@@ -223,32 +445,39 @@ def mhdir_train(h, path, is_spam, force):
     counter = 0
     trained = 0
 
-    for fn in glob.glob(os.path.join(path, "[0-9]*")):
-        counter += 1
-
-        cfn = fn
-        tfn = os.path.join(path, "spambayes.tmp")
-        if loud and counter % 10 == 0:
-            sys.stdout.write("\r%6d" % counter)
-            sys.stdout.flush()
-        f = file(fn, "rb")
-        msg = get_message(f)
-        f.close()
-        if not msg:
-            print "Malformed message: %s.  Skipping..." % cfn
-            continue
-        msg_train(h, msg, is_spam, force)
-        trained += 1
-        if not options["Headers", "include_trained"]:
-            continue
-        f = file(tfn, "wb")
-        f.write(mboxutils.as_string(msg))
-        f.close()
-        shutil.copystat(cfn, tfn)
-
-        # XXX: This will raise an exception on Windows.  Do any Windows
-        # people actually use MH directories?
-        os.rename(tfn, cfn)
+    names = glob.glob(os.path.join(path, "[0-9]*"))
+    # The (temporary file, message file) pairs to move into place.
+    replaced = []
+    try:
+        with training_batch(h):
+            for fn, prepared in prepared_messages(names, is_spam, force,
+                                                  from_files=True,
+                                                  write_all=True):
+                counter += 1
+
+                cfn = fn
+                tfn = os.path.join(path, "spambayes.tmp.%d" % (counter,))
+                if loud and counter % 10 == 0:
+                    sys.stdout.write("\r%6d" % counter)
+                    sys.stdout.flush()
+                if not prepared:
+                    print "Malformed message: %s.  Skipping..." % cfn
+                    continue
+                untrain, tokens, text = prepared
+                if untrain is not None:
+                    prepared_train(h, untrain, tokens, is_spam)
+                trained += 1
+                if text is None:
+                    continue
+                f = file(tfn, "wb")
+                f.write(text)
+                f.close()
+                shutil.copystat(cfn, tfn)
+                replaced.append((tfn, cfn))
+    except:
+        discard_messages(replaced)
+        raise
+    replace_messages(replaced)
 
     if loud:
         sys.stdout.write("\r%6d" % counter)
@@ -256,6 +485,7 @@ def mhdir_train(h, path, is_spam, force):
                          (trained, counter))
 
 def train(h, path, is_spam, force, trainnew, removetrained):
+    start = time.time()
     if not os.path.exists(path):
         raise ValueError("Nonexistent path: %s" % path)
     elif os.path.isfile(path):
@@ -270,6 +500,8 @@ def train(h, path, is_spam, force, trainnew, removetrained):
         mhdir_train(h, path, is_spam, force)
     else:
         raise ValueError("Unable to determine mailbox type: " + path)
+    if loud:
+        print "  Took %.2f seconds" % (time.time() - start,)
 
 
 def usage(code, msg=''):
@@ -283,10 +515,10 @@ def usage(code, msg=''):
 def main():
     """Main program; parse options and go."""
 
-    global loud
+    global loud, batch, processes, pool, use_mmap
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hfqnrd:p:g:s:o:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hfqnrBj:md:p:g:s:o:')
     except getopt.error, msg:
         usage(2, msg)
 
@@ -313,6 +545,12 @@ def main():
             spam.append(arg)
         elif opt == "-r":
             removetrained = True
+        elif opt == "-B":
+            batch = False
+        elif opt == "-j":
+            processes = int(arg)
+        elif opt == "-m":
+            use_mmap = True
         elif opt == '-o':
             options.set_from_cmdline(arg, sys.stderr)
     pck, usedb = storage.database_type(opts)
@@ -325,6 +563,12 @@ def main():
         pck = get_pathname_option("Storage",
                                           "persistent_storage_file")
 
+    if processes > 1:
+        # (Started before the database is opened, so that the worker
+        # processes don't have it.)
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+
     h = hammie.open(pck, usedb, "c")
 
     for g in good:
@@ -341,6 +585,10 @@ def main():
         sys.stdout.flush()
         save = True
 
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     if save:
         h.store()
 
@@ -95,6 +95,7 @@ from spambayes import i18n
 from spambayes import Stats
 from spambayes import Dibbler
 from spambayes import storage
+from spambayes import epochs
 from spambayes.FileCorpus import ExpiryFileCorpus
 from spambayes.FileCorpus import FileMessageFactory, GzipFileMessageFactory
 from spambayes.Options import options, get_pathname_option, _
@@ -121,6 +122,10 @@ class AlreadyRunningException(Exception):
 # number to add to STAT length for each msg to fudge for spambayes headers
 HEADER_SIZE_FUDGE_FACTOR = 512
 
+# Stop reading from the POP3 server while this many blocks of data are
+# waiting to be sent on to the email client.
+MAX_PENDING_WRITES = 16
+
 class ServerLineReader(Dibbler.BrighterAsyncChat):
     """An async socket that reads lines from a remote server and
     simply calls a callback with the data.  The BayesProxy object
@@ -128,9 +133,14 @@ class ServerLineReader(Dibbler.BrighterAsyncChat):
     synchronously, because that would block the process."""
 
     def __init__(self, serverName, serverPort, lineCallback, ssl=False,
-                 map=None):
+                 map=None, readyCallback=None, flushCallback=None):
         Dibbler.BrighterAsyncChat.__init__(self, map=map)
         self.lineCallback = lineCallback
+        # If given, readyCallback is called to ask whether more lines are
+        # wanted yet (while it returns False, nothing more is read), and
+        # flushCallback after each batch of lines read from the socket.
+        self.readyCallback = readyCallback
+        self.flushCallback = flushCallback
         self.handled_exception = False
         self.request = ''
         self.set_terminator('\r\n')
@@ -212,6 +222,18 @@ class ServerLineReader(Dibbler.BrighterAsyncChat):
             else:
                 raise
 
+    def readable(self):
+        """Asyncore override."""
+        if self.readyCallback is not None and not self.readyCallback():
+            return False
+        return Dibbler.BrighterAsyncChat.readable(self)
+
+    def handle_read(self):
+        """Asyncore override."""
+        Dibbler.BrighterAsyncChat.handle_read(self)
+        if self.flushCallback is not None:
+            self.flushCallback()
+
     def collect_incoming_data(self, data):
         self.request = self.request + data
 
@@ -236,22 +258,36 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
     POP3ProxyBase class, but BayesProxy doesn't need it and it would
     mean re-stuffing them afterwards).  self.onTransaction() should
     return the response to pass back to the email client - the response
-    can be the verbatim response or a processed version of it.  The
-    special command 'KILL' kills it (passing a 'QUIT' command to the
-    server).
+    can be the verbatim response or a processed version of it.  It can
+    also return None, and pass the response to self.deliverResponse()
+    later; until then, anything else from the client or the server is
+    held back.  The special command 'KILL' kills it (passing a 'QUIT'
+    command to the server).
+
+    Responses to RETR and TOP are normally collected in full before
+    being passed to self.onTransaction(), but if the retrieval timeout
+    passes, or the streaming threshold is reached, once all the headers
+    are in, then the part collected so far is passed on, and the rest
+    proxies straight through as it arrives.
     """
 
     def __init__(self, clientSocket, serverName, serverPort,
                  ssl=False, map=Dibbler._defaultContext._map):
         Dibbler.BrighterAsyncChat.__init__(self, clientSocket)
         self.request = ''
-        self.response = ''
+        self.response = ''          # Set for onTransaction() from...
+        self.responseLines = []     # ...the lines received so far,
+        self.responseSize = 0       # and their total length
         self.set_terminator('\r\n')
         self.command = ''           # The POP3 command being processed...
         self.args = []              # ...and its arguments
         self.isClosing = False      # Has the server closed the socket?
         self.seenAllHeaders = False # For the current RETR or TOP
         self.startTime = 0          # (ditto)
+        self.responsePending = False  # Waiting for deliverResponse()?
+        self.closeAfterResponse = False  # isClosing, when it was called
+        self.heldRequests = []      # Requests held back until then
+        self.passThrough = []       # Lines to echo (see flushServerLines)
 
         if not self.onIncomingConnection(clientSocket):
             # We must refuse this connection, so pass an error back
@@ -261,7 +297,9 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
             return
 
         self.serverSocket = ServerLineReader(serverName, serverPort,
-                                             self.onServerLine, ssl, map)
+                                             self.onServerLine, ssl, map,
+                                             self.isReadyForServer,
+                                             self.flushServerLines)
 
     def onIncomingConnection(self, clientSocket):
         """Checks the security settings."""
@@ -287,10 +325,28 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
         """
         raise NotImplementedError
 
+    def isReadyForServer(self):
+        """Returns False if reading from the POP3 server should wait: while
+        a response is pending, or the email client is behind in reading
+        what has been sent to it.  This keeps the memory used for a large
+        message that is being proxied straight through bounded."""
+        return not self.responsePending and \
+               len(self.producer_fifo) < MAX_PENDING_WRITES
+
     def onServerLine(self, line):
         """A line of response has been received from the POP3 server."""
-        isFirstLine = not self.response
-        self.response = self.response + line
+        # If we're not processing a command, just echo the response.
+        # (If the server has closed its end of the socket, that's dealt
+        # with below, like the end of a response.)
+        if not self.command and line:
+            self.passThrough.append(line)
+            return
+
+        isFirstLine = not self.responseLines
+        # (The lines are only joined once the response is complete;
+        # adding each one to a string would copy the response each time.)
+        self.responseLines.append(line)
+        self.responseSize += len(line)
 
         # Is this the line that terminates a set of headers?
         self.seenAllHeaders = self.seenAllHeaders or line in ['\r\n', '\n']
@@ -299,25 +355,32 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
         if not line:
             self.isClosing = True
 
-        # If we're not processing a command, just echo the response.
-        if not self.command:
-            self.push(self.response)
-            self.response = ''
-
         # Time out after some seconds (30 by default) for message-retrieval
         # commands if all the headers are down.  The rest of the message
-        # will proxy straight through.
+        # will proxy straight through.  The same happens once the message
+        # has reached the streaming threshold, so that large messages
+        # aren't held in memory.
         # See also [ 870524 ] Make the message-proxy timeout configurable
         if self.command in ['TOP', 'RETR'] and \
-           self.seenAllHeaders and time.time() > \
-           self.startTime + options["pop3proxy", "retrieval_timeout"]:
+           self.seenAllHeaders and (time.time() > \
+           self.startTime + options["pop3proxy", "retrieval_timeout"] or
+           0 < options["pop3proxy", "streaming_threshold"] <= \
+           self.responseSize):
             self.onResponse()
-            self.response = ''
         # If that's a complete response, handle it.
         elif not self.isMultiline() or line == '.\r\n' or \
            (isFirstLine and line.startswith('-ERR')):
             self.onResponse()
-            self.response = ''
+
+    def flushServerLines(self):
+        """Echoes the lines from the server that aren't part of a response
+        to a command, such as the rest of a message that is proxying
+        straight through.  They are pushed in one go for each batch read
+        from the server (rather than line by line), and not until the
+        client has the response it is waiting for."""
+        if self.passThrough and not self.responsePending:
+            self.push(''.join(self.passThrough))
+            self.passThrough = []
 
     def isMultiline(self):
         """Returns True if the request should get a multiline
@@ -353,6 +416,13 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
             # For testing
             raise ZeroDivisionError
 
+        if self.responsePending:
+            # The client hasn't had the response to its last command yet;
+            # deliverResponse() will send this on once it has.
+            self.heldRequests.append(self.request)
+            self.request = ''
+            return
+
         self.serverSocket.push(self.request + '\r\n')
         if self.request.strip() == '':
             # Someone just hit the Enter key.
@@ -368,6 +438,12 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
         self.request = ''
 
     def onResponse(self):
+        # Anything echoed came before this response.
+        self.flushServerLines()
+        self.response = ''.join(self.responseLines)
+        self.responseLines = []
+        self.responseSize = 0
+
         # There are some features, tested by clients using CAPA,
         # that we don't support.  We strip them from the CAPA
         # response here, so that the client won't use them.
@@ -377,21 +453,50 @@ class POP3ProxyBase(Dibbler.BrighterAsyncChat):
 
         # Pass the request and the raw response to the subclass and
         # send back the cooked response.
+        isClosing = self.isClosing
         if self.response:
             cooked = self.onTransaction(self.command, self.args, self.response)
-            self.push(cooked)
+            if cooked is None:
+                # The subclass will call deliverResponse() when it's ready.
+                self.responsePending = True
+                self.closeAfterResponse = isClosing
+                isClosing = False
+            else:
+                self.push(cooked)
 
         # If onServerLine() decided that the server has closed its
         # socket, close this one when the response has been sent.
-        if self.isClosing:
+        if isClosing:
             self.close_when_done()
 
         # Reset.
         self.command = ''
         self.args = []
+        self.response = ''
         self.isClosing = False
         self.seenAllHeaders = False
 
+    def deliverResponse(self, cooked):
+        """Sends the response that self.onTransaction() returned None
+        for, and then carries on with anything that was held back."""
+        self.responsePending = False
+        if not self.connected:
+            # The email client has gone away in the meantime.
+            return
+        self.push(cooked)
+        self.flushServerLines()
+        if self.closeAfterResponse:
+            self.close_when_done()
+            return
+
+        # Replay the requests, keeping any partial one that's arrived.
+        requests, self.heldRequests = self.heldRequests, []
+        partial = self.request
+        for request in requests:
+            self.request = request
+            self.found_terminator()
+        self.request = partial
+
 
 class BayesProxyListener(Dibbler.Listener):
     """Listens for incoming email client connections and spins off
@@ -535,25 +640,56 @@ class BayesProxy(POP3ProxyBase):
         # Remove the trailing .\r\n before passing to the email parser.
         # Thanks to Scott Schlesier for this fix.
         terminatingDotPresent = (response[-4:] == '\n.\r\n')
+        end = len(response)
         if terminatingDotPresent:
-            response = response[:-3]
+            end -= 3
 
-        # Break off the first line, which will be '+OK'.
-        statusLine, messageText = response.split('\n', 1)
+        # Break off the first line, which will be '+OK'.  (Slicing the
+        # message out in one go, because it might be large.)
+        newline = response.index('\n')
+        statusLine = response[:newline]
         statusData = statusLine.split()
         ok = statusData[0]
         if ok.strip().upper() != "+OK":
             # Must be an error response.  Return unproxied.
-            return response
+            return response[:end]
+        messageText = response[newline+1:end]
 
+        details = (command, args, ok, messageText, terminatingDotPresent)
+        if state.workers is None:
+            try:
+                result, error = self.classify(messageText), None
+            except:
+                result, error = None, sys.exc_info()
+            return self.finishRetr(details, result, error)
+
+        # Tokenizing and scoring can take a while, so do it in a worker
+        # thread, and send the response once it's done.
+        def onClassified(result, error):
+            self.deliverResponse(self.finishRetr(details, result, error))
+        state.workers.submit(onClassified, self.classify, messageText)
+        return None
+
+    def classify(self, messageText):
+        """Parses and scores the message, returning a tuple of the
+        SBHeaderMessage, its score and the clues.  This can be called from
+        a worker thread, so touches nothing but the classifier."""
+        msg = email.message_from_string(messageText,
+                  _class=spambayes.message.SBHeaderMessage)
+        (prob, clues) = state.bayes.spamprob(msg.tokenize(), evidence=True)
+        return msg, prob, clues
+
+    def finishRetr(self, details, result, error):
+        """Adds the judgement header given the result of self.classify()
+        (or the sys.exc_info() of the error it raised), and returns the
+        response for the email client."""
+        command, args, ok, messageText, terminatingDotPresent = details
         try:
-            msg = email.message_from_string(messageText,
-                      _class=spambayes.message.SBHeaderMessage)
+            if error is not None:
+                raise error[0], error[1], error[2]
+            msg, prob, clues = result
             msg.setId(state.getNewMessageName())
-            # Now find the spam disposition and add the header.
-            (prob, clues) = state.bayes.spamprob(msg.tokenize(),
-                                                 evidence=True)
-
+            # Now add the spam disposition header.
             msg.addSBHeaders(prob, clues)
 
             # Check for "RETR" or "TOP N 99999999" - fetchmail without
@@ -594,18 +730,22 @@ class BayesProxy(POP3ProxyBase):
             # appending a closing boundary separator.  Remember we can
             # be dealing with partial message here because of the timeout
             # code in onServerLine.
-            headers = []
-            for name, value in msg.items():
-                header = "%s: %s" % (name, value)
-                headers.append(re.sub(r'\r?\n', '\r\n', header))
-            try:
-                body = re.split(r'\n\r?\n', messageText, 1)[1]
-            except IndexError:
+            headers = ["%s: %s" % (name, value)
+                       for name, value in msg.items()]
+            headers = re.sub(r'\r?\n', '\r\n', "\r\n".join(headers))
+            separator = re.search(r'\n\r?\n', messageText)
+            if separator:
+                body = messageText[separator.end():]
+            else:
                 # No separator, so no body.  Bad message, but proxy it
                 # through anyway (adding the missing separator).
-                messageText = "\r\n".join(headers) + "\r\n\r\n"
-            else:
-                messageText = "\r\n".join(headers) + "\r\n\r\n" + body
+                body = ""
+
+            # Put the response together in one go, so that the body is
+            # only copied once more, and restore the POP3 .\r\n
+            # terminator if there was one.
+            return "".join([ok, "\n", headers, "\r\n\r\n", body,
+                            terminatingDotPresent and ".\r\n" or ""])
         except:
             # Something nasty happened while parsing or classifying -
             # report the exception in a hand-appended header and recover.
@@ -696,6 +836,7 @@ class State:
         __main__ code below."""
         self.logFile = None
         self.bayes = None
+        self.workers = None
         self.platform_mutex = None
         self.prepared = False
         self.can_stop = True
@@ -771,6 +912,12 @@ class State:
     def close(self):
         assert self.prepared, "closed without being prepared!"
         self.servers = None
+        if self.workers is not None:
+            # Let the messages being scored finish with the classifier
+            # before it is stored and closed.
+            self.workers.close()
+            self.workers.join()
+            self.workers = None
         if self.bayes is not None:
             # Only store a non-empty db.
             if self.bayes.nham != 0 and self.bayes.nspam != 0:
@@ -865,6 +1012,13 @@ class State:
         if not hasattr(self, "DBName"):
             self.DBName, self.useDB = storage.database_type([])
         self.bayes = storage.open_storage(self.DBName, self.useDB)
+        threads = options["pop3proxy", "classification_threads"]
+        if threads > 0:
+            # Messages are scored in the worker threads while this one
+            # trains (from the web interface), so the classifier needs to
+            # be shared safely.
+            self.bayes = epochs.EpochClassifier(self.bayes)
+            self.workers = Dibbler.WorkerPool(threads)
         self.mdb = spambayes.message.Message().message_info_db
 
         # Load stats manager.
@@ -996,7 +1150,8 @@ def main(servers, proxyPorts, uiPort, launchUI):
     httpServer = UserInterfaceServer(uiPort)
     proxyUI = ProxyUserInterface(state, _recreateState)
     httpServer.register(proxyUI)
-    Dibbler.run(launchBrowser=launchUI)
+    Dibbler.run(launchBrowser=launchUI,
+                poller=options["globals", "event_loop"])
 
 def prepare(can_stop=True):
     state.init()
@@ -149,7 +149,39 @@ you want Dibbler to use its own map: `context = Dibbler.Context({})`.
 
 You can either call `Dibbler.run(context)` to run the async loop, or call
 `asyncore.loop()` directly - the only difference is that the former has a
-few more options, like launching the web browser automatically.
+few more options, like launching the web browser automatically, and
+choosing how to wait for network activity:
+
+>>> Dibbler.run(poller="epoll")
+
+asyncore uses `select()`, which gets slower as the number of sockets
+grows, and on most platforms can't handle sockets numbered above 1023 at
+all.  "poll" uses `poll()` instead (asyncore's `use_poll`), which doesn't
+have the limit, and "epoll" uses Linux's epoll, which also only does work
+for the sockets that are active.  All three run exactly the same
+dispatchers, so nothing else changes.  If the one you ask for isn't
+available on your platform, the next best one is used.  `Dibbler.loop()`
+runs any asyncore socket map in the same way.
+
+
+*Dibbler and threads*
+
+Anything slow that a handler does holds up every other connection, because
+they all share the one async loop.  A `WorkerPool` runs functions in
+other threads and then calls you back, in the async loop, with the result:
+
+>>> pool = Dibbler.WorkerPool(4)
+>>> pool.submit(self.onResult, slowFunction, arg1, arg2)
+
+`self.onResult(result, error)` is called once `slowFunction(arg1, arg2)`
+has returned; `error` is None, or the `sys.exc_info()` of the exception it
+raised (in which case `result` is None).  `pool.close()` stops the
+threads once they have run the jobs already submitted, and `pool.join()`
+then waits for them to do so.  The callback is the only safe
+place to touch the handler, or anything else the async loop uses - the
+worker threads should only read their arguments.  Underneath, a `Trigger`
+(which you can also use directly) wakes the async loop up whenever another
+thread wants something run in it.
 
 
 *Self-test*
@@ -169,9 +201,10 @@ try:
 except ImportError:
     import StringIO
 
-import sys, re, time, traceback, base64
-import socket, cgi, urlparse, webbrowser
+import sys, re, time, traceback, base64, errno
+import socket, select, cgi, urlparse, webbrowser
 import asyncore, asynchat
+import threading, Queue
 from hashlib import md5
 
 class Context:
@@ -249,6 +282,142 @@ class Listener(asyncore.dispatcher):
             self.factory(*args)
 
 
+class Trigger(asyncore.dispatcher):
+    """Lets other threads run code in the async loop.  `pull(callback,
+    *args)` can be called from any thread, and `callback(*args)` is then
+    called by the async loop."""
+
+    def __init__(self, socketMap=_defaultContext._map):
+        # The loop only wakes up for sockets, so other threads wake it by
+        # writing a byte to a socket connected to this one.  (A pipe
+        # would do on Unix, but select() only takes sockets on Windows.)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self._writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._writer.connect(listener.getsockname())
+            reader, address = listener.accept()
+        finally:
+            listener.close()
+        reader.setblocking(False)
+        asyncore.dispatcher.__init__(self, reader, map=socketMap)
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def pull(self, callback, *args):
+        """Call `callback(*args)` in the async loop, as soon as it gets to
+        it.  Callbacks are called in the order they were pulled."""
+        self._lock.acquire()
+        try:
+            wake = not self._callbacks
+            self._callbacks.append((callback, args))
+        finally:
+            self._lock.release()
+        # Only the first callback needs to wake the loop; the rest are
+        # picked up along with it.
+        if wake:
+            try:
+                self._writer.send('x')
+            except socket.error:
+                # The trigger has been closed, so nothing will be called.
+                pass
+
+    def readable(self):
+        """Asyncore override."""
+        return True
+
+    def writable(self):
+        """Asyncore override."""
+        return False
+
+    def handle_read(self):
+        """Asyncore override."""
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+        self._lock.acquire()
+        try:
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback, args in callbacks:
+            # An exception would otherwise close the trigger (asyncore's
+            # handle_error does that), and no other callbacks would ever
+            # be called.
+            try:
+                callback(*args)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                traceback.print_exc()
+
+    def handle_close(self):
+        """Asyncore override."""
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class WorkerPool:
+    """Runs functions in a pool of threads, and calls back with their
+    results in the async loop.  See the main documentation for details."""
+
+    def __init__(self, numThreads, context=_defaultContext):
+        self._trigger = Trigger(context._map)
+        self._queue = Queue.Queue()
+        self._running = numThreads
+        self._threads = []
+        for i in range(numThreads):
+            thread = threading.Thread(target=self._work)
+            # Don't let a slow job stop the application from exiting.
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, callback, func, *args):
+        """Call `func(*args)` in a worker thread, and then
+        `callback(result, error)` in the async loop."""
+        self._queue.put((func, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._trigger.pull(self._onThreadFinished)
+                break
+            func, args, callback = job
+            try:
+                result, error = func(*args), None
+            except:
+                result, error = None, sys.exc_info()
+            self._trigger.pull(callback, result, error)
+
+    def _onThreadFinished(self):
+        # The jobs are taken in order, so once every thread has finished,
+        # every callback has been called.
+        self._running -= 1
+        if self._running == 0:
+            self._trigger.close()
+
+    def close(self):
+        """Stop the threads once they have finished the jobs already
+        submitted (whose callbacks are still called).  Nothing more can be
+        submitted."""
+        for i in range(self._running):
+            self._queue.put(None)
+
+    def join(self):
+        """Wait, after `close()`, until the threads have finished every
+        job.  (Their callbacks are only called once the async loop runs
+        again.)"""
+        for thread in self._threads:
+            thread.join()
+
+
 class HTTPServer(Listener):
     """A web server with which you can register `HTTPPlugin`s to serve up
     your content - see `HTTPPlugin` for detailed documentation and examples.
@@ -658,10 +827,84 @@ class HTTPPlugin:
         return self._handler.close()
 
 
-def run(launchBrowser=False, context=_defaultContext):
+def _epollLoop(map, timeout):
+    """Like `asyncore.loop()`, but waits using epoll.  The sockets stay
+    registered with epoll between iterations, and are only re-registered
+    when what they are waiting for (readable() and writable()) changes."""
+    epoll = select.epoll()
+    registered = {}     # fd -> (dispatcher, flags) as epoll knows them
+    readFlags = select.EPOLLIN | select.EPOLLPRI
+    writeFlags = select.EPOLLOUT
+    try:
+        while map:
+            current = 0
+            for fd, obj in map.items():
+                flags = 0
+                if obj.readable():
+                    flags = readFlags
+                # Accepting sockets should not be writable (as asyncore).
+                if obj.writable() and not obj.accepting:
+                    flags |= writeFlags
+                old = registered.get(fd)
+                if old is not None and old[0] is obj:
+                    if old[1] == flags:
+                        current += 1
+                    elif flags:
+                        epoll.modify(fd, flags)
+                        registered[fd] = (obj, flags)
+                        current += 1
+                    else:
+                        epoll.unregister(fd)
+                        del registered[fd]
+                elif flags:
+                    epoll.register(fd, flags)
+                    registered[fd] = (obj, flags)
+                    current += 1
+            if len(registered) > current:
+                # Some sockets have been closed (which takes them out of
+                # the epoll set), and their numbers may have been reused.
+                for fd, (obj, flags) in registered.items():
+                    if map.get(fd) is not obj:
+                        try:
+                            epoll.unregister(fd)
+                        except (IOError, OSError):
+                            pass
+                        del registered[fd]
+            try:
+                events = epoll.poll(timeout)
+            except IOError, e:
+                if e.errno != errno.EINTR:
+                    raise
+                continue
+            for fd, flags in events:
+                obj = map.get(fd)
+                if obj is not None:
+                    # The EPOLL* flags have the same values as the POLL*
+                    # ones that readwrite() understands.
+                    asyncore.readwrite(obj, flags)
+    finally:
+        epoll.close()
+
+
+def loop(map=asyncore.socket_map, poller="select", timeout=30.0):
+    """Runs the async loop for the given socket map until it is empty, or
+    a `SystemExit` exception is raised.  `poller` is one of "select",
+    "poll" or "epoll" - see the main documentation for details."""
+    if poller == "epoll" and not hasattr(select, "epoll"):
+        poller = "poll"
+    if poller == "poll" and not hasattr(select, "poll"):
+        poller = "select"
+    if poller == "epoll":
+        _epollLoop(map, timeout)
+    else:
+        asyncore.loop(timeout, poller == "poll", map)
+
+
+def run(launchBrowser=False, context=_defaultContext, poller="select"):
     """Runs a `Dibbler` application.  Servers listen for incoming connections
     and route requests through to plugins until a plugin calls `sys.exit()`
-    or raises a `SystemExit` exception."""
+    or raises a `SystemExit` exception.  `poller` says how to wait for
+    network activity - see `loop()`."""
 
     if launchBrowser:
         try:
@@ -669,7 +912,7 @@ def run(launchBrowser=False, context=_defaultContext):
             webbrowser.open_new(url)
         except webbrowser.Error, e:
             print "\n%s.\nPlease point your web browser at %s." % (e, url)
-    asyncore.loop(map=context._map)
+    loop(context._map, poller)
 
 
 def runTestServer(readyEvent=None):
@@ -1,14 +1,27 @@
 """
 This is the place where we try and discover information buried in images.
+
+The OCR program is run on images in separate processes, up to
+ocr_processes of them at once (however many threads are scoring
+messages), and is killed if it takes longer than ocr_timeout seconds.
+What it finds is cached, by the MD5 digest of the image, in a dbm
+database named by the crack_image_cache option; images that haven't been
+seen for crack_image_cache_days days, and the least recently seen beyond
+crack_image_cache_size, are dropped from it from time to time.
 """
 
 from __future__ import division
 
 import sys
 import os
+import time
+import whichdb
 import tempfile
 import math
 import atexit
+import threading
+import subprocess
+import cPickle as pickle
 try:
     import cStringIO as StringIO
 except ImportError:
@@ -19,7 +32,9 @@ try:
 except ImportError:
     Image = None
 
-from spambayes.safepickle import pickle_read, pickle_write
+from spambayes import dbmstorage
+from spambayes.lrucache import CacheStats
+from spambayes.safepickle import pickle_read
 from hashlib import md5
 
 # The email mime object carrying the image data can have a special attribute
@@ -229,35 +244,41 @@ class OCRExecutableEngine(OCREngine):
     
     program = property(get_program)
 
-    def get_command_line(self, pnmfile):
+    def get_args(self, pnmfile):
         raise NotImplementedError, "base classes must override"
 
+    def start(self, pnmfile, output):
+        """Start the program on pnmfile, writing its output to the file
+           output, and return the subprocess.Popen object.
+        """
+        assert self.is_enabled(), "I'm not working!"
+        devnull = open(os.devnull, "wb")
+        try:
+            return subprocess.Popen(self.get_args(pnmfile), stdout=output,
+                                    stderr=devnull)
+        finally:
+            devnull.close()
+
     def extract_text(self, pnmfile):
         # Generically reads output from stdout.
-        assert self.is_enabled(), "I'm not working!"
-        cmdline = self.get_command_line(pnmfile)
-        ocr = os.popen(cmdline)
-        ret = ocr.read()
-        exit_code = ocr.close()
-        if exit_code:
-            raise SystemError, ("%s failed with exit code %s" %
-                                (self.engine_name, exit_code))
-        return ret
+        text, error, timed_out, seconds = OCRPool(1).run(self, [pnmfile])[0]
+        if error:
+            raise SystemError, error
+        return text
 
 class OCREngineOCRAD(OCRExecutableEngine):
     engine_name = "ocrad"
 
-    def get_command_line(self, pnmfile):
+    def get_args(self, pnmfile):
         scale = options["Tokenizer", "ocrad_scale"] or 1
         charset = options["Tokenizer", "ocrad_charset"]
-        return '%s -s %s -c %s -f "%s" 2>%s' % \
-                (self.program, scale, charset, pnmfile, os.path.devnull)
+        return [self.program, "-s", str(scale), "-c", charset, "-f", pnmfile]
 
 class OCREngineGOCR(OCRExecutableEngine):
     engine_name = "gocr"
 
-    def get_command_line(self, pnmfile):
-        return '%s "%s" 2>%s' % (self.program, pnmfile, os.path.devnull)
+    def get_args(self, pnmfile):
+        return [self.program, pnmfile]
 
 # This lists all engines, with the first listed that is enabled winning.
 # Matched with the engine name, as specified in Options.py, via the
@@ -283,60 +304,294 @@ def get_engine(engine_name):
             return engine
     return None
 
+class OCRPool(object):
+    """Runs an OCR engine's program on images, with at most 'size' of
+       them running at once (however many threads use the pool), each for
+       at most 'timeout' seconds (if that isn't zero).
+    """
+    # How often to check whether the programs have finished, in seconds.
+    poll_interval = 0.01
+
+    def __init__(self, size, timeout=0):
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.Semaphore(size)
+
+    def run(self, engine, pnmfiles):
+        """Return a list of (text, error, timed_out, seconds) for each of
+           pnmfiles, where error is a message saying why there is no text,
+           or None.
+        """
+        results = {}
+        pending = list(pnmfiles)
+        running = []
+        try:
+            while pending or running:
+                # Wait for a free slot only if there's nothing else to
+                # wait for, so that threads can't hold slots waiting for
+                # each other.
+                while pending and self._slots.acquire(not running):
+                    pnmfile = pending.pop(0)
+                    output = tempfile.TemporaryFile()
+                    try:
+                        process = engine.start(pnmfile, output)
+                    except EnvironmentError, e:
+                        output.close()
+                        self._slots.release()
+                        results[pnmfile] = ("", "%s failed: %s" %
+                                            (engine.engine_name, e),
+                                            False, 0.0)
+                        continue
+                    running.append((pnmfile, process, output, time.time()))
+                for item in running[:]:
+                    pnmfile, process, output, started = item
+                    seconds = time.time() - started
+                    timed_out = False
+                    if process.poll() is None:
+                        if not self.timeout or seconds < self.timeout:
+                            continue
+                        process.kill()
+                        process.wait()
+                        timed_out = True
+                        error = "%s timed out after %.1f seconds" % \
+                                (engine.engine_name, seconds)
+                    elif process.returncode:
+                        error = "%s failed with exit code %s" % \
+                                (engine.engine_name, process.returncode)
+                    else:
+                        error = None
+                    text = ""
+                    if error is None:
+                        output.seek(0)
+                        text = output.read()
+                    output.close()
+                    running.remove(item)
+                    self._slots.release()
+                    results[pnmfile] = (text, error, timed_out, seconds)
+                if running:
+                    time.sleep(self.poll_interval)
+        finally:
+            # Only if something went wrong.
+            for pnmfile, process, output, started in running:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                output.close()
+                self._slots.release()
+        return [results[pnmfile] for pnmfile in pnmfiles]
+
+class OCRStats(CacheStats):
+    """How well the OCR cache works, and how long the OCR program takes."""
+    __slots__ = 'runs', 'seconds', 'slowest', 'failures', 'timeouts'
+
+    def __init__(self):
+        CacheStats.__init__(self)
+        self.runs = self.failures = self.timeouts = 0
+        self.seconds = self.slowest = 0.0
+
+    def __repr__(self):
+        return "%s(hits=%d, misses=%d, evictions=%d, runs=%d, " \
+               "mean=%.3fs, slowest=%.3fs, failures=%d, timeouts=%d)" % \
+               (self.__class__.__name__, self.hits, self.misses,
+                self.evictions, self.runs, self.mean_seconds(),
+                self.slowest, self.failures, self.timeouts)
+
+    def add_run(self, seconds, error, timed_out):
+        self.runs += 1
+        self.seconds += seconds
+        self.slowest = max(self.slowest, seconds)
+        if timed_out:
+            self.timeouts += 1
+        elif error:
+            self.failures += 1
+
+    def mean_seconds(self):
+        if self.runs:
+            return self.seconds / self.runs
+        return 0.0
+
 class ImageStripper:
     def __init__(self, cachefile=""):
         self.cachefile = os.path.expanduser(cachefile)
-        if os.path.exists(self.cachefile):
-            self.cache = pickle_read(self.cachefile)
-        else:
-            self.cache = {}
-        self.misses = self.hits = 0
-        if self.cachefile:
-            atexit.register(self.close)
+        # Maps the MD5 digest of each image to a pickled (time last used,
+        # text, tokens); a dbm database if there is a cache file, opened
+        # when it is first needed.
+        self.cache = None
+        # Only the process that made this ImageStripper writes to the cache
+        # file, so that worker processes it forks (for sb_mboxtrain -j or
+        # timcv -j, say) never have the dbm open for writing at the same
+        # time.  They open it read-only, and keep what they add in memory.
+        self._owner_pid = os.getpid()
+        self._cache_pid = None
+        self.read_only = False
+        self.added_here = {}
+        # The number of entries added since the last eviction.
+        self.added = 0
+        self.stats = OCRStats()
+        self.pool = None
         self.engine = None
-    
+        self._lock = threading.Lock()
+
+    def _open_cache(self):
+        # (A cache inherited from the parent process is left alone, not
+        # closed, since closing might write to it.)
+        self._cache_pid = os.getpid()
+        self.added_here = {}
+        if not self.cachefile:
+            self.cache = {}
+            return
+        if self._cache_pid != self._owner_pid:
+            self.read_only = True
+            try:
+                self.cache = dbmstorage.open(self.cachefile, "r")
+            except Exception:
+                # There's no cache yet (each dbm module raises its own
+                # error for that).
+                self.cache = {}
+            return
+        old = None
+        if os.path.isfile(self.cachefile) and \
+           not whichdb.whichdb(self.cachefile):
+            # A cache written by an older version, which kept it as a
+            # pickled dictionary.
+            try:
+                old = pickle_read(self.cachefile)
+            except Exception:
+                old = {}
+            os.remove(self.cachefile)
+        self.cache = dbmstorage.open(self.cachefile, "c")
+        if old:
+            now = time.time()
+            for fhash, (ctext, ctokens) in old.iteritems():
+                self.cache[fhash] = pickle.dumps((now, ctext, ctokens), 2)
+            self.evict()
+        atexit.register(self.close)
+
+    def evict(self):
+        """Drop the images that haven't been seen for more than
+           crack_image_cache_days days, and then the least recently seen
+           until there are no more than crack_image_cache_size.  Zero means
+           no limit."""
+        max_age = options["Tokenizer", "crack_image_cache_days"] * 86400
+        max_size = options["Tokenizer", "crack_image_cache_size"]
+        now = time.time()
+        used = []
+        for fhash in self.cache.keys():
+            last_used = pickle.loads(self.cache[fhash])[0]
+            if max_age and now - last_used > max_age:
+                del self.cache[fhash]
+                self.stats.evictions += 1
+            else:
+                used.append((last_used, fhash))
+        if max_size and len(used) > max_size:
+            used.sort()
+            for last_used, fhash in used[:len(used) - max_size]:
+                del self.cache[fhash]
+                self.stats.evictions += 1
+        self.added = 0
+
+    def _cache_get(self, fhash):
+        self._lock.acquire()
+        try:
+            if self.cache is None or self._cache_pid != os.getpid():
+                self._open_cache()
+            if fhash in self.added_here:
+                self.stats.hits += 1
+                return self.added_here[fhash]
+            if not self.cache.has_key(fhash):
+                self.stats.misses += 1
+                return None
+            self.stats.hits += 1
+            last_used, ctext, ctokens = pickle.loads(self.cache[fhash])
+            if not self.read_only:
+                self.cache[fhash] = pickle.dumps((time.time(), ctext,
+                                                  ctokens), 2)
+            return ctext, ctokens
+        finally:
+            self._lock.release()
+
+    def _cache_set(self, fhash, ctext, ctokens):
+        self._lock.acquire()
+        try:
+            if self.read_only:
+                self.added_here[fhash] = ctext, ctokens
+                return
+            self.cache[fhash] = pickle.dumps((time.time(), ctext, ctokens), 2)
+            self.added += 1
+            # Only new entries can take the cache over its size, so only
+            # look for entries to evict once it could have grown by a
+            # tenth (which saves reading the whole cache otherwise).
+            max_size = options["Tokenizer", "crack_image_cache_size"]
+            if self.added >= max(max_size // 10, 100):
+                self.evict()
+        finally:
+            self._lock.release()
+
+    def _get_pool(self):
+        size = max(options["Tokenizer", "ocr_processes"], 1)
+        timeout = options["Tokenizer", "ocr_timeout"]
+        pool = self.pool
+        if pool is None or pool.size != size or pool.timeout != timeout:
+            pool = self.pool = OCRPool(size, timeout)
+        return pool
+
     def extract_ocr_info(self, pnmfiles):
         assert self.engine, "must have an engine!"
-        textbits = []
-        tokens = set()
+        found = {}
+        misses = []
         for pnmfile in pnmfiles:
-            preserve = False
             fhash = md5(open(pnmfile).read()).hexdigest()
-            if fhash in self.cache:
-                self.hits += 1
-                ctext, ctokens = self.cache[fhash]
+            cached = self._cache_get(fhash)
+            if cached is None:
+                misses.append((pnmfile, fhash))
             else:
-                self.misses += 1
-                if self.engine.program:
-                    try:
-                        ctext = self.engine.extract_text(pnmfile).lower()
-                    except SystemError, msg:
-                        print >> sys.stderr, msg
-                        preserve = True
-                        ctext = ""
-                else:
-                    # We should not get here if no OCR is enabled.  If it
-                    # is enabled and we have no program, its OK to spew lots
-                    # of warnings - they should either disable OCR (it is by
-                    # default), or fix their config.
-                    print >> sys.stderr, \
-                          "No OCR program '%s' available - can't get text!" \
-                          % (self.engine.engine_name,)
-                    ctext = ""
-                ctokens = set()
-                if not ctext.strip():
-                    # Lots of spam now contains images in which it is
-                    # difficult or impossible (using ocrad) to find any
-                    # text.  Make a note of that.
-                    ctokens.add("image-text:no text found")
-                else:
-                    nlines = len(ctext.strip().split("\n"))
-                    if nlines:
-                        ctokens.add("image-text-lines:%d" % int(log2(nlines)))
-                self.cache[fhash] = (ctext, ctokens)
+                found[pnmfile] = cached
+
+        preserve = set()
+        if not misses:
+            results = []
+        elif self.engine.program:
+            results = self._get_pool().run(self.engine,
+                                           [pnmfile for pnmfile, _ in misses])
+        else:
+            # We should not get here if no OCR is enabled.  If it
+            # is enabled and we have no program, its OK to spew lots
+            # of warnings - they should either disable OCR (it is by
+            # default), or fix their config.
+            print >> sys.stderr, \
+                  "No OCR program '%s' available - can't get text!" \
+                  % (self.engine.engine_name,)
+            results = [("", None, False, None)] * len(misses)
+        for (pnmfile, fhash), (ctext, error, timed_out, seconds) in \
+                zip(misses, results):
+            if seconds is not None:
+                self.stats.add_run(seconds, error, timed_out)
+            if error:
+                print >> sys.stderr, error
+                preserve.add(pnmfile)
+            ctext = ctext.lower()
+            ctokens = set()
+            if not ctext.strip():
+                # Lots of spam now contains images in which it is
+                # difficult or impossible (using ocrad) to find any
+                # text.  Make a note of that.
+                ctokens.add("image-text:no text found")
+            else:
+                nlines = len(ctext.strip().split("\n"))
+                if nlines:
+                    ctokens.add("image-text-lines:%d" % int(log2(nlines)))
+            # The program might manage next time, with less to do at once.
+            if not timed_out:
+                self._cache_set(fhash, ctext, ctokens)
+            found[pnmfile] = ctext, ctokens
+
+        textbits = []
+        tokens = set()
+        for pnmfile in pnmfiles:
+            ctext, ctokens = found[pnmfile]
             textbits.append(ctext)
             tokens |= ctokens
-            if not preserve:
+            if pnmfile not in preserve:
                 os.unlink(pnmfile)
 
         return "\n".join(textbits), tokens
@@ -370,14 +625,23 @@ class ImageStripper:
 
 
     def close(self):
-        if options["globals", "verbose"]:
-            print >> sys.stderr, "saving", len(self.cache),
-            print >> sys.stderr, "items to", self.cachefile,
-            if self.hits + self.misses:
-                print >> sys.stderr, "%.2f%% hit rate" % \
-                      (100 * self.hits / (self.hits + self.misses)),
-            print >> sys.stderr
-        pickle_write(self.cachefile, self.cache)
+        self._lock.acquire()
+        try:
+            if self.cache is None or self._cache_pid != os.getpid():
+                return
+            if options["globals", "verbose"] and not self.read_only:
+                print >> sys.stderr, "saving", len(self.cache),
+                print >> sys.stderr, "items to", self.cachefile,
+                if self.stats.hits + self.stats.misses:
+                    print >> sys.stderr, "%.2f%% hit rate" % \
+                          (100 * self.stats.hit_rate()),
+                print >> sys.stderr
+                print >> sys.stderr, self.stats
+            if hasattr(self.cache, "close"):
+                self.cache.close()
+            self.cache = None
+        finally:
+            self._lock.release()
 
 _cachefile = options["Tokenizer", "crack_image_cache"]
 crack_images = ImageStripper(_cachefile).analyze
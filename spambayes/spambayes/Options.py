@@ -136,10 +136,33 @@ defaults = {
      HEADER_VALUE, RESTORE),
 
     ("crack_image_cache", _("Cache to speed up ocr."), "",
-     _("""If non-empty, names a file from which to read cached ocr info
-     at start and to which to save that info at exit."""),
+     _("""If non-empty, names a dbm database in which to keep what ocr
+     finds in each image, so that it needn't be run on the same image
+     again.  (A cache written by an older version of SpamBayes is
+     converted.)"""),
      PATH, RESTORE),
 
+    ("crack_image_cache_size", _("Maximum number of images to cache"),
+     10000,
+     _("""The least recently seen images are dropped from the ocr cache
+     when it holds more than this many.  Zero means no limit."""),
+     INTEGER, RESTORE),
+
+    ("crack_image_cache_days", _("Days to keep images in the cache"), 30,
+     _("""Images that haven't been seen for this many days are dropped
+     from the ocr cache.  Zero means that they are kept for ever."""),
+     INTEGER, RESTORE),
+
+    ("ocr_processes", _("Number of ocr programs to run at once"), 2,
+     _("""The largest number of images that ocr is run on at the same time
+     (when several messages are being scored at once, for example)."""),
+     INTEGER, RESTORE),
+
+    ("ocr_timeout", _("Seconds to let ocr run"), 30.0,
+     _("""If ocr takes longer than this on an image, it is stopped, and no
+     text is found in the image.  Zero means no limit."""),
+     REAL, RESTORE),
+
     ("ocrad_scale", _("Scale factor to use with ocrad."), 2,
      _("""Specifies the scale factor to apply when running ocrad.  While
      you can specify a negative scale it probably won't help.  Scaling up
@@ -264,6 +287,22 @@ defaults = {
      the ability to reduce the nine tokens to one. (This option has no
      effect if 'Search for Habeas Headers' is False)"""),
      BOOLEAN, RESTORE),
+
+    ("x-token_cache_size", _("Number of messages to cache tokens for"), 0,
+     _("""(EXPERIMENTAL) If greater than zero, the tokens generated for
+     this many of the most recently tokenized messages are remembered, so
+     that a message that is tokenized again (for example, when it is
+     trained after being scored, or in each round of a train-to-exhaustion
+     run) needn't be.  Messages are recognised by a digest of their text.
+     The cache is emptied whenever any other tokenizer option changes."""),
+     INTEGER, RESTORE),
+
+    ("x-token_cache_file", _("Token cache file location"), "",
+     _("""(EXPERIMENTAL) If token caching is enabled, and this is not
+     empty, cached tokens are also kept in a dbm database of this name, so
+     that they survive between sessions.  The size limit only applies to
+     the tokens kept in memory."""),
+     PATH, RESTORE),
   ),
 
   # These options are all experimental; it seemed better to put them into
@@ -481,6 +520,15 @@ defaults = {
      _("""default locations for timcv and timtest - these get the set number
      interpolated."""),
      VARIABLE_PATH, RESTORE),
+
+    ("token_cache_file", _("Corpus token cache file"), "",
+     _("""If this is not empty, the tokens of the messages that the test
+     drivers read are kept in a file of this name, so that later runs
+     needn't tokenize them again; this makes runs that only change
+     classifier options much faster.  A message is tokenized again if its
+     text has changed, and the whole cache is thrown away if any tokenizer
+     option changes."""),
+     PATH, RESTORE),
   ),
 
   "CV Driver": (
@@ -603,9 +651,13 @@ defaults = {
     ("persistent_use_database", _("Database backend"), DB_TYPE[0],
      _("""SpamBayes can use either a ZODB or dbm database (quick to score
      one message) or a pickle (quick to train on huge amounts of messages).
-     There is also (experimental) ability to use a mySQL or PostgresSQL
-     database."""),
-     ("zeo", "zodb", "cdb", "mysql", "pgsql", "dbm", "pickle"), RESTORE),
+     A "packed" pickle is a pickle that uses much less memory once it is
+     loaded, at a small cost in speed.  An "mmap" database is very quick
+     to open and is shared between processes, but is slow to store, so
+     suits filters that score far more often than they train.  There is
+     also (experimental) ability to use a mySQL or PostgresSQL database."""),
+     ("zeo", "zodb", "cdb", "mysql", "pgsql", "dbm", "pickle", "packed",
+      "mmap"), RESTORE),
 
     ("persistent_storage_file", _("Storage file name"), DB_TYPE[1],
      _("""Spambayes builds a database of information that it gathers
@@ -616,6 +668,45 @@ defaults = {
      most recent configuration file loaded."""),
      FILE_WITH_PATH, DO_NOT_RESTORE),
 
+    ("pickle_journal", _("Keep a journal of pickle changes"), False,
+     _("""With a pickle database, storing the database normally means
+     writing all of it, which can take a long time for a big database.
+     If this is set, the words that have changed since the last store are
+     added to a journal instead (in a file with ".journal" added to the
+     database's name), and the whole pickle is only written when the
+     journal gets too big, or when the database is closed."""),
+     BOOLEAN, RESTORE),
+
+    ("pickle_journal_size", _("Maximum size of the pickle journal"),
+     10000000,
+     _("""When the pickle journal is bigger than this many bytes, the
+     next store writes the whole pickle and starts a new journal."""),
+     INTEGER, RESTORE),
+
+    ("dbm_cache_size", _("Maximum number of cached words"), 0,
+     _("""With a dbm database, the records for the words that have been
+     looked up are kept in memory, so that they don't need to be read
+     again.  In a program that runs for a long time, such as sb_server,
+     this can eventually be most of the database.  If this is more than
+     zero, only this many of the most recently used records are kept
+     (plus any that have been changed and not yet saved)."""),
+     INTEGER, RESTORE),
+
+    ("use_bloom_filter", _("Use a Bloom filter"), False,
+     _("""With a dbm database, keep a Bloom filter of the words in the
+     database, so that most words that are not in it (usually the
+     majority of the words in a new message) can be ruled out without
+     reading the disk.  The filter is saved alongside the database, in a
+     file with ".bloom" added to the name, and takes about 10 bits per
+     word for a 1% false positive rate."""),
+     BOOLEAN, RESTORE),
+
+    ("bloom_filter_error_rate", _("Bloom filter false positive rate"), 0.01,
+     _("""The fraction of the words not in the database that the Bloom
+     filter should (wrongly) let through.  Smaller values make for a
+     bigger filter."""),
+     REAL, RESTORE),
+
     ("messageinfo_storage_file", _("Message information file name"), DB_TYPE[2],
      _("""Spambayes builds a database of information about messages
      that it has already seen and trained or classified.  This
@@ -889,6 +980,24 @@ defaults = {
      used for classifications (i.e. results may be effected)."""),
      REAL, RESTORE),
 
+    ("streaming_threshold", _("Streaming threshold"), 0,
+     _("""If greater than zero, a message is classified as soon as all of
+     its headers, and this many bytes of the message, have arrived from
+     the server, and the rest of it then proxies straight through to your
+     email client as it arrives, rather than being held in memory.  As
+     with the retrieval timeout, only the first part of a longer message
+     is used for classification (and kept in the cache).  Something like
+     1000000 (one megabyte) will keep the memory used for large
+     attachments down without affecting most messages."""),
+     INTEGER, RESTORE),
+
+    ("classification_threads", _("Classification threads"), 0,
+     _("""If greater than zero, messages are tokenized and scored by this
+     many background threads, so that a large message doesn't hold up
+     other email clients, or the web interface, while it is classified.
+     If zero, messages are classified one at a time, as they arrive."""),
+     INTEGER, RESTORE),
+
     ("use_ssl", "Connect via a secure socket layer", False,
      """Use SSL to connect to the server. This allows spambayes to connect
      without sending data in plain text.
@@ -1220,6 +1329,25 @@ defaults = {
      was originally in - *all* messages will be moved to the same
      folder."""),
      IMAP_FOLDER, DO_NOT_RESTORE),
+
+    ("fetch_batch_size", _("Messages to fetch with each command"), 25,
+     _("""Rather than asking the server for messages one at a time, the
+     filter fetches the headers (and, where they are needed, the bodies)
+     of this many messages with a single command."""),
+     INTEGER, RESTORE),
+
+    ("pipeline_depth", _("Commands to send without waiting"), 4,
+     _("""The number of fetch commands that are sent to the server before
+     waiting for any of the replies.  This saves waiting for a round trip
+     to the server for each command, which matters most with distant
+     servers.  Set this to 1 if your server has trouble with this."""),
+     INTEGER, RESTORE),
+
+    ("sessions", _("Connections to each server"), 1,
+     _("""If more than one folder is to be filtered, the filter can open
+     several connections to the server, and filter that many folders at
+     the same time."""),
+     INTEGER, RESTORE),
   ),
 
   "ZODB" : (
@@ -1298,6 +1426,16 @@ defaults = {
      _("""If possible, the user interface should use a language from this
      list (in order of preference)."""),
      r"\w\w(?:_\w\w)?", RESTORE),
+
+    ("event_loop", _("Event loop"), "select",
+     _("""How the servers (the POP3 and SMTP proxies and the web interface)
+     wait for network activity.  "select" works everywhere, but gets
+     slower as the number of connections grows, and can't handle more
+     than about five hundred at once.  "poll" (not available on Windows)
+     and "epoll" (Linux only, and the fastest with many connections)
+     don't have those limits.  If the one chosen isn't available, the
+     next best one is used."""),
+     ("select", "poll", "epoll"), RESTORE),
   ),
   "Plugin": (
     ("xmlrpc_path", _("XML-RPC path"), "/sbrpc",
@@ -3,6 +3,7 @@
 Classes:
     Option - Holds information about an option
     OptionsClass - A collection of options
+    OptionsSnapshot - The values of the options in a section, as attributes
 
 Abstract:
 
@@ -21,6 +22,13 @@ The OptionsClass class provides facility for a collection of Options.
 It is expected that manipulation of the options will be carried out
 via an instance of this class.
 
+Getting an option's value with options["section", "name"] takes several
+method calls and dictionary lookups, which adds up in code that does it
+for every message or every token.  Such code can instead bind the
+OptionsSnapshot for the section once (with options.snapshot("section"))
+and read plain attributes from it; the snapshot is updated whenever
+one of its options is set.
+
 Experimental or deprecated options are prefixed with 'x-', borrowing the
 practice from RFC-822 mail.  If the user sets an option like:
 
@@ -90,7 +98,7 @@ import types
 import locale
 from textwrap import wrap
 
-__all__ = ['OptionsClass',
+__all__ = ['OptionsClass', 'OptionsSnapshot',
            'HEADER_NAME', 'HEADER_VALUE',
            'INTEGER', 'REAL', 'BOOLEAN',
            'SERVER', 'PORT', 'EMAIL_ADDRESS',
@@ -112,6 +120,8 @@ class Option(object):
         self.allowed_values = allowed
         self.restore = restore
         self.delimiter = None
+        # The OptionsSnapshot to keep up to date, if there is one.
+        self.snapshot = None
         # start with default value
         self.set(default)
 
@@ -133,6 +143,8 @@ class Option(object):
     def set(self, val):
         '''Set option to value.'''
         self.value = val
+        if self.snapshot is not None:
+            self.snapshot._update(self.name, val)
     def get(self):
         '''Get option value.'''
         return self.value
@@ -368,10 +380,35 @@ class Option(object):
         return False
 
 
+class OptionsSnapshot(object):
+    '''The values of the options in one section, as attributes.
+
+    The attribute names are the option names with any "-" changed to "_"
+    (so the value of "x-short_runs" is the x_short_runs attribute).
+    Snapshots are read-only; OptionsClass.snapshot() explains how they
+    are kept up to date.
+    '''
+    def __init__(self, section):
+        self.__dict__["_section"] = section
+
+    def __repr__(self):
+        return "<%s [%s]>" % (self.__class__.__name__, self._section)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("options can't be set through a snapshot")
+
+    def __delattr__(self, name):
+        raise AttributeError("options can't be deleted from a snapshot")
+
+    def _update(self, name, value):
+        self.__dict__[name.replace("-", "_")] = value
+
+
 class OptionsClass(object):
     def __init__(self):
         self.verbose = None
         self._options = {}
+        self._snapshots = {}
         self.restore_point = {}
         self.conversion_table = {} # set by creator if they need it.
     #
@@ -510,6 +547,8 @@ class OptionsClass(object):
 
                 o = klass(*args)
                 self._options[section, o.name] = o
+                if section in self._snapshots:
+                    self._attach_snapshot(self._snapshots[section], o)
 
     def set_restore_point(self):
         '''Remember what the option values are right now, to
@@ -573,6 +612,26 @@ class OptionsClass(object):
                 else:
                     self.convert_and_set(section, option, value)
 
+    def snapshot(self, section):
+        '''Return an OptionsSnapshot of the options in the section.
+
+        There is one snapshot for each section, which is generated when
+        it is first asked for; after that, each option updates its value
+        in the snapshot whenever it is set (by set(), merge_file(),
+        revert_to_restore_point() and so on), so a snapshot can be bound
+        once and used for as long as the options are.'''
+        snap = self._snapshots.get(section)
+        if snap is None:
+            snap = self._snapshots[section] = OptionsSnapshot(section)
+            for (sect, opt), opt_obj in self._options.iteritems():
+                if sect == section:
+                    self._attach_snapshot(snap, opt_obj)
+        return snap
+
+    def _attach_snapshot(self, snap, opt_obj):
+        opt_obj.snapshot = snap
+        snap._update(opt_obj.name, opt_obj.get())
+
     # not strictly necessary, but convenient shortcuts to self._options
     def display_name(self, sect, opt):
         '''A name for the option suitable for display to a user.'''
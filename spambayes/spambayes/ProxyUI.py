@@ -162,6 +162,9 @@ class ProxyUserInterface(UserInterface.UserInterface):
         state.buildStatusStrings()
         stateDict = state.__dict__.copy()
         stateDict.update(state.bayes.__dict__)
+        # (These aren't in __dict__ if the classifier is shared between
+        # threads - see epochs.py.)
+        stateDict.update(nspam=state.bayes.nspam, nham=state.bayes.nham)
         statusTable = self.html.statusTable.clone()
         if not state.servers:
             statusTable.proxyDetails = _("No POP3 proxies running.<br/>")
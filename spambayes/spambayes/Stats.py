@@ -13,16 +13,23 @@ Abstract:
     retrieved from the messageinfo database, so is as reliable as that
     is <wink>.
 
+    The totals are kept up to date as messages are classified and
+    trained, and stored in the messageinfo database, along with the same
+    counts for each of the latest days (so that the daily throughput can
+    be shown), so that the statistics don't depend on how many messages
+    the database has.  They are only recalculated from the messages
+    themselves the first time, or when CalculatePersistentStats() is
+    called.
+
     This class provides information for both the web interface, the
     Outlook plug-in, and sb_pop3dnd.
 
 To Do:
     o People would like pretty graphs, so maybe that could be done.
+      (GetDailyStats() has the data for them.)
     o People have requested time-based statistics - mail per hour,
-      spam per hour, and so on.
-      Discussion on spambayes-dev indicated that this would be a lot
-      of work for not much gain; however, since we now have some
-      time data stored, it wouldn't be too bad, so maybe it can go in.
+      spam per hour, and so on.  There are now daily ones; anything
+      finer would need more buckets.
     o Suggestions?
 """
 
@@ -36,6 +43,7 @@ __credits__ = "Kenny Pitt, Mark Hammond, all the spambayes folk."
 import time
 
 from spambayes.message import STATS_START_KEY, STATS_STORAGE_KEY
+from spambayes.message import STATS_DAILY_KEY
 from spambayes.message import Message
 
 try:
@@ -43,6 +51,21 @@ try:
 except NameError:
     _ = lambda arg: arg
 
+PERSISTENT_STATS = ["num_ham", "num_spam", "num_unsure",
+                    "num_trained_spam", "num_trained_spam_fn",
+                    "num_trained_ham", "num_trained_ham_fp",]
+
+# The number of days of daily statistics that the web interface shows, and
+# the number that are kept (the latest days on which anything happened),
+# so that they don't grow for as long as SpamBayes is used.
+DAILY_STATS_SHOWN = 14
+DAILY_STATS_KEPT = 60
+
+def day_key(when=None):
+    """Return the key of the daily statistics for the given time (by
+    default, now): the local date, as "YYYY-MM-DD"."""
+    return time.strftime("%Y-%m-%d", time.localtime(when))
+
 class Stats(object):
     def __init__(self, options, messageinfo_db):
         self.messageinfo_db = messageinfo_db
@@ -59,10 +82,10 @@ class Stats(object):
         self.num_trained_ham = self.num_trained_ham_fp = 0
 
     def ResetTotal(self, permanently=False):
+        """Reset the totals.  The daily statistics are kept (they aren't
+        affected by the start date)."""
         self.totals = {}
-        for stat in ["num_ham", "num_spam", "num_unsure",
-                     "num_trained_spam", "num_trained_spam_fn",
-                     "num_trained_ham", "num_trained_ham_fp",]:
+        for stat in PERSISTENT_STATS:
             self.totals[stat] = 0
         if permanently:
             # Reset the date.
@@ -70,21 +93,43 @@ class Stats(object):
             self.messageinfo_db.set_statistics_start_date(self.from_date)
             self.messageinfo_db.set_persistent_statistics(self.totals)
 
+    def _Count(self, stat, when=None):
+        """Add one to the given statistic, in the totals (if when isn't
+        before the start date) and in the day's statistics."""
+        if when is None or not self.from_date or when >= self.from_date:
+            self.totals[stat] += 1
+        day = day_key(when)
+        try:
+            counts = self.daily[day]
+        except KeyError:
+            counts = self.daily[day] = dict.fromkeys(PERSISTENT_STATS, 0)
+        counts[stat] += 1
+
+    def _PruneDaily(self):
+        """Drop all but the latest DAILY_STATS_KEPT days of the daily
+        statistics."""
+        if len(self.daily) > DAILY_STATS_KEPT:
+            days = self.daily.keys()
+            days.sort()
+            for day in days[:-DAILY_STATS_KEPT]:
+                del self.daily[day]
+
     def RecordClassification(self, score):
         """Record that a message has been classified this session."""
-        totals = self.totals
         if score >= self.options["Categorization", "spam_cutoff"]:
             self.num_spam += 1
-            totals["num_spam"] += 1
+            self._Count("num_spam")
         elif score >= self.options["Categorization", "ham_cutoff"]:
             self.num_unsure += 1
-            totals["num_unsure"] += 1
+            self._Count("num_unsure")
         else:
             self.num_ham += 1
-            totals["num_ham"] += 1
+            self._Count("num_ham")
         # We have to record the updated totals every time or else the
         # persistent statistics will get out of sync.
-        self.messageinfo_db.set_persistent_statistics(self.totals)
+        self._PruneDaily()
+        self.messageinfo_db.set_persistent_statistics(self.totals,
+                                                      self.daily)
 
     def RecordTraining(self, as_ham, old_score=None, old_class=None):
         """Record that a message has been trained this session.
@@ -97,34 +142,35 @@ class Stats(object):
         """
         # XXX Why, oh why, does this function have as_ham, when every
         # XXX other function has isSpam???
-        totals = self.totals
         if as_ham:
             self.num_trained_ham += 1
-            totals["num_trained_ham"] += 1
+            self._Count("num_trained_ham")
             # If we are recovering an item that is in the "spam" threshold,
             # then record it as a "false positive"
             if old_score is not None and \
                old_score > self.options["Categorization", "spam_cutoff"]:
                 self.num_trained_ham_fp += 1
-                totals["num_trained_ham_fp"] += 1
+                self._Count("num_trained_ham_fp")
             elif old_class == self.options["Headers", "header_spam_string"]:
                 self.num_trained_ham_fp += 1
-                totals["num_trained_ham_fp"] += 1
+                self._Count("num_trained_ham_fp")
         else:
             self.num_trained_spam += 1
-            totals["num_trained_spam"] += 1
+            self._Count("num_trained_spam")
             # If we are deleting as Spam an item that was in our "good"
             # range, then record it as a false negative.
             if old_score is not None and \
                old_score < self.options["Categorization", "ham_cutoff"]:
                 self.num_trained_spam_fn += 1
-                totals["num_trained_spam_fn"] += 1
+                self._Count("num_trained_spam_fn")
             elif old_class == self.options["Headers", "header_ham_string"]:
                 self.num_trained_spam_fn += 1
-                totals["num_trained_spam_fn"] += 1
+                self._Count("num_trained_spam_fn")
         # We have to record the updated totals every time or else the
         # persistent statistics will get out of sync.
-        self.messageinfo_db.set_persistent_statistics(self.totals)
+        self._PruneDaily()
+        self.messageinfo_db.set_persistent_statistics(self.totals,
+                                                      self.daily)
 
     def LoadPersistentStats(self):
         """Load the persistent statistics from the messageinfo db.
@@ -134,26 +180,39 @@ class Stats(object):
         messages.  This will result in a one-time performance hit, but
         will greatly improve the startup time in the future."""
         self.totals = self.messageinfo_db.get_persistent_statistics()
+        self.daily = self.messageinfo_db.get_daily_statistics()
         if self.totals is None:
             self.CalculatePersistentStats()
+        elif self.daily is None:
+            # The totals were stored before there were daily statistics.
+            # Start them now, rather than going through all the messages
+            # (CalculatePersistentStats() will fill in the earlier days).
+            self.daily = {}
 
     def CalculatePersistentStats(self):
-        """Calculate the statistics totals (i.e. not this session).
+        """Calculate the statistics totals (i.e. not this session), and
+        the daily statistics.
 
         This is done by running through the messageinfo database and
         adding up the various information.  This could get quite time
         consuming if the messageinfo database gets very large, so
         it should only be done if the statistics start date is reset
         to an arbitrary point in the past.
+
+        Each message is counted on the day that it was last changed, so
+        the daily statistics this produces only approximate the ones
+        recorded as messages are classified and trained.
         """
         self.ResetTotal()
-        totals = self.totals
+        self.daily = {}
         for msg_id in self.messageinfo_db.keys():
             # Skip the date and persistent statistics keys.
             if msg_id == STATS_START_KEY:
                 continue
             if msg_id == STATS_STORAGE_KEY:
                 continue
+            if msg_id == STATS_DAILY_KEY:
+                continue
 
             m = Message(msg_id)
             self.messageinfo_db.load_msg(m)
@@ -162,37 +221,49 @@ class Stats(object):
             if m.date_modified is None:
                 continue
 
-            # Skip ones that are too old.
-            if self.from_date and m.date_modified < self.from_date:
-                continue
-
+            # (Ones that are too old only count in the daily statistics.)
+            when = m.date_modified
             classification = m.GetClassification()
             trained = m.GetTrained()
             
             if classification == self.options["Headers",
                                               "header_spam_string"]:
                 # Classified as spam.
-                totals["num_spam"] += 1
+                self._Count("num_spam", when)
                 if trained == False:
                     # False positive (classified as spam, trained as ham)
-                    totals["num_trained_ham_fp"] += 1
+                    self._Count("num_trained_ham_fp", when)
             elif classification == self.options["Headers",
                                                 "header_ham_string"]:
                 # Classified as ham.
-                totals["num_ham"] += 1
+                self._Count("num_ham", when)
                 if trained == True:
                     # False negative (classified as ham, trained as spam)
-                    totals["num_trained_spam_fn"] += 1
+                    self._Count("num_trained_spam_fn", when)
             elif classification == self.options["Headers",
                                                 "header_unsure_string"]:
                 # Classified as unsure.
-                totals["num_unsure"] += 1
+                self._Count("num_unsure", when)
                 if trained == False:
-                    totals["num_trained_ham"] += 1
+                    self._Count("num_trained_ham", when)
                 elif trained == True:
-                    totals["num_trained_spam"] += 1
-
-        self.messageinfo_db.set_persistent_statistics(totals)
+                    self._Count("num_trained_spam", when)
+
+        self._PruneDaily()
+        self.messageinfo_db.set_persistent_statistics(self.totals,
+                                                      self.daily)
+
+    def GetDailyStats(self, num_days=None):
+        """Return the daily statistics, oldest first, as a list of (date,
+        counts) pairs, where date is "YYYY-MM-DD" and counts is a
+        dictionary like the totals.  Days on which nothing happened are
+        left out.  If num_days is given, only that many of the latest
+        days are returned."""
+        days = self.daily.keys()
+        days.sort()
+        if num_days is not None:
+            days = days[max(0, len(days) - num_days):]
+        return [(day, self.daily[day].copy()) for day in days]
 
     def _CalculateAdditional(self, data):
         data["perc_ham"] = 100.0 * data["num_ham"] / data["num_seen"]
@@ -330,9 +401,7 @@ class Stats(object):
             data["num_trained_spam"] = self.num_trained_spam
             data["num_trained_spam_fn"] = self.num_trained_spam_fn
         else:
-            for stat in ["num_ham", "num_spam", "num_unsure",
-                         "num_trained_spam", "num_trained_spam_fn",
-                         "num_trained_ham", "num_trained_ham_fp",]:
+            for stat in PERSISTENT_STATS:
                 data[stat] = self.totals[stat]
         data["num_seen"] = data["num_ham"] + data["num_spam"] + \
                            data["num_unsure"]
@@ -20,9 +20,14 @@
 #         finishtest()
 # # Display stats against all runs.
 # alldone()
+#
+# ParallelDriver has the same interface, but only records what it is asked
+# to do until alldone() is called, and then does all the tokenizing and
+# testing in a pool of processes.  The output is the same as Driver's.
 
 from spambayes.Options import options
 from spambayes import Tester
+from spambayes import msgs
 from spambayes import classifier
 from spambayes.Histogram import Hist
 from spambayes.safepickle import pickle_write
@@ -176,7 +181,10 @@ class Driver:
             fname = "%s%d.pik" % (options["TestDriver", "pickle_basename"],
                                   self.ntimes_finishtest_called)
             print "    saving pickle to", fname
-            pickle_write(fname, self.classifier, 1)
+            self.save_classifier(fname)
+
+    def save_classifier(self, fname):
+        pickle_write(fname, self.classifier, 1)
 
     def alldone(self):
         if options["TestDriver", "show_histograms"]:
@@ -298,3 +306,295 @@ class Driver:
             printhist("this pair:", local_ham_hist, local_spam_hist)
         self.trained_ham_hist += local_ham_hist
         self.trained_spam_hist += local_spam_hist
+
+
+# Parallel testing.  The message streams are broken up into "units", each
+# of which is the messages a msgs.MsgStream takes from one directory.  The
+# state of the classifier at any time is then a number of copies (almost
+# always 0 or 1) of each unit's word counts, so the classifier for each
+# test can be built by adding up counts that are only calculated once.
+
+def _stream_units(stream, is_spam):
+    if not isinstance(stream, msgs.MsgStream):
+        raise TypeError("ParallelDriver only works with msgs.MsgStream "
+                        "streams, not %r" % (stream,))
+    return [(directory, stream.keep, is_spam)
+            for directory in stream.directories]
+
+# The results of _tokenize_unit, shared by the test worker processes.
+_unit_data = None
+
+def _set_unit_data(unit_data):
+    global _unit_data
+    _unit_data = unit_data
+
+def _tokenize_unit((unit, keep_tokens)):
+    """Tokenize the messages in a unit.
+
+    Return (tags, token tuples, number of messages, word counts), where
+    word counts maps each word to the number of messages it is in (after
+    whatever the classifier does to the tokens when training).  The tags
+    and tokens are only returned if keep_tokens is true.
+    """
+    directory, keep, is_spam = unit
+    c = classifier.Bayes()
+    tags = []
+    tokens = []
+    for msg in msgs.MsgStream(directory, [directory], keep):
+        tags.append(msg.tag)
+        tokens.append(tuple(msg))
+    c.learn_many(tokens, is_spam)
+    counts = {}
+    for word, record in c.wordinfo.iteritems():
+        counts[word] = is_spam and record.spamcount or record.hamcount
+    if not keep_tokens:
+        return None, None, len(tags), counts
+    return tags, tokens, len(tags), counts
+
+def _build_classifier(coefficients):
+    c = classifier.Bayes()
+    totals = {}
+    for unit, n in coefficients.iteritems():
+        if not n:
+            continue
+        is_spam = unit[2]
+        tags, tokens, nmsgs, counts = _unit_data[unit]
+        if is_spam:
+            c.nspam += n * nmsgs
+        else:
+            c.nham += n * nmsgs
+        for word, count in counts.iteritems():
+            total = totals.get(word)
+            if total is None:
+                total = totals[word] = [0, 0]
+            total[is_spam] += n * count
+    WordInfoClass = c.WordInfoClass
+    for word, (hamcount, spamcount) in totals.iteritems():
+        record = WordInfoClass()
+        record.__setstate__((spamcount, hamcount))
+        c.wordinfo[word] = record
+    return c
+
+class _ScoredMsg:
+    # Stands in for a msgs.Msg in the parent process:  it compares by tag
+    # in the same way, and knows its score (and its clues, if they might
+    # be displayed), but only reads the message text if it's displayed.
+    __slots__ = 'tag', 'prob', 'clues'
+
+    def __init__(self, tag, prob, clues):
+        self.tag = tag
+        self.prob = prob
+        self.clues = clues
+
+    def __hash__(self):
+        return hash(self.tag)
+
+    def __eq__(self, other):
+        return self.tag == other.tag
+
+    def __str__(self):
+        f = open(self.tag, 'rb')
+        guts = f.read()
+        f.close()
+        return guts
+
+def _needs_clues(prob, is_spam):
+    """Return True if Driver.test() might display the clues for a message
+    with this score."""
+    ham_cutoff = options["Categorization", "ham_cutoff"]
+    spam_cutoff = options["Categorization", "spam_cutoff"]
+    if is_spam:
+        if options["TestDriver", "show_spam_lo"] <= prob <= \
+           options["TestDriver", "show_spam_hi"]:
+            return True
+        if prob < ham_cutoff:
+            return options["TestDriver", "show_false_negatives"]
+    else:
+        if options["TestDriver", "show_ham_lo"] <= prob <= \
+           options["TestDriver", "show_ham_hi"]:
+            return True
+        if prob >= spam_cutoff:
+            return options["TestDriver", "show_false_positives"]
+    if ham_cutoff <= prob < spam_cutoff:
+        return options["TestDriver", "show_unsure"]
+    return False
+
+def _run_test(job):
+    """Build the classifier for a test and score the test messages.
+
+    Return the _ScoredMsg lists for the ham and for the spam.
+    """
+    coefficients, ham_units, spam_units, pickle_name = job
+    c = _build_classifier(coefficients)
+    if pickle_name is not None:
+        pickle_write(pickle_name, c, 1)
+    results = []
+    for units, is_spam in (ham_units, False), (spam_units, True):
+        scored = []
+        for unit in units:
+            tags, tokens = _unit_data[unit][:2]
+            for tag, words in zip(tags, tokens):
+                prob = c.spamprob(words)
+                clues = None
+                if _needs_clues(prob, is_spam):
+                    clues = c.spamprob(words, True)[1]
+                scored.append(_ScoredMsg(tag, prob, clues))
+        results.append(scored)
+    return results
+
+class _ReplayClassifier:
+    # Plays the part of the classifier when ParallelDriver replays a run:
+    # training only changes the message counts, and the scores come from
+    # the worker processes.
+    def __init__(self):
+        self.nham = self.nspam = 0
+
+    def learn(self, msg, is_spam):
+        if is_spam:
+            self.nspam += 1
+        else:
+            self.nham += 1
+
+    def unlearn(self, msg, is_spam):
+        if is_spam:
+            self.nspam -= 1
+        else:
+            self.nham -= 1
+
+    def spamprob(self, msg, evidence=False):
+        if evidence:
+            return msg.prob, msg.clues
+        return msg.prob
+
+class _ReplayStream:
+    def __init__(self, tag, msgs):
+        self.tag = tag
+        self.msgs = msgs
+
+    def __str__(self):
+        return self.tag
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+class ParallelDriver(Driver):
+    """A Driver that runs tests in a pool of processes.
+
+    Every message is tokenized once, training is done by adding up the
+    word counts of the messages in each stream, and the tests are run at
+    the same time, up to 'processes' at once.  Nothing is done (or
+    displayed) until alldone() is called; what is displayed then is the
+    same as Driver would have displayed along the way.
+
+    The streams must be msgs.MsgStream instances, and nothing may be
+    untrained unless it has been trained.  This relies on fork() to pass
+    the options and the tokens to the worker processes, so is only useful
+    on Unix.
+    """
+    def __init__(self, processes):
+        self.processes = processes
+        self.script = []
+        self.jobs = []
+        self.coefficients = {}
+        # Maps each unit to whether its messages are tested (in which
+        # case the workers need their tokens).
+        self.units = {}
+        self.ntests = self.nfinished = 0
+        Driver.__init__(self)
+
+    def new_classifier(self):
+        self.script.append(("new_classifier",))
+        self.coefficients = {}
+        Driver.set_classifier(self, _ReplayClassifier())
+
+    def set_classifier(self, classifier):
+        raise NotImplementedError("ParallelDriver builds its own classifiers")
+
+    def _adjust(self, stream, is_spam, n):
+        for unit in _stream_units(stream, is_spam):
+            self.units.setdefault(unit, False)
+            count = self.coefficients.get(unit, 0) + n
+            if count < 0:
+                raise ValueError("ParallelDriver can't untrain %s, because "
+                                 "it hasn't been trained" % (unit[0],))
+            self.coefficients[unit] = count
+
+    def train(self, ham, spam):
+        self._adjust(ham, False, 1)
+        self._adjust(spam, True, 1)
+        self.script.append(("train", ham, spam))
+
+    def untrain(self, ham, spam):
+        self._adjust(ham, False, -1)
+        self._adjust(spam, True, -1)
+        self.script.append(("untrain", ham, spam))
+
+    def test(self, ham, spam):
+        ham_units = _stream_units(ham, False)
+        spam_units = _stream_units(spam, True)
+        for unit in ham_units + spam_units:
+            self.units[unit] = True
+        pickle_name = None
+        if options["TestDriver", "save_trained_pickles"]:
+            # finishtest() will be saving the classifier under this name.
+            pickle_name = "%s%d.pik" % (options["TestDriver",
+                                                "pickle_basename"],
+                                        self.nfinished + 1)
+        job = (self.coefficients.copy(), ham_units, spam_units, pickle_name)
+        self.script.append(("test", ham, spam, self.ntests))
+        self.ntests += 1
+        self.jobs.append(job)
+
+    def finishtest(self):
+        self.nfinished += 1
+        self.script.append(("finishtest",))
+
+    def save_classifier(self, fname):
+        # The worker process has already done it.
+        pass
+
+    def alldone(self):
+        import multiprocessing
+
+        units = self.units.items()
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            unit_data = dict(zip([unit for unit, tested in units],
+                                 pool.map(_tokenize_unit, units)))
+        finally:
+            pool.close()
+            pool.join()
+        pool = multiprocessing.Pool(self.processes, _set_unit_data,
+                                    (unit_data,))
+        try:
+            results = pool.map(_run_test, self.jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Now go through it all again, displaying what Driver would have.
+        script = self.script
+        self.script = []
+        for step in script:
+            action = step[0]
+            if action == "new_classifier":
+                Driver.set_classifier(self, _ReplayClassifier())
+            elif action in ("train", "untrain"):
+                ham, spam = step[1:]
+                ham = self._replay_stream(ham, False, unit_data)
+                spam = self._replay_stream(spam, True, unit_data)
+                getattr(Driver, action)(self, ham, spam)
+            elif action == "test":
+                ham, spam, i = step[1:]
+                ham_scored, spam_scored = results[i]
+                Driver.test(self, _ReplayStream(str(ham), ham_scored),
+                            _ReplayStream(str(spam), spam_scored))
+            elif action == "finishtest":
+                Driver.finishtest(self)
+        Driver.alldone(self)
+
+    def _replay_stream(self, stream, is_spam, unit_data):
+        n = 0
+        for unit in _stream_units(stream, is_spam):
+            n += unit_data[unit][2]
+        return _ReplayStream(str(stream), [None] * n)
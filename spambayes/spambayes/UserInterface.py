@@ -84,6 +84,7 @@ from spambayes import tokenizer
 from spambayes import Version
 from spambayes import storage
 from spambayes import FileCorpus
+from spambayes.Stats import DAILY_STATS_SHOWN
 from spambayes.Options import options, optionsPathname, defaults, \
      OptionsClass, _
 
@@ -1023,8 +1024,38 @@ class UserInterface(BaseUserInterface):
             stats = self._buildBox(_("Statistics"), None,
                                    _("Statistics not available"))
         self.write(stats)
+        if self.stats:
+            daily = self.stats.GetDailyStats(DAILY_STATS_SHOWN)
+            if daily:
+                self.write(self._buildBox(_("Daily statistics"), None,
+                                          self._buildDailyTable(daily)))
         self._writePostamble(help_topic="stats")
 
+    def _buildDailyTable(self, daily):
+        """Returns a table of the given daily statistics, latest first."""
+        columns = [(_("Good"), "num_ham"), (_("Spam"), "num_spam"),
+                   (_("Unsure"), "num_unsure"),
+                   (_("Trained as good"), "num_trained_ham"),
+                   (_("Trained as spam"), "num_trained_spam")]
+        rows = ["<table class='sectiontable' cellspacing='0'><tr>"
+                "<td><strong>%s</strong></td>" % (_("Date"),)]
+        for heading, unused in columns:
+            rows.append("<td align='center'><strong>%s</strong></td>" %
+                        (heading,))
+        rows.append("</tr>")
+        stripe = 0
+        daily = daily[:]
+        daily.reverse()
+        for day, counts in daily:
+            rows.append("<tr class='%s'><td>%s</td>" %
+                        (['stripe_on', 'stripe_off'][stripe], day))
+            for unused, stat in columns:
+                rows.append("<td align='center'>%d</td>" % (counts[stat],))
+            rows.append("</tr>")
+            stripe = stripe ^ 1
+        rows.append("</table>")
+        return "".join(rows)
+
     def onBugreport(self):
         """Create a message to post to spambayes@python.org that hopefully
         has enough information for us to help this person with their
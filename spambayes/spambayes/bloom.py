@@ -0,0 +1,169 @@
+"""bloom.py - A Bloom filter for cheaply ruling out unknown words.
+
+Classes:
+    BloomStats - Counters showing how useful a Bloom filter has been
+    BloomFilter - A set of strings that can give false positives
+
+Functions:
+    load - Load a saved BloomFilter, if it is still valid
+    saved_signature - Return the signature a BloomFilter was saved with
+
+Abstract:
+    A BloomFilter answers "might this word be in the database?" from a
+    bit array held in memory.  A "no" is always right, so a classifier
+    that gets one can skip looking the word up on disk; a "yes" is wrong
+    with (about) the probability the filter was built for, and then the
+    lookup is wasted.  Most of the tokens in a new message are usually not
+    in the database at all, so this saves a lot of disk reads.
+
+    Words can't be removed from a BloomFilter.  The owner records how many
+    have been removed (in the stale attribute) and, once the filter holds
+    more words than it was built for, builds a new one.
+
+    A filter is saved along with a "signature" of the database it was
+    built from (anything that changes whenever the database does, such as
+    the sizes and modification times of its files); load() only returns
+    the filter if the signature still matches, since a filter that is
+    missing words would give wrong answers.
+
+To Do:
+    o Suggestions?
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import math
+import array
+import struct
+from hashlib import md5
+
+from spambayes.safepickle import pickle_read, pickle_write
+
+BLOOM_VERSION = 1
+LN2 = math.log(2)
+
+
+class BloomStats(object):
+    # Kept separately from the filter, so that the counts survive the
+    # filter being rebuilt.
+    __slots__ = 'saved', 'false_positives'
+
+    def __init__(self):
+        # saved is the number of lookups skipped because the filter said
+        # the word wasn't there; false_positives the number of lookups
+        # that were made because the filter said it might be, but that
+        # found nothing.
+        self.saved = self.false_positives = 0
+
+    def __repr__(self):
+        return "%s(saved=%d, false_positives=%d)" % \
+               (self.__class__.__name__, self.saved, self.false_positives)
+
+    def false_positive_rate(self):
+        """Return the fraction of the missing words the filter let
+        through."""
+        missing = self.saved + self.false_positives
+        if missing:
+            return float(self.false_positives) / missing
+        return 0.0
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        """Make an empty filter that will give false positives at about
+        error_rate once it holds capacity words."""
+        if not 0.0 < error_rate < 1.0:
+            raise ValueError("error_rate must be between 0 and 1")
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = max(8, int(math.ceil(-capacity * math.log(error_rate)
+                                          / (LN2 * LN2))))
+        self.nhashes = max(1, int(round(LN2 * self.nbits / capacity)))
+        self.bits = array.array('B', [0]) * ((self.nbits + 7) // 8)
+        # The number of (distinct) words added.
+        self.count = 0
+        # The number of words removed from the database since the filter
+        # was built, whose bits are still set.
+        self.stale = 0
+        # Whether the filter has changed since it was loaded or saved, and
+        # the signature it was loaded or saved with.
+        self.changed = True
+        self.signature = None
+
+    def __repr__(self):
+        return "<%s holding %d of %d words>" % \
+               (self.__class__.__name__, self.count, self.capacity)
+
+    def _positions(self, word):
+        # Double hashing:  the k positions are h1 + i*h2, which is as good
+        # as k independent hashes, for the price of one md5.
+        h1, h2 = struct.unpack("<QQ", md5(word).digest())
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in xrange(self.nhashes)]
+
+    def add(self, word):
+        """Add a word, which must not have been added already (the filter
+        can't tell, so it would be counted twice)."""
+        bits = self.bits
+        for pos in self._positions(word):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        self.changed = True
+
+    def update(self, words):
+        for word in words:
+            self.add(word)
+
+    def __contains__(self, word):
+        bits = self.bits
+        for pos in self._positions(word):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        """Return True if the filter should be rebuilt, because it holds
+        (or has held) more words than it was built for."""
+        return self.count + self.stale > self.capacity
+
+    def save(self, filename, signature):
+        pickle_write(filename, (BLOOM_VERSION, signature, self.capacity,
+                                self.error_rate, self.count, self.stale,
+                                self.bits.tostring()), 2)
+        self.signature = signature
+        self.changed = False
+
+
+def load(filename, signature):
+    """Return the BloomFilter saved in filename, or None if there isn't
+    one, or it was saved with a different signature."""
+    try:
+        state = pickle_read(filename)
+    except (IOError, OSError, EOFError):
+        return None
+    if state[0] != BLOOM_VERSION or state[1] != signature:
+        return None
+    capacity, error_rate, count, stale, bits = state[2:]
+    bloom = BloomFilter(capacity, error_rate)
+    if len(bits) != len(bloom.bits):
+        return None
+    bloom.bits = array.array('B', bits)
+    bloom.count = count
+    bloom.stale = stale
+    bloom.changed = False
+    bloom.signature = signature
+    return bloom
+
+def saved_signature(filename):
+    """Return the signature the BloomFilter in filename was saved with, or
+    None if there isn't one."""
+    try:
+        state = pickle_read(filename)
+    except (IOError, OSError, EOFError):
+        return None
+    if state[0] != BLOOM_VERSION:
+        return None
+    return state[1]
@@ -38,6 +38,7 @@ from __future__ import generators
 # This implementation is due to Tim Peters et alia.
 
 import math
+import heapq
 
 # XXX At time of writing, these are only necessary for the
 # XXX experimental url retrieving/slurping code.  If that
@@ -57,10 +58,16 @@ URL_KEY_RE = re.compile(r"[\W]")
 
 from spambayes.Options import options
 from spambayes.chi2 import chi2Q
+from spambayes.lrucache import CacheStats
 from spambayes.safepickle import pickle_read, pickle_write
 
 LN2 = math.log(2)       # used frequently by chi-combining
 
+# The Classifier options are read for every message and every word, so
+# we use a snapshot of them (which is kept up to date) rather than
+# looking each one up in options.
+classifier_options = options.snapshot("Classifier")
+
 slurp_wordstream = None
 
 PICKLE_VERSION = 5
@@ -90,6 +97,51 @@ class WordInfo(object):
         self.spamcount, self.hamcount = t
 
 
+class TrainingBatch(object):
+    # Word count changes collected by Classifier.bulk_update(), waiting to
+    # be applied to the database in one pass.
+    def __init__(self):
+        self.nspam = self.nham = 0
+        self.spamcounts = {}
+        self.hamcounts = {}
+
+    def add(self, wordstream, is_spam):
+        if is_spam:
+            self.nspam += 1
+            counts = self.spamcounts
+        else:
+            self.nham += 1
+            counts = self.hamcounts
+        for word in set(wordstream):
+            counts[word] = counts.get(word, 0) + 1
+
+
+class _BulkUpdate(object):
+    # The context manager returned by Classifier.bulk_update().
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.nested = False
+
+    def __enter__(self):
+        c = self.classifier
+        if c._training_batch is None:
+            c._training_batch = TrainingBatch()
+        else:
+            self.nested = True
+        return c._training_batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.nested:
+            return False
+        c = self.classifier
+        batch = c._training_batch
+        c._training_batch = None
+        # Like a transaction, nothing is applied if there was an error.
+        if exc_type is None:
+            c._apply_batch(batch)
+        return False
+
+
 class Classifier:
     # Defining __slots__ here made Jeremy's life needlessly difficult when
     # trying to hook this all up to ZODB as a persistent object.  There's
@@ -108,6 +160,9 @@ class Classifier:
     def __init__(self):
         self.wordinfo = {}
         self.probcache = {}
+        self.probcache_stats = CacheStats()
+        self._probcache_params = None
+        self._training_batch = None
         self.nspam = self.nham = 0
 
     def __getstate__(self):
@@ -118,6 +173,9 @@ class Classifier:
             raise ValueError("Can't unpickle -- version %s unknown" % t[0])
         (self.wordinfo, self.nspam, self.nham) = t[1:]
         self.probcache = {}
+        self.probcache_stats = CacheStats()
+        self._probcache_params = None
+        self._training_batch = None
 
     # spamprob() implementations.  One of the following is aliased to
     # spamprob, depending on option settings.
@@ -149,6 +207,43 @@ class Classifier:
         where evidence is a list of (word, probability) pairs.
         """
 
+        return self._chi2_combine(self._getclues(wordstream), evidence)
+
+    def chi2_spamprob_many(self, wordstreams, evidence=False):
+        """Return a list of best-guess probabilities, one per wordstream.
+
+        wordstreams is an iterable producing wordstreams, each of the kind
+        accepted by chi2_spamprob().  The scores are exactly those that
+        chi2_spamprob() would return for each wordstream in turn, but each
+        distinct token (or bigram) is looked up in the database, and has
+        its probability computed, only once for the whole batch.  This
+        pays off when many messages are scored together, because popular
+        tokens occur in nearly all of them.
+
+        If optional arg evidence is True, each list element is a
+        (probability, evidence) pair, as for chi2_spamprob().
+        """
+        # Map each word seen so far in this batch to its
+        # (distance, prob, word, record) tuple.
+        seen = {}
+        worddistanceget = self._worddistanceget
+        def distanceget(word):
+            try:
+                return seen[word]
+            except KeyError:
+                tup = seen[word] = worddistanceget(word)
+                return tup
+
+        return [self._chi2_combine(self._getclues(wordstream, distanceget),
+                                   evidence)
+                for wordstream in wordstreams]
+
+    def _chi2_combine(self, clues, evidence):
+        """Combine the (prob, word, record) clues into a spam score.
+
+        This is the guts of chi2_spamprob(), and is shared with
+        chi2_spamprob_many() so that the two can't drift apart.
+        """
         from math import frexp, log as ln
 
         # We compute two chi-squared statistics, one for ham and one for
@@ -166,7 +261,6 @@ class Classifier:
         H = S = 1.0
         Hexp = Sexp = 0
 
-        clues = self._getclues(wordstream)
         for prob, word, record in clues:
             S *= 1.0 - prob
             H *= prob
@@ -232,11 +326,20 @@ class Classifier:
             return prob, clues
         return prob
 
+    def _spamprob_each(self, wordstreams, evidence=False):
+        """Score a batch of wordstreams one at a time with spamprob()."""
+        return [self.spamprob(wordstream, evidence)
+                for wordstream in wordstreams]
+
     if options["Classifier", "use_chi_squared_combining"]:
         if options["URLRetriever", "x-slurp_urls"]:
             spamprob = slurping_spamprob
+            # The slurped tokens belong to whichever message was last
+            # tokenized, so there is no sharing to be had across a batch.
+            spamprob_many = _spamprob_each
         else:
             spamprob = chi2_spamprob
+            spamprob_many = chi2_spamprob_many
 
     def learn(self, wordstream, is_spam):
         """Teach the classifier by example.
@@ -245,21 +348,93 @@ class Classifier:
         True, you're telling the classifier this message is definitely spam,
         else that it's definitely not spam.
         """
-        if options["Classifier", "use_bigrams"]:
+        if classifier_options.use_bigrams:
             wordstream = self._enhance_wordstream(wordstream)
         if options["URLRetriever", "x-slurp_urls"]:
             wordstream = self._add_slurped(wordstream)
-        self._add_msg(wordstream, is_spam)
+        if self._training_batch is None:
+            self._add_msg(wordstream, is_spam)
+        else:
+            self._training_batch.add(wordstream, is_spam)
+
+    def learn_many(self, wordstreams, is_spam):
+        """Teach the classifier by many examples at once.
+
+        wordstreams is an iterable producing word streams, each of which
+        represents a message.  The result is the same as calling learn()
+        for each of them, but the per-word counts are totalled first and
+        then applied to the database once each.  See bulk_update().
+        """
+        bulk = self.bulk_update()
+        bulk.__enter__()
+        try:
+            for wordstream in wordstreams:
+                self.learn(wordstream, is_spam)
+        except:
+            bulk.__exit__(*sys.exc_info())
+            raise
+        bulk.__exit__(None, None, None)
+
+    def bulk_update(self):
+        """Return a context manager that defers training.
+
+            with bayes.bulk_update():
+                for msg in msgs:
+                    bayes.learn(tokenize(msg), is_spam)
+
+        Messages learn()ed inside the block are only counted; when the
+        block ends, the changes for each word are applied to the database
+        in a single (sorted) pass, so each word is fetched and written
+        once, rather than once per message that contains it.  If the
+        block raises an exception, none of its training is applied.
+
+        Scores computed inside the block don't reflect its training, and
+        an unlearn() inside the block applies the pending training first.
+        """
+        return _BulkUpdate(self)
+
+    def _apply_batch(self, batch):
+        """Apply the counts collected in a TrainingBatch."""
+        if not (batch.nspam or batch.nham):
+            return
+        self._invalidate_probcache()
+        self.nspam += batch.nspam
+        self.nham += batch.nham
+
+        spamcounts = batch.spamcounts
+        hamcounts = batch.hamcounts
+        words = spamcounts.keys()
+        words.extend([word for word in hamcounts if word not in spamcounts])
+        # Working through the words in order is kinder to disk-based
+        # databases.  A mix of unicode and non-ASCII strings can't be
+        # sorted, but the order doesn't matter for correctness.
+        try:
+            words.sort()
+        except UnicodeError:
+            pass
+        for word in words:
+            record = self._wordinfoget(word)
+            if record is None:
+                record = self.WordInfoClass()
+            record.spamcount += spamcounts.get(word, 0)
+            record.hamcount += hamcounts.get(word, 0)
+            self._wordinfoset(word, record)
+
+        self._post_training()
 
     def unlearn(self, wordstream, is_spam):
         """In case of pilot error, call unlearn ASAP after screwing up.
 
         Pass the same arguments you passed to learn().
         """
-        if options["Classifier", "use_bigrams"]:
+        if classifier_options.use_bigrams:
             wordstream = self._enhance_wordstream(wordstream)
         if options["URLRetriever", "x-slurp_urls"]:
             wordstream = self._add_slurped(wordstream)
+        if self._training_batch is not None:
+            # The message may be one learn()ed in this batch.
+            self._apply_batch(self._training_batch)
+            self._training_batch = TrainingBatch()
         self._remove_msg(wordstream, is_spam)
 
     def probability(self, record):
@@ -277,9 +452,12 @@ class Classifier:
 
         # Try the cache first
         try:
-            return self.probcache[spamcount][hamcount]
+            prob = self.probcache[spamcount][hamcount]
         except KeyError:
-            pass
+            self.probcache_stats.misses += 1
+        else:
+            self.probcache_stats.hits += 1
+            return prob
 
         nham = float(self.nham or 1)
         nspam = float(self.nspam or 1)
@@ -292,8 +470,8 @@ class Classifier:
 
         prob = spamratio / (hamratio + spamratio)
 
-        S = options["Classifier", "unknown_word_strength"]
-        StimesX = S * options["Classifier", "unknown_word_prob"]
+        S = classifier_options.unknown_word_strength
+        StimesX = S * classifier_options.unknown_word_prob
 
 
         # Now do Robinson's Bayesian adjustment.
@@ -344,7 +522,7 @@ class Classifier:
     # appears in a msg, but distorting spamprob doesn't appear a correct way
     # to exploit it.
     def _add_msg(self, wordstream, is_spam):
-        self.probcache = {}    # nuke the prob cache
+        self._invalidate_probcache()
         if is_spam:
             self.nspam += 1
         else:
@@ -365,7 +543,7 @@ class Classifier:
         self._post_training()
 
     def _remove_msg(self, wordstream, is_spam):
-        self.probcache = {}    # nuke the prob cache
+        self._invalidate_probcache()
         if is_spam:
             if self.nspam <= 0:
                 raise ValueError("spam count would go negative!")
@@ -391,6 +569,33 @@ class Classifier:
 
         self._post_training()
 
+    def _invalidate_probcache(self):
+        """Drop the probcache entries that training is about to make stale.
+
+        Training changes nspam or nham, and so the probability of every
+        word seen in both ham and spam.  A word seen only in spam has a
+        raw probability of exactly 1.0, though, and one seen only in ham
+        exactly 0.0, whatever nspam and nham are, so the probabilities
+        for those (which are most of the database) can be kept.  That
+        keeps the cache warm when training and scoring are interleaved.
+        """
+        params = (classifier_options.unknown_word_strength,
+                  classifier_options.unknown_word_prob)
+        cache = self.probcache
+        self.probcache_stats.invalidations += 1
+        if params != self._probcache_params:
+            # Everything depends on these, so start afresh.
+            self._probcache_params = params
+            self.probcache = {}
+            return
+        newcache = {}
+        if 0 in cache:
+            newcache[0] = cache[0]
+        for spamcount, hamprobs in cache.iteritems():
+            if spamcount and 0 in hamprobs:
+                newcache[spamcount] = {0: hamprobs[0]}
+        self.probcache = newcache
+
     def _post_training(self):
         """This is called after training on a wordstream.  Subclasses might
         want to ensure that their databases are in a consistent state at
@@ -405,10 +610,18 @@ class Classifier:
     # the strongest (farthest from 0.5) spamprobs of all tokens in wordstream.
     # Tokens with spamprobs less than minimum_prob_strength away from 0.5
     # aren't returned.
-    def _getclues(self, wordstream):
-        mindist = options["Classifier", "minimum_prob_strength"]
-
-        if options["Classifier", "use_bigrams"]:
+    # If distanceget is given, it is used in place of _worddistanceget to
+    # find the (distance, prob, word, record) tuple for each token.
+    def _getclues(self, wordstream, distanceget=None):
+        mindist = classifier_options.minimum_prob_strength
+        max_discriminators = classifier_options.max_discriminators
+        if not max_discriminators:
+            # Zero has always meant every clue (it used to be clues[-0:]).
+            max_discriminators = sys.maxint
+        if distanceget is None:
+            distanceget = self._worddistanceget
+
+        if classifier_options.use_bigrams:
             # This scheme mixes single tokens with pairs of adjacent tokens.
             # wordstream is "tiled" into non-overlapping unigrams and
             # bigrams.  Non-overlap is important to prevent a single original
@@ -441,13 +654,24 @@ class Classifier:
                 for clue, indices in (token, (i,)), (pair, (i-1, i)):
                     if clue not in seen:    # as always, skip duplicates
                         seen[clue] = 1
-                        tup = self._worddistanceget(clue)
+                        tup = distanceget(clue)
                         if tup[0] >= mindist:
                             push((tup, indices))
 
-            # Sort raw, strongest to weakest spamprob.
-            raw.sort()
-            raw.reverse()
+            # Each token index is covered by at most three entries in raw
+            # (its unigram and the bigrams on either side), so a clue can
+            # overlap at most four others:  the strongest
+            # 5*max_discriminators entries always hold the
+            # max_discriminators strongest non-overlapping clues.  A big
+            # message can have tens of thousands of entries, so pick those
+            # out with a heap rather than sorting all of raw.
+            limit = 5 * max_discriminators
+            if len(raw) > limit:
+                raw = heapq.nlargest(limit, raw)
+            else:
+                # Sort raw, strongest to weakest spamprob.
+                raw.sort()
+                raw.reverse()
             # Fill clues with the strongest non-overlapping clues.
             clues = []
             push = clues.append
@@ -460,6 +684,8 @@ class Classifier:
                     for i in indices:
                         seen[i] = 1
                     push(tup)
+                    if len(clues) == max_discriminators:
+                        break
             # Leave sorted from smallest to largest spamprob.
             clues.reverse()
 
@@ -469,20 +695,26 @@ class Classifier:
             clues = []
             push = clues.append
             for word in set(wordstream):
-                tup = self._worddistanceget(word)
+                tup = distanceget(word)
                 if tup[0] >= mindist:
                     push(tup)
-            clues.sort()
+            if len(clues) > max_discriminators:
+                # Only the strongest are wanted, and a heap finds those
+                # without sorting every clue.
+                clues = heapq.nlargest(max_discriminators, clues)
+                clues.reverse()
+            else:
+                clues.sort()
 
-        if len(clues) > options["Classifier", "max_discriminators"]:
-            del clues[0 : -options["Classifier", "max_discriminators"]]
+        if len(clues) > max_discriminators:
+            del clues[0 : -max_discriminators]
         # Return (prob, word, record).
         return [t[1:] for t in clues]
 
     def _worddistanceget(self, word):
         record = self._wordinfoget(word)
         if record is None:
-            prob = options["Classifier", "unknown_word_prob"]
+            prob = classifier_options.unknown_word_prob
         else:
             prob = self.probability(record)
         distance = abs(prob - 0.5)
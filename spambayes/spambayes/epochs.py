@@ -0,0 +1,230 @@
+"""epochs.py - Score with a classifier while other threads train and store it.
+
+Classes:
+    Epoch - The state of a classifier at one point in its training
+    EpochClassifier - A classifier that can be shared between threads
+
+Abstract:
+    The classifiers in storage.py aren't safe to use from more than one
+    thread:  training changes their records (and nspam and nham) in
+    place, so a message scored during training can see a mixture of old
+    and new counts, and store() can take seconds, during which nothing
+    else should touch the database.
+
+    An EpochClassifier wraps one of them.  Training doesn't change the
+    wrapped classifier; instead, it makes a new Epoch, which holds nspam,
+    nham and the records of the words that have been trained since the
+    last store (new records, never changed ones - copy on write), and
+    then makes that the current epoch (an atomic assignment).  Scoring
+    uses whichever epoch was current when it started, so every message is
+    scored against a consistent set of counts, and words that the epoch
+    doesn't have are looked up in the wrapped classifier, under a lock.
+
+    store() writes the current epoch's records into the wrapped
+    classifier and then stores it.  Training can carry on in the
+    meantime, in newer epochs.  Classifiers whose store() only reads them
+    (such as storage.PickledClassifier, which says so with a false
+    store_blocks_lookups attribute) are stored without holding the lock,
+    so scoring carries on as well; for the others (such as dbm ones),
+    lookups wait until store() has finished, because their databases
+    can't be used by two threads at once.
+
+To Do:
+    o Suggestions?
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import threading
+
+from spambayes import classifier
+
+
+class Epoch(classifier.Classifier):
+    def __init__(self, owner, previous=None):
+        classifier.Classifier.__init__(self)
+        self.WordInfoClass = owner.bayes.WordInfoClass
+        self._owner = owner
+        # Until it is frozen, an epoch can be trained (by the thread that
+        # is making it).
+        self._frozen = False
+        if previous is None:
+            # Map word to WordInfo, or None if the word has been removed.
+            self.changes = {}
+            self.nspam = owner.bayes.nspam
+            self.nham = owner.bayes.nham
+        else:
+            self.changes = previous.changes.copy()
+            self.nspam = previous.nspam
+            self.nham = previous.nham
+            # Training replaces the cache rather than changing it, so it
+            # can be shared until then.
+            self.probcache = previous.probcache
+            self._probcache_params = previous._probcache_params
+
+    def freeze(self):
+        self._frozen = True
+
+    def _invalidate_probcache(self):
+        # Threads scoring with the previous epoch may be adding to the
+        # shared cache, so work from a copy (dict.copy() is atomic).
+        self.probcache = self.probcache.copy()
+        classifier.Classifier._invalidate_probcache(self)
+
+    def _wordinfoget(self, word):
+        try:
+            record = self.changes[word]
+        except KeyError:
+            record = self._owner._lookup(word)
+        if record is not None and not self._frozen:
+            # Training changes the record it gets in place, and this one
+            # may be in use in other epochs.
+            copy = self.WordInfoClass()
+            copy.__setstate__(record.__getstate__())
+            record = copy
+        return record
+
+    def _wordinfoset(self, word, record):
+        if self._frozen:
+            raise TypeError("an epoch can't be changed once it is in use")
+        self.changes[word] = record
+
+    def _wordinfodel(self, word):
+        if self._frozen:
+            raise TypeError("an epoch can't be changed once it is in use")
+        self.changes[word] = None
+
+
+class EpochClassifier(object):
+    def __init__(self, bayes):
+        self.bayes = bayes
+        # Held while the wrapped classifier is in use.
+        self._lock = threading.RLock()
+        # Held while a new epoch is being made, and while storing, so that
+        # there is only one of each at a time.
+        self._train_lock = threading.RLock()
+        self._store_lock = threading.Lock()
+        self.epoch = Epoch(self)
+        self.epoch.freeze()
+
+    def __getattr__(self, att):
+        # Anything else is the wrapped classifier's business.
+        if att == "bayes":
+            raise AttributeError(att)
+        return getattr(self.bayes, att)
+
+    def _get_nspam(self):
+        return self.epoch.nspam
+    nspam = property(_get_nspam)
+
+    def _get_nham(self):
+        return self.epoch.nham
+    nham = property(_get_nham)
+
+    def spamprob(self, wordstream, evidence=False):
+        return self.epoch.spamprob(wordstream, evidence)
+
+    def spamprob_many(self, wordstreams, evidence=False):
+        return self.epoch.spamprob_many(wordstreams, evidence)
+
+    chi2_spamprob = spamprob
+    chi2_spamprob_many = spamprob_many
+
+    def probability(self, record):
+        return self.epoch.probability(record)
+
+    def learn(self, wordstream, is_spam):
+        self._train(classifier.Classifier.learn, wordstream, is_spam)
+
+    def unlearn(self, wordstream, is_spam):
+        self._train(classifier.Classifier.unlearn, wordstream, is_spam)
+
+    def learn_many(self, wordstreams, is_spam):
+        self._train(classifier.Classifier.learn_many, wordstreams, is_spam)
+
+    def _train(self, method, *args):
+        self._train_lock.acquire()
+        try:
+            epoch = Epoch(self, self.epoch)
+            method(epoch, *args)
+            epoch.freeze()
+            self.epoch = epoch
+        finally:
+            self._train_lock.release()
+
+    def _lookup(self, word):
+        self._lock.acquire()
+        try:
+            return self.bayes._wordinfoget(word)
+        finally:
+            self._lock.release()
+
+    def _wordinfoget(self, word):
+        return self.epoch._wordinfoget(word)
+
+    def _wordinfokeys(self):
+        epoch = self.epoch
+        self._lock.acquire()
+        try:
+            keys = set(self.bayes._wordinfokeys())
+        finally:
+            self._lock.release()
+        for word, record in epoch.changes.iteritems():
+            if record is None:
+                keys.discard(word)
+            else:
+                keys.add(word)
+        return list(keys)
+
+    def store(self):
+        '''Write the current epoch into the classifier, and store it'''
+        self._store_lock.acquire()
+        try:
+            epoch = self.epoch
+            self._lock.acquire()
+            try:
+                self._write_epoch(epoch)
+                blocks = getattr(self.bayes, "store_blocks_lookups", True)
+                if blocks:
+                    self.bayes.store()
+            finally:
+                self._lock.release()
+            if not blocks:
+                self.bayes.store()
+
+            # The classifier now has everything in epoch, so the records
+            # that haven't been trained again since can be forgotten.
+            self._train_lock.acquire()
+            try:
+                current = Epoch(self, self.epoch)
+                written = epoch.changes
+                for word, record in current.changes.items():
+                    if word in written and written[word] is record:
+                        del current.changes[word]
+                current.freeze()
+                self.epoch = current
+            finally:
+                self._train_lock.release()
+        finally:
+            self._store_lock.release()
+
+    def _write_epoch(self, epoch):
+        bayes = self.bayes
+        for word, record in epoch.changes.iteritems():
+            if record is not None:
+                bayes._wordinfoset(word, record)
+            elif bayes._wordinfoget(word) is not None:
+                # (The lookup also makes sure that classifiers that cache
+                # records have this one to delete.)
+                bayes._wordinfodel(word)
+        bayes.nspam = epoch.nspam
+        bayes.nham = epoch.nham
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self.bayes.close()
+        finally:
+            self._lock.release()
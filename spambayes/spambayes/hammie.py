@@ -56,6 +56,21 @@ class Hammie:
 
         return self._scoremsg(msg, evidence)
 
+    def score_many(self, msgs, evidence=False):
+        """Score (judge) a batch of messages.
+
+        msgs is a sequence of messages, each of which can be a string, a
+        file object, or a Message object.
+
+        Returns a list with one score per message, exactly as score()
+        would return it.  Scoring the messages together means that tokens
+        shared between them are only looked up once.
+
+        """
+
+        return self.bayes.spamprob_many([tokenize(msg) for msg in msgs],
+                                        evidence)
+
     def score_and_filter(self, msg, header=None, spam_cutoff=None,
                          ham_cutoff=None, debugheader=None,
                          debug=None, train=None):
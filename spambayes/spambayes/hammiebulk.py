@@ -92,15 +92,35 @@ def untrain(h, msgs, is_spam):
     sys.stdout.flush()
     print
 
+# Number of messages scored together by score().
+SCORE_BATCH_SIZE = 100
+
+def _batches(iterable, size):
+    """Yield lists of up to size consecutive items from iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _scored(h, mbox):
+    """Yield (msg, (prob, clues)) for each message in mbox, scoring the
+    messages in batches."""
+    for batch in _batches(mbox, SCORE_BATCH_SIZE):
+        for msg, result in zip(batch, h.score_many(batch, True)):
+            yield msg, result
+
 def score(h, msgs, reverse=0):
     """Score (judge) all messages from a mailbox."""
     # XXX The reporting needs work!
     mbox = mboxutils.getmbox(msgs)
     i = 0
     spams = hams = unsures = 0
-    for msg in mbox:
+    for msg, (prob, clues) in _scored(h, mbox):
         i += 1
-        prob, clues = h.score(msg, True)
         if hasattr(msg, '_mh_msgno'):
             msgno = msg._mh_msgno
         else:
@@ -0,0 +1,180 @@
+"""lrucache.py - Bounded caches that discard the least recently used entry.
+
+Classes:
+    CacheStats - Hit, miss, eviction and invalidation counters for a cache
+    LRUCache - A mapping that holds at most a fixed number of entries
+
+Abstract:
+    LRUCache keeps its entries on a circular doubly-linked list, most
+    recently used first, alongside a dictionary mapping each key to its
+    link, so that lookups, insertions and evictions all take constant
+    time.  It deliberately implements only the handful of mapping methods
+    that caches need.
+
+    LRUCache only counts evictions (in the CacheStats it is given, if
+    any), since only it knows when they happen; callers that want other
+    statistics keep the CacheStats up to date themselves, since only they
+    know whether a miss in the cache was really a miss (the value might
+    be fetched from somewhere slower and then added).
+
+    An entry can be "pinned" (for example, a value that has been changed
+    but not yet saved), and then it is never evicted until unpin_all() is
+    called.  Pinned entries are kept in a separate dictionary rather than
+    on the list, so that eviction never has to step over them.  They
+    still count towards the size, so the cache grows past its size,
+    rather than evicting anything, if they fill it.
+
+To Do:
+    o Suggestions?
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+# The fields of a link.
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class CacheStats(object):
+    # These live in a separate object rather than as attributes of the
+    # cache's owner, because a ZODB classifier (for example) would
+    # otherwise be marked as changed by every lookup.
+    __slots__ = 'hits', 'misses', 'evictions', 'invalidations'
+
+    def __init__(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def __repr__(self):
+        return "%s(hits=%d, misses=%d, evictions=%d, invalidations=%d)" % \
+               (self.__class__.__name__, self.hits, self.misses,
+                self.evictions, self.invalidations)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            return float(self.hits) / lookups
+        return 0.0
+
+
+class LRUCache(object):
+    def __init__(self, size, stats=None):
+        if size < 1:
+            raise ValueError("LRUCache size must be at least 1")
+        self.size = size
+        self.stats = stats
+        self.clear()
+
+    def clear(self):
+        # The root is a sentinel: root[NEXT] is the most recently used
+        # link and root[PREV] the least recently used.
+        root = []
+        root[:] = [root, root, None, None]
+        self._root = root
+        self._links = {}
+        # Maps each pinned key to its value.
+        self._pinned = {}
+
+    def __len__(self):
+        return len(self._links) + len(self._pinned)
+
+    def __contains__(self, key):
+        # Doesn't count as a use.
+        return key in self._links or key in self._pinned
+    has_key = __contains__
+
+    def keys(self):
+        return self._links.keys() + self._pinned.keys()
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return self._pinned.get(key, default)
+        self._move_to_front(link)
+        return link[VALUE]
+
+    def __getitem__(self, key):
+        link = self._links.get(key)
+        if link is None:
+            return self._pinned[key]
+        self._move_to_front(link)
+        return link[VALUE]
+
+    def __setitem__(self, key, value):
+        if key in self._pinned:
+            self._pinned[key] = value
+            return
+        link = self._links.get(key)
+        if link is not None:
+            link[VALUE] = value
+            self._move_to_front(link)
+            return
+        # There may be more than one entry to evict, if the cache grew
+        # while entries were pinned.
+        while len(self) >= self.size and self._evict():
+            pass
+        self._insert(key, value)
+
+    def __delitem__(self, key):
+        if key in self._pinned:
+            del self._pinned[key]
+            return
+        link = self._links.pop(key)
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def pin(self, key):
+        """Stop the entry for key being evicted, until unpin_all()."""
+        if key in self._pinned:
+            return
+        value = self[key]
+        del self[key]
+        self._pinned[key] = value
+
+    def unpin_all(self):
+        """Let every pinned entry be evicted again, as the most recently
+        used ones."""
+        pinned = self._pinned
+        self._pinned = {}
+        for key, value in pinned.iteritems():
+            self._insert(key, value)
+        # If this leaves the cache bigger than its size, it shrinks back
+        # the next time something is added.
+
+    def popitem(self):
+        """Remove and return the least recently used (key, value) pair
+        that isn't pinned."""
+        link = self._root[PREV]
+        if link is self._root:
+            raise KeyError("popitem(): cache is empty")
+        del self[link[KEY]]
+        return link[KEY], link[VALUE]
+
+    def _insert(self, key, value):
+        root = self._root
+        first = root[NEXT]
+        link = [root, first, key, value]
+        first[PREV] = root[NEXT] = link
+        self._links[key] = link
+
+    def _evict(self):
+        # Discard the least recently used entry that isn't pinned (none of
+        # those on the list are), and return whether there was one.
+        link = self._root[PREV]
+        if link is self._root:
+            return False
+        del self[link[KEY]]
+        if self.stats is not None:
+            self.stats.evictions += 1
+        return True
+
+    def _move_to_front(self, link):
+        root = self._root
+        if root[NEXT] is link:
+            return
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        first = root[NEXT]
+        link[PREV] = root
+        link[NEXT] = first
+        first[PREV] = root[NEXT] = link
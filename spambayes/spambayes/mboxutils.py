@@ -16,6 +16,17 @@ mailbox type given a mailbox argument.
 /foo/Mail/bar/ -- (existing directory with /Mail/ in its path)
              alternative way of spelling an MH mailbox
 
+getmbox() reads Unix-style mailboxes a message at a time, which is safe
+even if the mailbox is changed while it is being read.  A program that
+reads a mailbox that nothing else is changing (such as a saved corpus)
+can instead use MmapMailbox, which reads it through mmap, using an index
+of where each message starts (MboxIndex), and can also get messages by
+number and split a mailbox into shards (for example, one for each of
+several processes).  The index can be kept in a file next to the mailbox
+(the mailbox's name plus INDEX_SUFFIX) so that it only has to be worked
+out once, however many times the mailbox is read; since mail programs
+may take that file for another mailbox, it is only written when asked.
+
 """
 
 from __future__ import generators
@@ -23,11 +34,13 @@ from __future__ import generators
 import os
 import sys
 import glob
+import mmap
 import email
 import mailbox
 import email.Message
 import re
 import traceback
+import cPickle as pickle
 
 class DirOfTxtFileMailbox:
     """Directory of files each assumed to contain an RFC-822 message.
@@ -65,6 +78,165 @@ class DirOfTxtFileMailbox:
                 yield self.factory(f)
                 f.close()
 
+INDEX_SUFFIX = ".sbindex"
+INDEX_VERSION = 1
+
+class MboxIndex:
+    """The offset and length of each message in a Unix-style mailbox.
+
+    Messages are split the way mailbox.PortableUnixMailbox splits them:
+    each one starts at a line beginning "From ".  If save is true, the
+    offsets are saved in a file next to the mailbox, which is used for as
+    long as the mailbox has the same size and modification time.
+    """
+
+    def __init__(self, name, save=False):
+        self.name = name
+        st = os.stat(name)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.offsets = self._load()
+        if self.offsets is None:
+            self.offsets = self._scan()
+            if save:
+                self._save()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        """Return the (offset, length) of message i."""
+        if i < 0:
+            i += len(self.offsets)
+        if not 0 <= i < len(self.offsets):
+            raise IndexError(i)
+        offset = self.offsets[i]
+        if i + 1 < len(self.offsets):
+            return offset, self.offsets[i + 1] - offset
+        return offset, self.size - offset
+
+    def _scan(self):
+        offsets = []
+        if not self.size:
+            # (An empty file can't be mapped.)
+            return offsets
+        f = open(self.name, "rb")
+        try:
+            mm = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            try:
+                if mm[:5] == "From ":
+                    offsets.append(0)
+                pos = mm.find("\nFrom ")
+                while pos != -1:
+                    offsets.append(pos + 1)
+                    pos = mm.find("\nFrom ", pos + 1)
+            finally:
+                mm.close()
+        finally:
+            f.close()
+        return offsets
+
+    def _load(self):
+        try:
+            f = open(self.name + INDEX_SUFFIX, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                version, size, mtime, offsets = pickle.load(f)
+            except Exception:
+                # A damaged index is just made again.
+                return None
+        finally:
+            f.close()
+        if (version, size, mtime) != (INDEX_VERSION, self.size, self.mtime):
+            return None
+        return offsets
+
+    def _save(self):
+        index_name = self.name + INDEX_SUFFIX
+        tmp = index_name + ".tmp"
+        try:
+            f = open(tmp, "wb")
+            try:
+                pickle.dump((INDEX_VERSION, self.size, self.mtime,
+                             self.offsets), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            if os.path.exists(index_name):
+                # (Windows can't rename over an existing file.)
+                os.remove(index_name)
+            os.rename(tmp, index_name)
+        except EnvironmentError:
+            # The index is only there to save time, so it doesn't matter
+            # if it can't be written (in a read-only directory, say).
+            pass
+
+class MmapMailbox:
+    """A Unix-style mailbox, read through mmap.
+
+    Iterating over it gives factory(text) for each message, where text
+    is the message (with its "From " line); by default, the text itself.
+    Messages can also be got by number, and shard() returns part of the
+    mailbox.  An MboxIndex is made (but not saved) if one isn't given.
+
+    The mailbox must not be shortened while it is open: reading a part of
+    the mapping that is no longer in the file kills the process (with
+    SIGBUS), which can't be caught.  So this is for mailboxes that nothing
+    else is changing, not a user's live mail.
+    """
+
+    def __init__(self, name, factory=None, index=None, start=0, stop=None):
+        if index is None:
+            index = MboxIndex(name)
+        if stop is None:
+            stop = len(index)
+        self.name = name
+        self.factory = factory
+        self.index = index
+        self.start = start
+        self.stop = stop
+        self.mm = None
+        if index.size:
+            f = open(name, "rb")
+            try:
+                self.mm = mmap.mmap(f.fileno(), index.size,
+                                    access=mmap.ACCESS_READ)
+            finally:
+                # (The mapping stays open without the file.)
+                f.close()
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        offset, length = self.index[self.start + i]
+        text = self.mm[offset:offset + length]
+        if self.factory is None:
+            return text
+        return self.factory(text)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def shard(self, i, n):
+        """Return the i'th of n (contiguous, nearly equal) parts of this
+        mailbox, numbering from zero."""
+        size = len(self)
+        return MmapMailbox(self.name, self.factory, self.index,
+                           self.start + size * i // n,
+                           self.start + size * (i + 1) // n)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
 def full_messages(msgs):
     """A generator that transforms each message by calling its
     get_full_message() method.  Used for IMAP messages since they don't really
@@ -148,6 +320,8 @@ def getmbox(name):
         else:
             mbox = DirOfTxtFileMailbox(name, get_message)
     else:
+        # Not an MmapMailbox, since the mailbox may be a live one that
+        # another program changes while we read it.
         fp = open(name, "rb")
         mbox = mailbox.PortableUnixMailbox(fp, get_message)
     return iter(mbox)
@@ -104,6 +104,7 @@ CRLF_RE = re.compile(r'\r\n|\r|\n')
 
 STATS_START_KEY = "Statistics start date"
 STATS_STORAGE_KEY = "Persistent statistics"
+STATS_DAILY_KEY = "Daily statistics"
 PERSISTENT_HAM_STRING = 'h'
 PERSISTENT_SPAM_STRING = 's'
 PERSISTENT_UNSURE_STRING = 'u'
@@ -131,10 +132,18 @@ class MessageInfoBase(object):
         else:
             return None
             
-    def set_persistent_statistics(self, stats):
+    def set_persistent_statistics(self, stats, daily=None):
         self.db[STATS_STORAGE_KEY] = stats
+        if daily is not None:
+            self.db[STATS_DAILY_KEY] = daily
         self.store()
 
+    def get_daily_statistics(self):
+        if self.db.has_key(STATS_DAILY_KEY):
+            return self.db[STATS_DAILY_KEY]
+        else:
+            return None
+
     def __getstate__(self):
         return self.db
 
@@ -402,6 +411,9 @@ class Message(object, email.Message.Message):
         if id == STATS_STORAGE_KEY:
             raise ValueError, "MsgId must not be " + STATS_STORAGE_KEY
 
+        if id == STATS_DAILY_KEY:
+            raise ValueError, "MsgId must not be " + STATS_DAILY_KEY
+
         self.id = id
         self.message_info_db.load_msg(self)
 
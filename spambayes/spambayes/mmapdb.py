@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+"""
+A read-only hashed token database that is looked up through mmap.
+
+The whole file is mapped into memory and looked up in place, so opening
+a database costs nothing however large it is, and every process that has
+the same database open shares a single copy of it in the page cache.
+
+File layout (all integers are unsigned 32 bit little-endian):
+
+    header:   magic "SBMM", version, nspam, nham, nrecords, nslots
+    table:    nslots (hash, offset) pairs; offset 0 marks an empty slot.
+              nslots is a power of two, at least twice nrecords, and
+              collisions are resolved by linear probing.
+    records:  (spamcount, hamcount, keylength) followed by the key bytes.
+
+The hash is zlib.crc32 of the key, which is quick (it's done in C) and
+the same on every platform.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+from array import array
+
+MAGIC = "SBMM"
+VERSION = 1
+
+HEADER = struct.Struct("<4sLLLLL")
+SLOT = struct.Struct("<LL")
+RECORD = struct.Struct("<LLL")
+
+MINSLOTS = 8
+
+def mmapdb_hash(key):
+    return zlib.crc32(key) & 0xffffffffL
+
+class MmapDB(object):
+    def __init__(self, fp):
+        self.fp = fp
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        (magic, version, self.nspam, self.nham, self.nrecords,
+         self.nslots) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("Not a SpamBayes mmap database")
+        if version != VERSION:
+            self.close()
+            raise ValueError("Can't read mmap database -- version %s "
+                             "unknown" % (version,))
+        self.mask = self.nslots - 1
+        self.records_start = HEADER.size + self.nslots * SLOT.size
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    def get(self, key, default=None):
+        """Return (spamcount, hamcount) for key, or default."""
+        themap = self.map
+        h = mmapdb_hash(key)
+        i = h & self.mask
+        unpack_slot = SLOT.unpack_from
+        while True:
+            slot_hash, pos = unpack_slot(themap, HEADER.size + i * SLOT.size)
+            if not pos:
+                return default
+            if slot_hash == h:
+                spamcount, hamcount, klen = RECORD.unpack_from(themap, pos)
+                start = pos + RECORD.size
+                if klen == len(key) and themap[start:start+klen] == key:
+                    return spamcount, hamcount
+            i = (i + 1) & self.mask
+
+    def __iter__(self):
+        """Yield (key, spamcount, hamcount) for every record."""
+        themap = self.map
+        pos = self.records_start
+        for i in xrange(self.nrecords):
+            spamcount, hamcount, klen = RECORD.unpack_from(themap, pos)
+            pos += RECORD.size
+            yield themap[pos:pos+klen], spamcount, hamcount
+            pos += klen
+
+    def keys(self):
+        return [key for key, _spamcount, _hamcount in self]
+
+
+def mmapdb_make(outfile, nspam, nham, items):
+    """Write a database to the file object outfile.
+
+    items is an iterable of (key, spamcount, hamcount) triples; the keys
+    must be (byte) strings, and must be unique.
+    """
+    items = list(items)
+    nslots = MINSLOTS
+    while nslots < 2 * len(items):
+        nslots <<= 1
+    mask = nslots - 1
+
+    # Work out where each record will go, and build the table.
+    table = array('L', [0]) * (2 * nslots)
+    pos = HEADER.size + nslots * SLOT.size
+    for key, spamcount, hamcount in items:
+        h = mmapdb_hash(key)
+        i = h & mask
+        while table[2*i+1]:
+            i = (i + 1) & mask
+        table[2*i] = h
+        table[2*i+1] = pos
+        pos += RECORD.size + len(key)
+
+    outfile.write(HEADER.pack(MAGIC, VERSION, nspam, nham, len(items),
+                              nslots))
+    outfile.write("".join([SLOT.pack(table[i], table[i+1])
+                           for i in xrange(0, len(table), 2)]))
+    write = outfile.write
+    for key, spamcount, hamcount in items:
+        write(RECORD.pack(spamcount, hamcount, len(key)))
+        write(key)
+
+
+def test():
+    db = open('test.mmdb', 'wb')
+    mmapdb_make(db, 2, 1, [('one', 1, 0), ('two', 2, 1), ('us', 0, 1)])
+    db.close()
+    db = MmapDB(open('test.mmdb', 'rb'))
+    print db.nspam, db.nham
+    print db.get('one')
+    print db.get('two')
+    print db.get('us')
+    print db.get('notthere')
+    print list(db)
+    db.close()
+    os.remove('test.mmdb')
+
+if __name__ == '__main__':
+    test()
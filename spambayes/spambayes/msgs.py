@@ -1,9 +1,18 @@
 from __future__ import generators
 
 import os
+import zlib
+import mmap
+import array
+import atexit
 import random
+import marshal
+import cPickle as pickle
+from hashlib import md5
 
+from spambayes import tokenizer
 from spambayes.tokenizer import tokenize
+from spambayes.Options import options, get_pathname_option
 
 HAMTEST  = None
 SPAMTEST = None
@@ -11,18 +20,265 @@ HAMTRAIN  = None
 SPAMTRAIN = None
 SEED = random.randrange(2000000000)
 
+# A Set directory can be packed into a single data file (the directory's
+# name plus PACK_SUFFIX) and an index (that plus INDEX_SUFFIX); see
+# testtools/packsets.py.  Reading 100k small files is mostly spent in
+# the filesystem, opening them, rather than in reading them.
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+PACK_VERSION = 1
+
+class MsgPack(object):
+    """The messages in a packed Set directory.
+
+    The index is a pickled (version, entries) pair, where entries lists
+    (name, offset, length, compressed) for each message, in the order
+    that os.listdir() gave them when the directory was packed (so that
+    the 'keep' sampling picks the same messages from either).  The data
+    file is read through mmap, so a pack can be shared by forked
+    processes without them moving each other's file position.
+    """
+    def __init__(self, path):
+        f = open(path + INDEX_SUFFIX, 'rb')
+        try:
+            version, entries = pickle.load(f)
+        finally:
+            f.close()
+        if version != PACK_VERSION:
+            raise ValueError("%s is a version %s pack, not version %s" %
+                             (path, version, PACK_VERSION))
+        self.path = path
+        self.entries = {}
+        self.names = []
+        for entry in entries:
+            self.entries[entry[0]] = entry[1:]
+            self.names.append(entry[0])
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                self.data = mmap.mmap(f.fileno(), size,
+                                      access=mmap.ACCESS_READ)
+            else:
+                self.data = ""
+        finally:
+            f.close()
+
+    def listdir(self):
+        return self.names[:]
+
+    def read(self, name):
+        offset, length, compressed = self.entries[name]
+        guts = self.data[offset:offset+length]
+        if compressed:
+            guts = zlib.decompress(guts)
+        return guts
+
+def write_pack(directory, path=None, compress=False):
+    """Pack the messages in directory into path (by default, the
+    directory's name plus PACK_SUFFIX) and its index.  If compress is
+    true, messages that zlib makes smaller are stored compressed.
+    Return the number of messages packed."""
+    if path is None:
+        path = directory.rstrip("/" + os.sep) + PACK_SUFFIX
+    entries = []
+    offset = 0
+    data = open(path + ".tmp", 'wb')
+    try:
+        for name in os.listdir(directory):
+            f = open(os.path.join(directory, name), 'rb')
+            guts = f.read()
+            f.close()
+            compressed = False
+            if compress:
+                packed = zlib.compress(guts)
+                if len(packed) < len(guts):
+                    guts = packed
+                    compressed = True
+            data.write(guts)
+            entries.append((name, offset, len(guts), compressed))
+            offset += len(guts)
+    finally:
+        data.close()
+    index = open(path + INDEX_SUFFIX + ".tmp", 'wb')
+    try:
+        pickle.dump((PACK_VERSION, entries), index, pickle.HIGHEST_PROTOCOL)
+    finally:
+        index.close()
+    for name in (path, path + INDEX_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+        os.rename(name + ".tmp", name)
+    return len(entries)
+
+# Map each directory to its MsgPack, or None if it isn't packed.
+_packs = {}
+
+def get_pack(directory):
+    """Return the MsgPack for directory, or None if it should be read as
+    a directory.  A directory is packed if its name ends in PACK_SUFFIX,
+    or if it doesn't exist, but a pack of it does."""
+    try:
+        return _packs[directory]
+    except KeyError:
+        pass
+    pack = None
+    if directory.endswith(PACK_SUFFIX):
+        pack = MsgPack(directory)
+    elif not os.path.isdir(directory) and \
+             os.path.exists(directory + PACK_SUFFIX):
+        pack = MsgPack(directory + PACK_SUFFIX)
+    _packs[directory] = pack
+    return pack
+
+def listdir(directory):
+    """Return the names of the messages in directory, which may be
+    packed."""
+    pack = get_pack(directory)
+    if pack is None:
+        return os.listdir(directory)
+    return pack.listdir()
+
+class CorpusTokenCache(object):
+    """The tokens of the messages in a corpus, kept in a file between runs.
+
+    Messages are looked up by tag (their path), and their cached tokens
+    are only used if the MD5 digest of their text hasn't changed.  Each
+    distinct token is stored once, in a vocabulary, and each message's
+    tokens as an array of indexes into that, which keeps the file small
+    and quick to load (with marshal).  If any tokenizer option changes,
+    the cache is emptied (and the file replaced when it is saved).
+    """
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._options = tokenizer.token_options()
+        self.fingerprint = self._fingerprint()
+        self.vocab = []
+        # Maps each token to its index in vocab; only built once a
+        # message has to be added.
+        self.ids = None
+        # Maps each tag to (digest, string of an array of indexes).
+        self.entries = {}
+        self.changed = False
+        self.hits = self.misses = 0
+        self._load()
+        atexit.register(self.close)
+
+    def _fingerprint(self):
+        return tuple([opt.get() for opt in self._options])
+
+    def _load(self):
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                version, fingerprint, vocab, entries = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                self.changed = True
+                return
+        finally:
+            f.close()
+        if version != self.VERSION or fingerprint != repr(self.fingerprint):
+            self.changed = True
+            return
+        self.vocab = vocab
+        self.entries = entries
+
+    def clear(self):
+        self.vocab = []
+        self.ids = None
+        self.entries = {}
+        self.changed = True
+
+    def get_tokens(self, msg):
+        """Return a list of msg's tokens, tokenizing it if necessary."""
+        fingerprint = self._fingerprint()
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.clear()
+        digest = md5(msg.guts).digest()
+        entry = self.entries.get(msg.tag)
+        if entry is not None and entry[0] == digest:
+            self.hits += 1
+            return map(self.vocab.__getitem__, array.array('i', entry[1]))
+        self.misses += 1
+        tokens = list(tokenize(msg.guts))
+        ids = self.ids
+        if ids is None:
+            ids = self.ids = dict(zip(self.vocab, xrange(len(self.vocab))))
+        vocab = self.vocab
+        indexes = array.array('i')
+        for token in tokens:
+            i = ids.get(token)
+            if i is None:
+                if isinstance(token, str):
+                    token = intern(token)
+                i = ids[token] = len(vocab)
+                vocab.append(token)
+            indexes.append(i)
+        self.entries[msg.tag] = digest, indexes.tostring()
+        self.changed = True
+        return tokens
+
+    def close(self):
+        """Save the cache, if anything has changed."""
+        if not self.changed:
+            return
+        tmp = self.filename + ".tmp"
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump((self.VERSION, repr(self.fingerprint), self.vocab,
+                          self.entries), f)
+        finally:
+            f.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmp, self.filename)
+        self.changed = False
+
+# The CorpusTokenCache in use, and the option value it was opened for.
+_token_cache = None
+_token_cache_option = None
+
+def get_token_cache():
+    """Return the CorpusTokenCache named by the [TestDriver]
+    token_cache_file option, or None if that is empty."""
+    global _token_cache, _token_cache_option
+    filename = options["TestDriver", "token_cache_file"]
+    if not filename:
+        return None
+    if _token_cache is None or _token_cache_option != filename:
+        if _token_cache is not None:
+            _token_cache.close()
+        path = get_pathname_option("TestDriver", "token_cache_file")
+        _token_cache = CorpusTokenCache(path)
+        _token_cache_option = filename
+    return _token_cache
+
 class Msg(object):
     __slots__ = 'tag', 'guts'
 
     def __init__(self, dir, name):
         path = dir + "/" + name
         self.tag = path
+        pack = get_pack(dir)
+        if pack is not None:
+            self.guts = pack.read(name)
+            return
         f = open(path, 'rb')
         self.guts = f.read()
         f.close()
 
     def __iter__(self):
-        return tokenize(self.guts)
+        cache = get_token_cache()
+        # Slurping needs the message tokenized (see Tokenizer.tokenize).
+        if cache is None or options["URLRetriever", "x-slurp_urls"]:
+            return tokenize(self.guts)
+        return iter(cache.get_tokens(self))
 
     # Compare msgs by their paths; this is appropriate for sets of msgs.
     def __hash__(self):
@@ -41,7 +297,7 @@ class Msg(object):
         self.tag, self.guts = s
 
 # The iterator yields a stream of Msg objects, taken from a list of
-# directories.
+# directories (any of which may be packed).
 class MsgStream(object):
     __slots__ = 'tag', 'directories', 'keep'
 
@@ -56,14 +312,14 @@ class MsgStream(object):
     def produce(self):
         if self.keep is None:
             for directory in self.directories:
-                for fname in os.listdir(directory):
+                for fname in listdir(directory):
                     yield Msg(directory, fname)
             return
         # We only want part of the msgs.  Shuffle each directory list, but
         # in such a way that we'll get the same result each time this is
         # called on the same directory list.
         for directory in self.directories:
-            all = os.listdir(directory)
+            all = listdir(directory)
             random.seed(hash(max(all)) ^ SEED) # reproducible across calls
             random.shuffle(all)
             del all[self.keep:]
@@ -0,0 +1,288 @@
+"""packedwordinfo.py - A compact replacement for the wordinfo dictionary.
+
+Classes:
+    PackedWordInfo - Mapping of token to WordInfo, stored in flat arrays
+
+Abstract:
+    A classifier's wordinfo is normally a dictionary mapping each token
+    to a WordInfo instance.  Even with __slots__, that costs a string
+    object, a WordInfo object, (often) two int objects and a dictionary
+    slot for every token, which adds up to well over a hundred bytes per
+    token.  Large databases have millions of tokens.
+
+    PackedWordInfo keeps the same information in a handful of flat
+    buffers:  the token strings are concatenated into a single
+    bytearray, the spam and ham counts live in parallel array('I')
+    objects, and an open-addressing hash table of array('i') slots maps
+    tokens to their position in those arrays.  That comes to around
+    twenty bytes plus the length of the token for each entry.  The table
+    is hashed with zlib.crc32 rather than the builtin hash(), which
+    differs between builds (and with -R), and the arrays are pickled
+    along with the byte order and item size of the machine that wrote
+    them (and converted if need be), so that a pickle is still right
+    wherever it is loaded.
+
+    WordInfo records are only created when a token is looked up, and are
+    copies:  changing one has no effect until it is handed back via
+    __setitem__ (which is what Classifier._wordinfoset does, so the
+    classifier contract is unchanged).
+
+    Tokens are stored as UTF-8 encoded strings, so unicode tokens come
+    back as (encoded) strings, as they do from a DBDictClassifier.
+
+To Do:
+    o Suggestions?
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import zlib
+from array import array
+from UserDict import DictMixin
+
+from spambayes.classifier import WordInfo
+
+# Values for the hash table slots that don't point at an entry.
+EMPTY = -1
+DELETED = -2
+
+MINSIZE = 8
+
+# Pickled along with the table, which is rebuilt when loading a pickle
+# without it (one whose table was made with the builtin hash()).
+TABLE_VERSION = 1
+
+# Typecodes of the same signedness, for reading arrays pickled on a
+# machine whose ints are another size.
+SAME_SIGN = {'I': 'IHL', 'i': 'ihl'}
+
+def packed_hash(word):
+    return zlib.crc32(word) & 0xffffffffL
+
+def load_array(typecode, data, byteorder, itemsize):
+    """Return an array of typecode holding data, which was made by
+    tostring() on a machine with the given byte order and item size."""
+    for code in SAME_SIGN[typecode]:
+        if array(code).itemsize == itemsize:
+            break
+    else:
+        raise ValueError("no array typecode has itemsize %d" % (itemsize,))
+    a = array(code)
+    a.fromstring(data)
+    if byteorder != sys.byteorder:
+        a.byteswap()
+    if code != typecode:
+        a = array(typecode, a)
+    return a
+
+class PackedWordInfo(DictMixin):
+    def __init__(self, initial=None, WordInfoClass=WordInfo):
+        self.WordInfoClass = WordInfoClass
+        self._clear()
+        if initial is not None:
+            self.update(initial)
+
+    def _clear(self, size=MINSIZE):
+        # Entry i is the token self._blob[offsets[i]:offsets[i+1]]; the
+        # offsets array always has one more element than there are
+        # entries.  Entries of deleted tokens stay in the arrays (with
+        # zero counts) until the next resize.
+        self._blob = bytearray()
+        self._offsets = array('I', [0])
+        self._spamcounts = array('I')
+        self._hamcounts = array('I')
+        self._table = array('i', [EMPTY]) * size
+        self._len = 0      # number of live tokens
+        self._fill = 0     # number of table slots that aren't EMPTY
+
+    def _lookup(self, word):
+        """Return (slot, entry) for word.
+
+        entry is the index of word in the parallel arrays, or None if it
+        isn't present; in that case slot is where it should be inserted.
+        """
+        table = self._table
+        offsets = self._offsets
+        blob = self._blob
+        mask = len(table) - 1
+        perturb = h = packed_hash(word)
+        i = h & mask
+        freeslot = None
+        while True:
+            entry = table[i]
+            if entry == EMPTY:
+                if freeslot is None:
+                    freeslot = i
+                return freeslot, None
+            if entry == DELETED:
+                if freeslot is None:
+                    freeslot = i
+            elif blob[offsets[entry]:offsets[entry+1]] == word:
+                return i, entry
+            # Same probe sequence as the builtin dict.
+            i = (i * 5 + 1 + perturb) & mask
+            perturb >>= 5
+
+    def _resize(self):
+        """Rebuild the table and arrays, dropping deleted entries."""
+        self._rebuild(list(self._iteritems()))
+
+    def _rebuild(self, items):
+        """Replace the contents with items, a list of (word, spamcount,
+        hamcount)."""
+        size = MINSIZE
+        while size * 2 <= len(items) * 3:
+            size <<= 1
+        self._clear(size * 2)
+        for word, spamcount, hamcount in items:
+            self._insert(word, spamcount, hamcount)
+
+    def _insert(self, word, spamcount, hamcount):
+        slot, entry = self._lookup(word)
+        if entry is None:
+            if self._table[slot] == EMPTY:
+                self._fill += 1
+            entry = len(self._spamcounts)
+            self._blob.extend(word)
+            self._offsets.append(len(self._blob))
+            self._spamcounts.append(spamcount)
+            self._hamcounts.append(hamcount)
+            self._table[slot] = entry
+            self._len += 1
+            # Keep the table at most two thirds full, like the builtin
+            # dict, so that probe sequences stay short, and don't let the
+            # entries of deleted tokens pile up in the arrays.
+            if self._fill * 3 >= len(self._table) * 2 or \
+               entry >= 2 * self._len + MINSIZE:
+                self._resize()
+        else:
+            self._spamcounts[entry] = spamcount
+            self._hamcounts[entry] = hamcount
+
+    def _iteritems(self):
+        """Yield (word, spamcount, hamcount) for each live token."""
+        blob = self._blob
+        offsets = self._offsets
+        hamcounts = self._hamcounts
+        for entry in self._table:
+            if entry >= 0:
+                yield (str(blob[offsets[entry]:offsets[entry+1]]),
+                       self._spamcounts[entry], hamcounts[entry])
+
+    def _record(self, entry):
+        record = self.WordInfoClass()
+        record.__setstate__((self._spamcounts[entry],
+                             self._hamcounts[entry]))
+        return record
+
+    def get(self, word, default=None):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        entry = self._lookup(word)[1]
+        if entry is None:
+            return default
+        return self._record(entry)
+
+    def __getitem__(self, word):
+        record = self.get(word)
+        if record is None:
+            raise KeyError(word)
+        return record
+
+    def __setitem__(self, word, record):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        self._insert(word, record.spamcount, record.hamcount)
+
+    def __delitem__(self, word):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        slot, entry = self._lookup(word)
+        if entry is None:
+            raise KeyError(word)
+        self._table[slot] = DELETED
+        self._spamcounts[entry] = self._hamcounts[entry] = 0
+        self._len -= 1
+
+    def __contains__(self, word):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        return self._lookup(word)[1] is not None
+    has_key = __contains__
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for word, _spamcount, _hamcount in self._iteritems():
+            yield word
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        WordInfoClass = self.WordInfoClass
+        for word, spamcount, hamcount in self._iteritems():
+            record = WordInfoClass()
+            record.__setstate__((spamcount, hamcount))
+            yield word, record
+
+    def clear(self):
+        self._clear()
+
+    def memory_usage(self):
+        """Return the approximate number of bytes used by the buffers."""
+        total = len(self._blob)
+        for a in (self._offsets, self._spamcounts, self._hamcounts,
+                  self._table):
+            total += a.itemsize * len(a)
+        return total
+
+    # Pickle the buffers directly, which is much smaller and quicker than
+    # pickling a dictionary of WordInfo instances.
+    def __getstate__(self):
+        packed = self
+        if len(self._spamcounts) != self._len:
+            # Leave out the deleted entries, without changing this table
+            # (which may be in use).
+            packed = PackedWordInfo(None, self.WordInfoClass)
+            packed._rebuild(list(self._iteritems()))
+        return (self.WordInfoClass, str(packed._blob),
+                packed._offsets.tostring(), packed._spamcounts.tostring(),
+                packed._hamcounts.tostring(), packed._table.tostring(),
+                TABLE_VERSION, sys.byteorder, packed._table.itemsize)
+
+    def __setstate__(self, state):
+        self.WordInfoClass = state[0]
+        self._blob = bytearray(state[1])
+        # Pickles from before the byte order was saved were made here.
+        byteorder, itemsize = state[7:] or (sys.byteorder,
+                                            array('i').itemsize)
+        for name, typecode, data in zip(("_offsets", "_spamcounts",
+                                         "_hamcounts", "_table"),
+                                        "IIIi", state[2:6]):
+            setattr(self, name, load_array(typecode, data, byteorder,
+                                           itemsize))
+        self._len = self._fill = len(self._spamcounts)
+        if state[6:7] != (TABLE_VERSION,):
+            self._resize()
+
+
+def dict_memory_usage(wordinfo):
+    """Return the approximate number of bytes used by a wordinfo dictionary
+    (the dictionary itself, plus the keys, WordInfo records and counts).
+
+    This is intended for comparison with PackedWordInfo.memory_usage().
+    """
+    total = sys.getsizeof(wordinfo)
+    for word, record in wordinfo.iteritems():
+        total += sys.getsizeof(word) + sys.getsizeof(record)
+        for count in record.__getstate__():
+            # Python shares the objects for small ints.
+            if count > 256:
+                total += sys.getsizeof(count)
+    return total
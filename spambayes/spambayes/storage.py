@@ -4,10 +4,12 @@
 
 Classes:
     PickledClassifier - Classifier that uses a pickle db
+    PackedPickledClassifier - PickledClassifier with a compact wordinfo
     DBDictClassifier - Classifier that uses a shelve db
     PGClassifier - Classifier that uses postgres
     mySQLClassifier - Classifier that uses mySQL
     CBDClassifier - Classifier that uses CDB
+    MmapClassifier - Classifier that uses an mmap'ed hash file
     ZODBClassifier - Classifier that uses ZODB
     ZEOClassifier - Classifier that uses ZEO
     Trainer - Classifier training observer
@@ -22,10 +24,24 @@ Abstract:
 
     PickledClassifier is a Classifier class that uses a cPickle
     datastore.  This database is relatively small, but slower than other
-    databases.
+    databases.  It can keep a journal of the changes made since the
+    pickle was last written, so that storing after training a few
+    messages doesn't mean writing the whole database.
+
+    PackedPickledClassifier is a PickledClassifier that keeps its
+    wordinfo in a packedwordinfo.PackedWordInfo rather than a dictionary,
+    which uses a fraction of the memory for large databases.
 
     DBDictClassifier is a Classifier class that uses a database
-    store.
+    store.  The records it has read are cached in memory (optionally
+    only the most recently used ones), and it can keep a Bloom filter
+    (see bloom.py) of the words in the database, so that looking up words
+    that aren't there doesn't need to touch the disk.
+
+    MmapClassifier is a Classifier class that looks words up directly in
+    a memory-mapped file, without loading anything at startup.  It is
+    intended for processes that only (or mostly) score, such as many
+    sb_filter.py processes sharing one database.
 
     Trainer is concrete class that observes a Corpus and trains a
     Classifier object based upon movement of messages between corpora  When
@@ -59,12 +75,18 @@ import sys
 import time
 import types
 import tempfile
+import cPickle as pickle
+import lockfile
 from spambayes import classifier
 from spambayes.Options import options, get_pathname_option
 import errno
 import shelve
 from spambayes import cdb
+from spambayes import mmapdb
 from spambayes import dbmstorage
+from spambayes import bloom
+from spambayes.packedwordinfo import PackedWordInfo
+from spambayes.lrucache import LRUCache, CacheStats
 from spambayes.safepickle import pickle_write, pickle_read
 
 # Make shelve use binary pickles by default.
@@ -80,13 +102,18 @@ UPDATEPROBS = True       # Probabilities will be autoupdated with training
 class PickledClassifier(classifier.Classifier):
     '''Classifier object persisted in a pickle'''
 
+    # store() only reads the classifier, so an epochs.EpochClassifier can
+    # let other threads look words up while it runs.
+    store_blocks_lookups = False
+
     def __init__(self, db_name):
         classifier.Classifier.__init__(self)
         self.db_name = db_name
+        self.journal_name = db_name + ".journal"
         self.load()
 
     def load(self):
-        '''Load this instance from the pickle.'''
+        '''Load this instance from the pickle (and its journal).'''
         # This is a bit strange, because the loading process
         # creates a temporary instance of PickledClassifier, from which
         # this object's state is copied.  This is a nuance of the way
@@ -123,17 +150,133 @@ class PickledClassifier(classifier.Classifier):
             self.nham = 0
             self.nspam = 0
 
+        # The words changed since the last store, and whether we have
+        # added to the journal since the pickle was written.
+        self.changed_words = {}
+        self.journalled = False
+        self._replay_journal()
+
     def store(self):
         '''Store self as a pickle'''
 
+        # Appending the changes to the journal is much quicker than
+        # writing everything, until the journal gets big enough that
+        # loading it is slow.
+        if options["Storage", "pickle_journal"] and \
+           os.path.exists(self.db_name):
+            try:
+                size = os.path.getsize(self.journal_name)
+            except OSError:
+                size = 0
+            if size < options["Storage", "pickle_journal_size"]:
+                self._append_journal()
+                return
+        self.compact()
+
+    def compact(self):
+        '''Write the whole pickle, which makes the journal unnecessary'''
+
         if options["globals", "verbose"]:
             print >> sys.stderr, 'Persisting', self.db_name, 'as a pickle'
 
         pickle_write(self.db_name, self, PICKLE_TYPE)
+        # If we stop here, replaying the journal next time will do no
+        # harm, because it holds counts, not changes to them.
+        if os.path.exists(self.journal_name):
+            os.remove(self.journal_name)
+        self.changed_words.clear()
+        self.journalled = False
 
     def close(self):
-        # we keep no resources open - nothing to do
-        pass
+        # We keep no resources open, but fold the journal into the pickle,
+        # as long as that won't also save changes that weren't stored.
+        if self.journalled and not self.changed_words:
+            self.compact()
+
+    def _wordinfoset(self, word, record):
+        classifier.Classifier._wordinfoset(self, word, record)
+        self.changed_words[word] = True
+
+    def _wordinfodel(self, word):
+        classifier.Classifier._wordinfodel(self, word)
+        self.changed_words[word] = True
+
+    def _append_journal(self):
+        '''Add the counts of the changed words to the journal'''
+        if options["globals", "verbose"]:
+            print >> sys.stderr, 'Adding %d words to %s' % \
+                  (len(self.changed_words), self.journal_name)
+
+        # Each entry has the new counts (0, 0 for a deleted word), rather
+        # than the change to them, so that it can be replayed more than
+        # once.
+        words = []
+        for word in self.changed_words:
+            record = self.wordinfo.get(word)
+            if record is None:
+                words.append((word, 0, 0))
+            else:
+                words.append((word, record.spamcount, record.hamcount))
+        lock = lockfile.FileLock(self.journal_name)
+        lock.acquire(timeout=20)
+        try:
+            fp = open(self.journal_name, 'ab')
+            try:
+                pickle.dump((self.nspam, self.nham, words), fp, 2)
+            finally:
+                fp.close()
+        finally:
+            lock.release()
+        self.changed_words.clear()
+        self.journalled = True
+
+    def _replay_journal(self):
+        '''Apply the entries in the journal to the loaded pickle'''
+        try:
+            fp = open(self.journal_name, 'rb')
+        except IOError:
+            return
+        entries = 0
+        try:
+            while True:
+                # If the last store was interrupted, what it was writing
+                # is lost, but everything before it is fine.
+                try:
+                    nspam, nham, words = pickle.load(fp)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError), e:
+                    print >> sys.stderr, "Ignoring the end of %s: %s" % \
+                          (self.journal_name, e)
+                    break
+                self.nspam, self.nham = nspam, nham
+                for word, spamcount, hamcount in words:
+                    if spamcount or hamcount:
+                        record = self.WordInfoClass()
+                        record.__setstate__((spamcount, hamcount))
+                        self.wordinfo[word] = record
+                    elif word in self.wordinfo:
+                        del self.wordinfo[word]
+                entries += 1
+        finally:
+            fp.close()
+        # The pickle needs writing before this journal can go.
+        self.journalled = True
+        if options["globals", "verbose"]:
+            print >> sys.stderr, 'Replayed %d entries from %s' % \
+                  (entries, self.journal_name)
+
+class PackedPickledClassifier(PickledClassifier):
+    '''Classifier object persisted in a pickle, with a packed wordinfo'''
+
+    def load(self):
+        '''Load this instance from the pickle.'''
+        PickledClassifier.load(self)
+        # A pickle written by a plain PickledClassifier holds a dictionary,
+        # which we convert.  One written by us already has a PackedWordInfo.
+        if not isinstance(self.wordinfo, PackedWordInfo):
+            self.wordinfo = PackedWordInfo(self.wordinfo,
+                                           self.WordInfoClass)
 
 # Values for our changed words map
 WORD_DELETED = "D"
@@ -141,6 +284,14 @@ WORD_CHANGED = "C"
 
 STATE_KEY = 'saved state'
 
+# The smallest Bloom filter to build, so that a new database doesn't need
+# a new filter after every few messages.
+MIN_BLOOM_CAPACITY = 10000
+
+# How often (in seconds) a read-only DBDictClassifier checks that its Bloom
+# filter still matches the database, which another process may change.
+BLOOM_CHECK_INTERVAL = 1.0
+
 class DBDictClassifier(classifier.Classifier):
     '''Classifier object persisted in a caching database'''
 
@@ -151,6 +302,9 @@ class DBDictClassifier(classifier.Classifier):
         self.statekey = STATE_KEY
         self.mode = mode
         self.db_name = db_name
+        self.bloom = None
+        self.bloom_stats = bloom.BloomStats()
+        self.wordinfo_stats = CacheStats()
         self.load()
 
     def close(self):
@@ -160,6 +314,20 @@ class DBDictClassifier(classifier.Classifier):
             pass
         getattr(self.db, "close", noop)()
         getattr(self.dbm, "close", noop)()
+        # Closing may have written to the database files, so only now do
+        # they have the signature that the Bloom filter should be saved
+        # with.
+        if options["globals", "verbose"]:
+            stats = self.wordinfo_stats
+            print >> sys.stderr, "Word cache hit rate %.1f%%, with %d " \
+                  "evictions" % (100.0 * stats.hit_rate(), stats.evictions)
+        if self.bloom is not None:
+            self._save_bloom_filter()
+            if options["globals", "verbose"]:
+                print >> sys.stderr, "Bloom filter saved %d lookups, " \
+                      "with a false positive rate of %.1f%%" % \
+                      (self.bloom_stats.saved,
+                       100.0 * self.bloom_stats.false_positive_rate())
         # should not be a need to drop the 'dbm' or 'db' attributes.
         # but we do anyway, because it makes it more clear what has gone
         # wrong if we try to keep using the database after we have closed
@@ -196,8 +364,33 @@ class DBDictClassifier(classifier.Classifier):
                 print >> sys.stderr, self.db_name,'is a new database'
             self.nspam = 0
             self.nham = 0
-        self.wordinfo = {}
         self.changed_words = {} # value may be one of the WORD_ constants
+        cache_size = options["Storage", "dbm_cache_size"]
+        if cache_size > 0:
+            # Changed records must stay in memory until they are stored,
+            # so _wordinfoset() pins them.
+            self.wordinfo = LRUCache(cache_size, self.wordinfo_stats)
+        else:
+            self.wordinfo = {}
+        self.bloom = None
+        self._bloom_checked = time.time()
+        self._bloom_check = self.mode == 'r' and \
+                            options["Storage", "use_bloom_filter"]
+        if options["Storage", "use_bloom_filter"]:
+            signature = self._bloom_signature()
+            self.bloom = bloom.load(self._bloom_filename(), signature)
+            if self.bloom is not None:
+                self._bloom_file_signature = signature
+            elif self.mode != 'r':
+                # Remember what was there, so that _save_bloom_filter()
+                # can tell whether another process has saved a filter
+                # since.
+                self._bloom_file_signature = \
+                    bloom.saved_signature(self._bloom_filename())
+                self._rebuild_bloom_filter()
+            # A read-only classifier doesn't build a filter (which means
+            # reading every key), but looks words up in the database until
+            # a writer saves one that matches it.
 
     def store(self):
         '''Place state into persistent store'''
@@ -226,12 +419,100 @@ class DBDictClassifier(classifier.Classifier):
             else:
                 raise RuntimeError, "Unknown flag value"
 
-        # Reset the changed word list.
-        self.changed_words = {}
+        # Reset the changed word list, and let the wordinfo cache evict
+        # the records that were changed.
+        self.changed_words.clear()
+        if isinstance(self.wordinfo, LRUCache):
+            self.wordinfo.unpin_all()
         # Update the global state, then do the actual save.
         self._write_state_key()
         self.db.sync()
 
+        # Now that everything is in the database, it is a good time to
+        # replace a Bloom filter that is too full to be useful, and to
+        # save it, so that other processes can use it.
+        if self.bloom is not None:
+            if self.bloom.is_full():
+                self._rebuild_bloom_filter()
+            self._save_bloom_filter()
+
+    def _bloom_filename(self):
+        return self.db_name + ".bloom"
+
+    def _bloom_signature(self):
+        '''Return something that changes whenever the database does'''
+        # Different dbm modules use different files (and the Bloom filter's
+        # own files are next to them), so look at everything that starts
+        # with the database's name.
+        dirname, basename = os.path.split(self.db_name)
+        bloom_name = os.path.basename(self._bloom_filename())
+        signature = []
+        for name in os.listdir(dirname or os.curdir):
+            if name.startswith(basename) and not name.startswith(bloom_name):
+                st = os.stat(os.path.join(dirname, name))
+                signature.append((name, st.st_size, st.st_mtime))
+        signature.sort()
+        return signature
+
+    def _rebuild_bloom_filter(self):
+        '''Build a new Bloom filter from the words in the database'''
+        # Not _wordinfokeys(), because a new database has no state key.
+        words = set([word for word in self.db.keys()
+                     if word != self.statekey])
+        for word, flag in self.changed_words.iteritems():
+            if flag is WORD_CHANGED:
+                words.add(word)
+        self.bloom = bloom.BloomFilter(
+            max(2 * len(words), MIN_BLOOM_CAPACITY),
+            options["Storage", "bloom_filter_error_rate"])
+        self.bloom.update(words)
+        if options["globals", "verbose"]:
+            print >> sys.stderr, "Built a Bloom filter of %d words for %s" % \
+                  (self.bloom.count, self.db_name)
+
+    def _check_bloom_filter(self):
+        '''Make sure that a read-only classifier's Bloom filter matches the
+        database, which other processes may have changed.'''
+        now = time.time()
+        if now - self._bloom_checked < BLOOM_CHECK_INTERVAL:
+            return
+        self._bloom_checked = now
+        signature = self._bloom_signature()
+        if self.bloom is None or signature != self.bloom.signature:
+            # Use the filter the writer saved, if it has; otherwise look
+            # everything up in the database for now.
+            self.bloom = bloom.load(self._bloom_filename(), signature)
+
+    def _save_bloom_filter(self):
+        # A read-only classifier may have been open while another process
+        # changed the database, so its filter could be missing words; it
+        # never saves (and doesn't need to, since load() ignores a filter
+        # saved for other files).
+        if self.mode == 'r':
+            return
+        filename = self._bloom_filename()
+        if bloom.saved_signature(filename) != self._bloom_file_signature:
+            # Another process has saved its filter since this one was
+            # loaded, so it changed the database too, and this filter may
+            # not know about its words.  Stamping this filter with the
+            # database's signature would make those words "missing" for
+            # good, so remove the saved one and let it be built again.
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return
+        signature = self._bloom_signature()
+        if self.bloom.changed or signature != self.bloom.signature:
+            try:
+                self.bloom.save(filename, signature)
+            except (IOError, OSError), e:
+                # It will just have to be built again next time.
+                if options["globals", "verbose"]:
+                    print >> sys.stderr, "Couldn't save Bloom filter:", e
+            else:
+                self._bloom_file_signature = signature
+
     def _write_state_key(self):
         self.db[self.statekey] = (classifier.PICKLE_VERSION,
                                   self.nspam, self.nham)
@@ -246,16 +527,26 @@ class DBDictClassifier(classifier.Classifier):
         if isinstance(word, unicode):
             word = word.encode("utf-8")
         try:
-            return self.wordinfo[word]
+            ret = self.wordinfo[word]
         except KeyError:
+            self.wordinfo_stats.misses += 1
             ret = None
             if self.changed_words.get(word) is not WORD_DELETED:
+                if self._bloom_check:
+                    self._check_bloom_filter()
+                if self.bloom is not None and word not in self.bloom:
+                    self.bloom_stats.saved += 1
+                    return None
                 r = self.db.get(word)
                 if r:
                     ret = self.WordInfoClass()
                     ret.__setstate__(r)
                     self.wordinfo[word] = ret
+                elif self.bloom is not None:
+                    self.bloom_stats.false_positives += 1
             return ret
+        self.wordinfo_stats.hits += 1
+        return ret
 
     def _wordinfoset(self, word, record):
         # "Singleton" words (i.e. words that only have a single instance)
@@ -269,6 +560,8 @@ class DBDictClassifier(classifier.Classifier):
         # takes to store the database
         if isinstance(word, unicode):
             word = word.encode("utf-8")
+        if self.bloom is not None and self._is_new_word(word):
+            self.bloom.add(word)
         if record.spamcount + record.hamcount <= 1:
             self.db[word] = record.__getstate__()
             try:
@@ -286,12 +579,28 @@ class DBDictClassifier(classifier.Classifier):
         else:
             self.wordinfo[word] = record
             self.changed_words[word] = WORD_CHANGED
+            if isinstance(self.wordinfo, LRUCache):
+                self.wordinfo.pin(word)
+
+    def _is_new_word(self, word):
+        '''Return True if word isn't in the Bloom filter yet'''
+        # _wordinfoget() has just been called for the word, so if it is in
+        # the database, it is in the cache; only a false positive from the
+        # filter needs a look at the database.
+        if word in self.wordinfo:
+            return False
+        if word not in self.bloom or \
+           self.changed_words.get(word) is WORD_DELETED:
+            return True
+        return not self.db.has_key(word)
 
     def _wordinfodel(self, word):
         if isinstance(word, unicode):
             word = word.encode("utf-8")
         del self.wordinfo[word]
         self.changed_words[word] = WORD_DELETED
+        if self.bloom is not None:
+            self.bloom.stale += 1
 
     def _wordinfokeys(self):
         wordinfokeys = self.db.keys()
@@ -299,20 +608,58 @@ class DBDictClassifier(classifier.Classifier):
         return wordinfokeys
 
 
+# Idle SQL connections, keyed by whatever identifies the database, so that
+# reopening a classifier (e.g. when sb_server reloads its database) reuses
+# a connection rather than making a new one.
+_connection_pool = {}
+MAX_POOLED_CONNECTIONS = 4
+
+def _get_connection(key, connect):
+    """Return a pooled connection for key, or a new one from connect()."""
+    try:
+        return _connection_pool[key].pop()
+    except (KeyError, IndexError):
+        return connect()
+
+def _release_connection(key, conn):
+    """Return conn to the pool (or close it, if the pool is full)."""
+    idle = _connection_pool.setdefault(key, [])
+    if len(idle) < MAX_POOLED_CONNECTIONS:
+        idle.append(conn)
+    else:
+        conn.close()
+
 class SQLClassifier(classifier.Classifier):
+    # Maximum number of words to look up in a single "where word in (...)"
+    # query.
+    MAX_WORDS_PER_QUERY = 500
+
     def __init__(self, db_name):
         '''Constructor(database name)'''
 
         classifier.Classifier.__init__(self)
         self.statekey = STATE_KEY
         self.db_name = db_name
+        # While scoring or training a message, the rows for all of its
+        # words are fetched in one go; _wordinfoget() uses this dictionary
+        # of word to WordInfo (None if the word isn't in the database).
+        self._prefetched = None
+        # Inside _batch(), the changes to be written, as a dictionary of
+        # word to (nspam, nham) (None if the word is to be deleted).
+        self._batch_rows = None
         self.load()
 
     def close(self):
         '''Release all database resources'''
-        # As we (presumably) aren't as constrained as we are by file locking,
-        # don't force sub-classes to override
-        pass
+        # Hand the connection back to the pool, so that it can be reused
+        # if the database is opened again.
+        if getattr(self, "db", None) is not None:
+            _release_connection(self.connection_key(), self.db)
+            self.db = None
+
+    def connection_key(self):
+        '''Return a key identifying the database, for the connection pool'''
+        return (self.__class__.__name__, self.db_name)
 
     def load(self):
         '''Load state from the database'''
@@ -334,6 +681,10 @@ class SQLClassifier(classifier.Classifier):
         '''Commit the current transaction - may commit at db or cursor'''
         raise NotImplementedError, "must be implemented in subclass"
 
+    def _unpack_row(self, row):
+        '''Return (word, nspam, nham) from a row returned by fetchall'''
+        return row["word"], row["nspam"], row["nham"]
+
     def create_bayes(self):
         '''Create a new bayes table'''
         c = self.cursor()
@@ -357,25 +708,56 @@ class SQLClassifier(classifier.Classifier):
         else:
             return {}
 
+    def _get_rows(self, words):
+        '''Return a dict mapping each of words that is in the database to
+        its (nspam, nham) counts, using as few queries as possible'''
+        counts = {}
+        c = self.cursor()
+        for i in xrange(0, len(words), self.MAX_WORDS_PER_QUERY):
+            chunk = words[i:i+self.MAX_WORDS_PER_QUERY]
+            try:
+                c.execute("select word, nspam, nham from bayes"
+                          "  where word in (%s)" %
+                          (", ".join(["%s"] * len(chunk)),),
+                          tuple(chunk))
+            except Exception, e:
+                print >> sys.stderr, "error:", (e, chunk)
+                raise
+            for row in self.fetchall(c):
+                word, nspam, nham = self._unpack_row(row)
+                if not isinstance(word, basestring):
+                    # e.g. a buffer from a bytea column.
+                    word = str(word)
+                counts[word] = (int(nspam), int(nham))
+        return counts
+
+    update_sql = ("update bayes"
+                  "  set nspam=%s,nham=%s"
+                  "  where word=%s")
+    insert_sql = ("insert into bayes"
+                  "  (nspam, nham, word)"
+                  "  values (%s, %s, %s)")
+    delete_sql = ("delete from bayes"
+                  "  where word=%s")
+
     def _set_row(self, word, nspam, nham):
+        if self._batch_rows is not None:
+            # Written at the end of _batch().
+            self._batch_rows[word] = (nspam, nham)
+            return
         c = self.cursor()
         if self._has_key(word):
-            c.execute("update bayes"
-                      "  set nspam=%s,nham=%s"
-                      "  where word=%s",
-                      (nspam, nham, word))
+            c.execute(self.update_sql, (nspam, nham, word))
         else:
-            c.execute("insert into bayes"
-                      "  (nspam, nham, word)"
-                      "  values (%s, %s, %s)",
-                      (nspam, nham, word))
+            c.execute(self.insert_sql, (nspam, nham, word))
         self.commit(c)
 
     def _delete_row(self, word):
+        if self._batch_rows is not None:
+            self._batch_rows[word] = None
+            return
         c = self.cursor()
-        c.execute("delete from bayes"
-                  "  where word=%s",
-                  (word,))
+        c.execute(self.delete_sql, (word,))
         self.commit(c)
 
     def _has_key(self, key):
@@ -385,27 +767,112 @@ class SQLClassifier(classifier.Classifier):
                   (key,))
         return len(self.fetchall(c)) > 0
 
+    def _encode_words(self, words):
+        encoded = {}
+        for word in words:
+            if isinstance(word, unicode):
+                word = word.encode("utf-8")
+            encoded[word] = True
+        return encoded.keys()
+
+    def _prefetch(self, words):
+        '''Fetch the records for words (and forget any fetched before)'''
+        prefetched = {}
+        for word, counts in self._get_rows(self._encode_words(words)).items():
+            item = self.WordInfoClass()
+            item.__setstate__(counts)
+            prefetched[word] = item
+        self._prefetched = prefetched
+
+    def _batch(self, words, func, *args):
+        '''Call func(*args) with the records for words prefetched, and
+        all the changes it makes done in a single transaction (with one
+        executemany() for each kind of change)'''
+        self._prefetch(words)
+        # The words that already have rows.
+        existing = set(self._prefetched)
+        self._batch_rows = {}
+        try:
+            func(*args)
+            updates = []
+            inserts = []
+            deletes = []
+            for word, counts in self._batch_rows.iteritems():
+                if counts is None:
+                    if word in existing:
+                        deletes.append((word,))
+                elif word in existing:
+                    updates.append(counts + (word,))
+                else:
+                    inserts.append(counts + (word,))
+            c = self.cursor()
+            for sql, rows in ((self.delete_sql, deletes),
+                              (self.update_sql, updates),
+                              (self.insert_sql, inserts)):
+                if rows:
+                    c.executemany(sql, rows)
+            self.commit(c)
+        finally:
+            self._batch_rows = None
+            self._prefetched = None
+
+    def _getclues(self, wordstream, distanceget=None):
+        # Look up all the message's words in one query, rather than one
+        # query per word.
+        wordstream = list(wordstream)
+        if classifier.classifier_options.use_bigrams:
+            self._prefetch(self._enhance_wordstream(wordstream))
+        else:
+            self._prefetch(wordstream)
+        try:
+            return classifier.Classifier._getclues(self, wordstream,
+                                                   distanceget)
+        finally:
+            self._prefetched = None
+
+    def _add_msg(self, wordstream, is_spam):
+        words = set(wordstream)
+        self._batch(words, classifier.Classifier._add_msg, self, words,
+                    is_spam)
+
+    def _remove_msg(self, wordstream, is_spam):
+        words = set(wordstream)
+        self._batch(words, classifier.Classifier._remove_msg, self, words,
+                    is_spam)
+
+    def _apply_batch(self, batch):
+        words = set(batch.spamcounts)
+        words.update(batch.hamcounts)
+        self._batch(words, classifier.Classifier._apply_batch, self, batch)
+
     def _wordinfoget(self, word):
         if isinstance(word, unicode):
             word = word.encode("utf-8")
 
+        if self._prefetched is not None:
+            return self._prefetched.get(word)
         row = self._get_row(word)
         if row:
+            unused, nspam, nham = self._unpack_row(row)
             item = self.WordInfoClass()
-            item.__setstate__((row["nspam"], row["nham"]))
+            item.__setstate__((int(nspam), int(nham)))
             return item
         else:
-            return self.WordInfoClass()
+            return None
 
     def _wordinfoset(self, word, record):
         if isinstance(word, unicode):
             word = word.encode("utf-8")
         self._set_row(word, record.spamcount, record.hamcount)
+        if self._prefetched is not None:
+            self._prefetched[word] = record
 
     def _wordinfodel(self, word):
         if isinstance(word, unicode):
             word = word.encode("utf-8")
         self._delete_row(word)
+        if self._prefetched is not None:
+            self._prefetched[word] = None
 
     def _wordinfokeys(self):
         c = self.cursor()
@@ -442,7 +909,9 @@ class PGClassifier(SQLClassifier):
         if options["globals", "verbose"]:
             print >> sys.stderr, 'Loading state from', self.db_name, 'database'
 
-        self.db = psycopg.connect('dbname=' + self.db_name)
+        self.db = _get_connection(self.connection_key(),
+                                  lambda: psycopg.connect('dbname=' +
+                                                          self.db_name))
 
         c = self.cursor()
         try:
@@ -483,6 +952,7 @@ class mySQLClassifier(SQLClassifier):
         self.host = "localhost"
         self.username = "root"
         self.password = ""
+        self.port = 3306
         db_name = "spambayes"
         self.charset = None
         source_info = data_source_name.split()
@@ -493,12 +963,18 @@ class mySQLClassifier(SQLClassifier):
                 self.username = info[5:]
             elif info.startswith("pass"):
                 self.password = info[5:]
+            elif info.startswith("port"):
+                self.port = int(info[5:])
             elif info.startswith("dbname"):
                 db_name = info[7:]
             elif info.startswith("charset"):
                 self.charset = info[8:]
         SQLClassifier.__init__(self, db_name)
 
+    def connection_key(self):
+        return (self.__class__.__name__, self.host, self.port,
+                self.username, self.password, self.db_name, self.charset)
+
     def cursor(self):
         return self.db.cursor()
 
@@ -517,11 +993,12 @@ class mySQLClassifier(SQLClassifier):
             print >> sys.stderr, 'Loading state from', self.db_name, 'database'
 
         params = {
-          'host': self.host, 'db': self.db_name,
+          'host': self.host, 'port': self.port, 'db': self.db_name,
           'user': self.username, 'passwd': self.password,
           'charset': self.charset
         }
-        self.db = MySQLdb.connect(**params)
+        self.db = _get_connection(self.connection_key(),
+                                  lambda: MySQLdb.connect(**params))
 
         c = self.cursor()
         try:
@@ -551,17 +1028,8 @@ class mySQLClassifier(SQLClassifier):
             self.nspam = 0
             self.nham = 0
 
-    def _wordinfoget(self, word):
-        if isinstance(word, unicode):
-            word = word.encode("utf-8")
-
-        row = self._get_row(word)
-        if row:
-            item = self.WordInfoClass()
-            item.__setstate__((row[1], row[2]))
-            return item
-        else:
-            return None
+    def _unpack_row(self, row):
+        return row[0], row[1], row[2]
 
 
 class CDBClassifier(classifier.Classifier):
@@ -639,6 +1107,124 @@ class CDBClassifier(classifier.Classifier):
         pass
 
 
+class MmapClassifier(classifier.Classifier):
+    """A classifier that looks words up in a memory-mapped file.
+
+    Opening the database reads only its header; words are looked up in
+    the mapped file as they are needed, and records aren't kept once they
+    have been used.  Every process using the same file shares one copy of
+    it in the operating system's page cache.
+
+    Training is allowed:  changed words are kept in memory, and store()
+    writes a complete new file and renames it over the old one, which is
+    slow for large databases.  Processes that already have the old file
+    mapped keep using it until they reload.
+    """
+    def __init__(self, db_name):
+        classifier.Classifier.__init__(self)
+        self.db_name = db_name
+        self.db = None
+        self.load()
+
+    def load(self):
+        '''Load state from database'''
+        self.close()
+        if os.path.exists(self.db_name):
+            self.db = mmapdb.MmapDB(open(self.db_name, "rb"))
+            self.nspam = self.db.nspam
+            self.nham = self.db.nham
+            if options["globals", "verbose"]:
+                print >> sys.stderr, ('%s is an existing mmap database,'
+                                      ' with %d spam and %d ham') \
+                                      % (self.db_name, self.nspam,
+                                         self.nham)
+        else:
+            if options["globals", "verbose"]:
+                print >> sys.stderr, self.db_name, 'is a new mmap database'
+            self.nspam = 0
+            self.nham = 0
+        # Words changed since the last store().  The value may be one of
+        # the WORD_ constants.
+        self.wordinfo = {}
+        self.changed_words = {}
+        self.probcache = {}
+
+    def store(self):
+        '''Place state into persistent store'''
+        if options["globals", "verbose"]:
+            print >> sys.stderr, 'Persisting', self.db_name,
+            print >> sys.stderr, 'state in mmap database'
+
+        items = []
+        if self.db is not None:
+            for word, spamcount, hamcount in self.db:
+                if word not in self.changed_words:
+                    items.append((word, spamcount, hamcount))
+        for word, record in self.wordinfo.iteritems():
+            items.append((word, record.spamcount, record.hamcount))
+
+        # Write to a new file and rename it into place, so that other
+        # processes never see a half-written database.
+        tmp = self.db_name + ".tmp"
+        fp = open(tmp, "wb")
+        try:
+            mmapdb.mmapdb_make(fp, self.nspam, self.nham, items)
+        finally:
+            fp.close()
+        self.close()
+        try:
+            os.rename(tmp, self.db_name)
+        except OSError:
+            # win32 won't rename over an existing file.
+            os.remove(self.db_name)
+            os.rename(tmp, self.db_name)
+        self.load()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def _wordinfoget(self, word):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        try:
+            return self.wordinfo[word]
+        except KeyError:
+            pass
+        if self.db is None or word in self.changed_words:
+            return None
+        counts = self.db.get(word)
+        if counts is None:
+            return None
+        record = self.WordInfoClass()
+        record.__setstate__(counts)
+        return record
+
+    def _wordinfoset(self, word, record):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        self.wordinfo[word] = record
+        self.changed_words[word] = WORD_CHANGED
+
+    def _wordinfodel(self, word):
+        if isinstance(word, unicode):
+            word = word.encode("utf-8")
+        try:
+            del self.wordinfo[word]
+        except KeyError:
+            pass
+        self.changed_words[word] = WORD_DELETED
+
+    def _wordinfokeys(self):
+        keys = self.wordinfo.keys()
+        if self.db is not None:
+            for word, _spamcount, _hamcount in self.db:
+                if word not in self.changed_words:
+                    keys.append(word)
+        return keys
+
+
 # If ZODB isn't available, then this class won't be useable, but we
 # still need to be able to import this module.  So we pretend that all
 # is ok.
@@ -976,9 +1562,11 @@ class MutuallyExclusiveError(Exception):
 # arg, and True if the argument is a pathname
 _storage_types = {"dbm" : (DBDictClassifier, True, True),
                   "pickle" : (PickledClassifier, False, True),
+                  "packed" : (PackedPickledClassifier, False, True),
                   "pgsql" : (PGClassifier, False, False),
                   "mysql" : (mySQLClassifier, False, False),
                   "cdb" : (CDBClassifier, False, True),
+                  "mmap" : (MmapClassifier, False, True),
                   "zodb" : (ZODBClassifier, True, True),
                   "zeo" : (ZEOClassifier, False, False),
                   }
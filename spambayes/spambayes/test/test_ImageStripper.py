@@ -0,0 +1,236 @@
+# Test spambayes.ImageStripper module.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes import ImageStripper
+from spambayes.Options import options
+from spambayes.safepickle import pickle_write
+
+# Stands in for an OCR program:  the "image" says what it should do.
+FAKE_OCR = """import sys, time
+command = open(sys.argv[1]).read()
+if command.startswith("sleep "):
+    time.sleep(float(command.split()[1]))
+    print "slept"
+elif command == "fail":
+    sys.exit(3)
+else:
+    print command
+"""
+
+class FakeEngine(ImageStripper.OCRExecutableEngine):
+    engine_name = "fake"
+
+    def __init__(self, script):
+        ImageStripper.OCRExecutableEngine.__init__(self)
+        self._program = sys.executable
+        self.script = script
+
+    def get_args(self, pnmfile):
+        return [self.program, self.script, pnmfile]
+
+class ImageStripperTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp("spambayestest")
+        script = os.path.join(self.directory, "ocr.py")
+        f = open(script, "w")
+        f.write(FAKE_OCR)
+        f.close()
+        self.engine = FakeEngine(script)
+        self.cachefile = os.path.join(self.directory, "cache")
+        self.saved = {}
+        for name in ("crack_image_cache_size", "crack_image_cache_days",
+                     "ocr_processes", "ocr_timeout"):
+            self.saved[name] = options["Tokenizer", name]
+        self.count = 0
+        self.strippers = []
+
+    def tearDown(self):
+        for stripper in self.strippers:
+            stripper.close()
+        for name, value in self.saved.items():
+            options["Tokenizer", name] = value
+        shutil.rmtree(self.directory)
+
+    def image(self, command):
+        self.count += 1
+        name = os.path.join(self.directory, "image%d" % (self.count,))
+        f = open(name, "w")
+        f.write(command)
+        f.close()
+        return name
+
+    def stripper(self, cachefile=None):
+        if cachefile is None:
+            cachefile = self.cachefile
+        stripper = ImageStripper.ImageStripper(cachefile)
+        stripper.engine = self.engine
+        self.strippers.append(stripper)
+        return stripper
+
+    def run_pool(self, size, timeout, commands):
+        pool = ImageStripper.OCRPool(size, timeout)
+        start = time.time()
+        results = pool.run(self.engine, [self.image(c) for c in commands])
+        return results, time.time() - start
+
+    def test_concurrent(self):
+        results, serial = self.run_pool(1, 0, ["sleep 0.3"] * 3)
+        self.assertEqual([r[0] for r in results], ["slept\n"] * 3)
+        self.assert_(serial >= 0.9)
+        results, parallel = self.run_pool(3, 0, ["sleep 0.3"] * 3)
+        self.assertEqual([r[0] for r in results], ["slept\n"] * 3)
+        self.assert_(parallel < serial - 0.3)
+
+    def test_timeout(self):
+        results, elapsed = self.run_pool(2, 0.3, ["sleep 10", "hello"])
+        text, error, timed_out, seconds = results[0]
+        self.assertEqual(text, "")
+        self.assert_(timed_out)
+        self.assert_(error)
+        self.assert_(elapsed < 5)
+        self.assertEqual(results[1][:3], ("hello\n", None, False))
+
+    def test_failure(self):
+        results, elapsed = self.run_pool(2, 0, ["fail"])
+        text, error, timed_out, seconds = results[0]
+        self.assertEqual(text, "")
+        self.failIf(timed_out)
+        self.assert_("exit code 3" in error)
+        self.assertRaises(SystemError, self.engine.extract_text,
+                          self.image("fail"))
+        self.assertEqual(self.engine.extract_text(self.image("Hi")), "Hi\n")
+
+    def test_extract(self):
+        stripper = self.stripper()
+        images = [self.image("Buy\nNow"), self.image("")]
+        text, tokens = stripper.extract_ocr_info(images)
+        self.assertEqual(text, "buy\nnow\n\n\n")
+        self.assertEqual(tokens, set(["image-text-lines:1",
+                                      "image-text:no text found"]))
+        for image in images:
+            self.failIf(os.path.exists(image))
+        self.assertEqual(stripper.stats.misses, 2)
+        self.assertEqual(stripper.stats.runs, 2)
+
+        text, tokens = stripper.extract_ocr_info([self.image("Buy\nNow")])
+        self.assertEqual(text, "buy\nnow\n")
+        self.assertEqual(stripper.stats.hits, 1)
+        self.assertEqual(stripper.stats.runs, 2)
+
+    def test_errors_not_removed(self):
+        options["Tokenizer", "ocr_timeout"] = 0.3
+        stripper = self.stripper()
+        failed, slow = self.image("fail"), self.image("sleep 10")
+        saved_stderr = sys.stderr
+        sys.stderr = open(os.devnull, "w")
+        try:
+            text, tokens = stripper.extract_ocr_info([failed, slow])
+        finally:
+            sys.stderr.close()
+            sys.stderr = saved_stderr
+        self.assertEqual(tokens, set(["image-text:no text found"]))
+        self.assert_(os.path.exists(failed))
+        self.assert_(os.path.exists(slow))
+        self.assertEqual(stripper.stats.failures, 1)
+        self.assertEqual(stripper.stats.timeouts, 1)
+        # Failures are cached (as before), but not timeouts.
+        self.assertEqual(len(stripper.cache), 1)
+
+    def test_saved(self):
+        stripper = self.stripper()
+        stripper.extract_ocr_info([self.image("Cached")])
+        stripper.close()
+        stripper = self.stripper()
+        self.engine._program = "/nonexistent"
+        text, tokens = stripper.extract_ocr_info([self.image("Cached")])
+        self.assertEqual(text, "cached\n")
+        self.assertEqual(stripper.stats.hits, 1)
+
+    def test_worker(self):
+        stripper = self.stripper()
+        stripper.extract_ocr_info([self.image("Cached")])
+        stripper.close()
+        # As if this one had been forked from the process that made it.
+        worker = self.stripper()
+        worker._owner_pid = -1
+        worker.extract_ocr_info([self.image("Cached")])
+        worker.extract_ocr_info([self.image("New")])
+        worker.extract_ocr_info([self.image("New")])
+        self.assert_(worker.read_only)
+        self.assertEqual(worker.stats.hits, 2)
+        self.assertEqual(worker.stats.runs, 1)
+        worker.close()
+        # Only the owner writes to the cache file.
+        stripper = self.stripper()
+        stripper.extract_ocr_info([self.image("New")])
+        self.assertEqual(stripper.stats.misses, 1)
+        self.assertEqual(len(stripper.cache), 2)
+
+    def test_worker_no_cache(self):
+        worker = self.stripper()
+        worker._owner_pid = -1
+        text, tokens = worker.extract_ocr_info([self.image("Hello")])
+        self.assertEqual(text, "hello\n")
+        worker.extract_ocr_info([self.image("Hello")])
+        self.assertEqual(worker.stats.hits, 1)
+
+    def test_evict_size(self):
+        options["Tokenizer", "crack_image_cache_size"] = 2
+        stripper = self.stripper()
+        for command in ("one", "two", "three"):
+            stripper.extract_ocr_info([self.image(command)])
+            time.sleep(0.01)
+        # Seeing "one" again makes "two" the least recently seen.
+        stripper.extract_ocr_info([self.image("one")])
+        stripper.evict()
+        self.assertEqual(len(stripper.cache), 2)
+        self.assertEqual(stripper.stats.evictions, 1)
+        stripper.extract_ocr_info([self.image("two")])
+        self.assertEqual(stripper.stats.misses, 4)
+
+    def test_evict_age(self):
+        options["Tokenizer", "crack_image_cache_days"] = 1
+        stripper = self.stripper()
+        stripper.extract_ocr_info([self.image("old")])
+        stripper.extract_ocr_info([self.image("new")])
+        # Make the first image two days old.
+        fhash = stripper.cache.keys()[0]
+        record = ImageStripper.pickle.loads(stripper.cache[fhash])
+        stripper.cache[fhash] = ImageStripper.pickle.dumps(
+            (record[0] - 2 * 86400,) + record[1:])
+        stripper.evict()
+        self.failIf(stripper.cache.has_key(fhash))
+        self.assertEqual(len(stripper.cache), 1)
+
+    def test_old_cache(self):
+        name = os.path.join(self.directory, "old")
+        pickle_write(name, {"0123": ("text", set(["image-text-lines:0"]))})
+        stripper = self.stripper(name)
+        self.assertEqual(stripper._cache_get("0123"),
+                         ("text", set(["image-text-lines:0"])))
+
+    def test_no_cachefile(self):
+        stripper = self.stripper("")
+        stripper.extract_ocr_info([self.image("Memory")])
+        stripper.extract_ocr_info([self.image("Memory")])
+        self.assertEqual(stripper.stats.hits, 1)
+        self.assertEqual(os.listdir(self.directory), ["ocr.py"])
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (ImageStripperTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
@@ -0,0 +1,60 @@
+# Test spambayes.OptionsClass module.
+
+import sys
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes.OptionsClass import OptionsClass, BOOLEAN, INTEGER
+
+defaults = {
+    "Test" : (
+        ("x-flag", "A flag", False, "", BOOLEAN, True),
+        ("count", "A count", 3, "", INTEGER, True),
+        ),
+    }
+
+class OptionsSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.options = OptionsClass()
+        self.options.load_defaults(defaults)
+
+    def test_values(self):
+        snap = self.options.snapshot("Test")
+        self.assertEqual(snap.x_flag, False)
+        self.assertEqual(snap.count, 3)
+        self.assert_(self.options.snapshot("Test") is snap)
+
+    def test_set(self):
+        snap = self.options.snapshot("Test")
+        self.options.set_restore_point()
+        self.options["Test", "count"] = 5
+        self.options.set("Test", "x-flag", True)
+        self.assertEqual((snap.x_flag, snap.count), (True, 5))
+        self.options.revert_to_restore_point()
+        self.assertEqual((snap.x_flag, snap.count), (False, 3))
+
+    def test_read_only(self):
+        snap = self.options.snapshot("Test")
+        self.assertRaises(AttributeError, setattr, snap, "count", 4)
+        self.assertRaises(AttributeError, delattr, snap, "count")
+        self.assertEqual(self.options["Test", "count"], 3)
+
+    def test_new_options(self):
+        snap = self.options.snapshot("Test")
+        self.options.load_defaults({"Test" : (
+            ("extra", "Another", "x", "", r"[\w]+", True),)})
+        self.assertEqual(snap.extra, "x")
+        self.options["Test", "extra"] = "y"
+        self.assertEqual(snap.extra, "y")
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (OptionsSnapshotTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
@@ -0,0 +1,142 @@
+# Test spambayes.classifier module.
+
+import sys
+import random
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes.Options import options
+from spambayes.classifier import Classifier
+
+# A small vocabulary, so that the random messages below share plenty of
+# tokens with each other and with the training data.
+WORDS = ["word%d" % i for i in range(200)]
+
+def random_message(rand, length=60):
+    return [rand.choice(WORDS) for i in range(length)]
+
+def sorted_clues(c, wordstream, use_bigrams):
+    """The clues _getclues() should find, got by sorting every candidate."""
+    mindist = options["Classifier", "minimum_prob_strength"]
+    raw = []
+    seen = {}
+    last_token = None
+    for i, token in enumerate(wordstream):
+        candidates = [(token, (i,))]
+        if use_bigrams and i:
+            candidates.append(("bi:%s %s" % (last_token, token), (i-1, i)))
+        last_token = token
+        for clue, indices in candidates:
+            if clue not in seen:
+                seen[clue] = 1
+                tup = c._worddistanceget(clue)
+                if tup[0] >= mindist:
+                    raw.append((tup, indices))
+    raw.sort()
+    raw.reverse()
+    clues = []
+    used = {}
+    for tup, indices in raw:
+        if not [i for i in indices if i in used]:
+            for i in indices:
+                used[i] = 1
+            clues.append(tup)
+    clues.reverse()
+    clues = clues[-options["Classifier", "max_discriminators"]:]
+    return [t[1:] for t in clues]
+
+class _ClassifierTestBase(unittest.TestCase):
+    use_bigrams = False
+
+    def setUp(self):
+        self.saved_bigrams = options["Classifier", "use_bigrams"]
+        options["Classifier", "use_bigrams"] = self.use_bigrams
+        self.rand = random.Random(42)
+        self.classifier = Classifier()
+        for i in range(50):
+            # Skew the vocabulary a little so that some words are hammy
+            # and some spammy.
+            is_spam = i % 2
+            msg = random_message(self.rand)
+            if is_spam:
+                msg = [w for w in msg if not w.endswith("7")]
+            else:
+                msg = [w for w in msg if not w.endswith("3")]
+            self.classifier.learn(msg, is_spam)
+
+    def tearDown(self):
+        options["Classifier", "use_bigrams"] = self.saved_bigrams
+
+    def test_spamprob_many(self):
+        msgs = [random_message(self.rand) for i in range(20)]
+        msgs.append([])
+        msgs.append(["unknown", "tokens", "only"])
+        c = self.classifier
+        expected = [c.chi2_spamprob(msg) for msg in msgs]
+        self.assertEqual(c.chi2_spamprob_many(msgs), expected)
+
+    def test_spamprob_many_evidence(self):
+        msgs = [random_message(self.rand) for i in range(20)]
+        c = self.classifier
+        expected = [c.chi2_spamprob(msg, True) for msg in msgs]
+        # Iterators must work as well as lists.
+        got = c.chi2_spamprob_many([iter(msg) for msg in msgs], True)
+        self.assertEqual(got, expected)
+
+    def test_getclues_strongest(self):
+        c = self.classifier
+        saved = options["Classifier", "max_discriminators"]
+        try:
+            for max_discriminators in (0, 1, 10, 150):
+                options["Classifier", "max_discriminators"] = \
+                    max_discriminators
+                for length in (0, 5, 60, 2000):
+                    msg = random_message(self.rand, length) + ["unknown"]
+                    expected = sorted_clues(c, msg, self.use_bigrams)
+                    self.assertEqual(c._getclues(msg), expected)
+        finally:
+            options["Classifier", "max_discriminators"] = saved
+
+    def test_probcache_survives_training(self):
+        c = self.classifier
+        msgs = [random_message(self.rand) for i in range(10)]
+        for msg in msgs:
+            c.chi2_spamprob(msg)
+        self.assert_(c.probcache_stats.hits > 0)
+        cached = sum([len(hamprobs) for hamprobs in c.probcache.values()])
+        c.learn(random_message(self.rand), True)
+        remaining = sum([len(hamprobs)
+                         for hamprobs in c.probcache.values()])
+        self.assert_(0 < remaining < cached)
+        # Whatever is left in the cache must match a fresh computation.
+        fresh = Classifier()
+        fresh.nspam, fresh.nham = c.nspam, c.nham
+        for spamcount, hamprobs in c.probcache.items():
+            for hamcount, prob in hamprobs.items():
+                record = c.WordInfoClass()
+                record.__setstate__((spamcount, hamcount))
+                self.assertEqual(fresh.probability(record), prob)
+        # And scores must be the same as with an empty cache.
+        for msg in msgs:
+            expected = c.chi2_spamprob(msg)
+            c.probcache = {}
+            self.assertEqual(c.chi2_spamprob(msg), expected)
+
+class UnigramClassifierTest(_ClassifierTestBase):
+    use_bigrams = False
+
+class BigramClassifierTest(_ClassifierTestBase):
+    use_bigrams = True
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (UnigramClassifierTest,
+                BigramClassifierTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
@@ -0,0 +1,127 @@
+# Test spambayes.epochs module.
+
+import os
+import sys
+import glob
+import random
+import tempfile
+import threading
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes.classifier import Classifier
+from spambayes.storage import PickledClassifier, DBDictClassifier
+from spambayes.epochs import EpochClassifier
+
+WORDS = ["word%d" % i for i in range(200)]
+
+def random_message(rand, length=40):
+    return [rand.choice(WORDS) for i in range(length)]
+
+class _EpochTestBase(unittest.TestCase):
+    StorageClass = None
+
+    def setUp(self):
+        self.db_name = tempfile.mktemp("spambayestest")
+        self.rand = random.Random(42)
+        self.bayes = EpochClassifier(self.StorageClass(self.db_name))
+
+    def tearDown(self):
+        self.bayes.close()
+        for name in glob.glob(self.db_name + "*"):
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def train(self, *classifiers):
+        msgs = [(random_message(self.rand), i % 2) for i in range(30)]
+        for c in classifiers:
+            for msg, is_spam in msgs:
+                c.learn(msg, is_spam)
+            c.unlearn(msgs[0][0], msgs[0][1])
+        return msgs
+
+    def test_same_scores(self):
+        plain = Classifier()
+        self.train(plain, self.bayes)
+        self.assertEqual((self.bayes.nspam, self.bayes.nham),
+                         (plain.nspam, plain.nham))
+        msgs = [random_message(self.rand) for i in range(10)]
+        expected = [plain.spamprob(msg) for msg in msgs]
+        self.assertEqual([self.bayes.spamprob(msg) for msg in msgs],
+                         expected)
+        self.bayes.store()
+        self.assertEqual(self.bayes.epoch.changes, {})
+        self.assertEqual([self.bayes.spamprob(msg) for msg in msgs],
+                         expected)
+
+    def test_epoch_unchanged(self):
+        self.train(self.bayes)
+        epoch = self.bayes.epoch
+        msg = random_message(self.rand)
+        before = epoch.spamprob(msg), epoch.nspam
+        self.bayes.learn(msg, True)
+        self.bayes.store()
+        self.bayes.unlearn(msg, True)
+        self.assertEqual((epoch.spamprob(msg), epoch.nspam), before)
+        self.assertRaises(TypeError, epoch.learn, msg, True)
+
+    def test_store(self):
+        self.bayes.learn(["some", "tokens"], True)
+        self.bayes.learn(["some"], False)
+        self.bayes.learn(["gone"], False)
+        self.bayes.unlearn(["gone"], False)
+        self.bayes.store()
+        self.bayes.learn(["more"], True)
+        self.bayes.close()
+        self.bayes = EpochClassifier(self.StorageClass(self.db_name))
+        self.assertEqual((self.bayes.nspam, self.bayes.nham), (1, 1))
+        record = self.bayes._wordinfoget("some")
+        self.assertEqual((record.spamcount, record.hamcount), (1, 1))
+        self.assertEqual(self.bayes._wordinfoget("gone"), None)
+        self.assertEqual(self.bayes._wordinfoget("more"), None)
+        self.assertEqual(sorted(self.bayes._wordinfokeys()),
+                         ["some", "tokens"])
+
+    def test_threads(self):
+        self.train(self.bayes)
+        msgs = [random_message(self.rand) for i in range(20)]
+        errors = []
+        done = []
+        def score():
+            try:
+                while not done:
+                    for msg in msgs:
+                        self.bayes.spamprob(msg)
+            except:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=score) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(10):
+                self.train(self.bayes)
+                self.bayes.store()
+        finally:
+            done.append(True)
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+class PickleEpochTest(_EpochTestBase):
+    StorageClass = PickledClassifier
+
+class DBEpochTest(_EpochTestBase):
+    StorageClass = DBDictClassifier
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (PickleEpochTest,
+                DBEpochTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
@@ -0,0 +1,137 @@
+# Test spambayes.mboxutils module.
+
+import os
+import sys
+import mailbox
+import tempfile
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes import mboxutils
+from spambayes.mboxutils import MboxIndex, MmapMailbox, INDEX_SUFFIX
+
+MBOX = """This isn't part of any message.
+From alice@example.com Mon Jan  1 00:00:00 2007
+From: alice@example.com
+Subject: one
+
+First message.
+From bob@example.com Tue Jan  2 00:00:00 2007\r
+From: bob@example.com\r
+Subject: two\r
+\r
+Second message, with CRLF line endings.\r
+>From this line on, nothing is split.
+Neither here: From bob@example.com
+From carol@example.com Wed Jan  3 00:00:00 2007
+From: carol@example.com
+Subject: three
+
+Third message, without a final newline."""
+
+class MboxIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.name = tempfile.mktemp("spambayestest")
+        self.write(MBOX)
+
+    def tearDown(self):
+        for name in (self.name, self.name + INDEX_SUFFIX):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def write(self, text, mtime=None):
+        f = open(self.name, "wb")
+        f.write(text)
+        f.close()
+        if mtime is not None:
+            os.utime(self.name, (mtime, mtime))
+
+    def portable_texts(self):
+        f = open(self.name, "rb")
+        try:
+            return list(mailbox.PortableUnixMailbox(f, lambda fp: fp.read()))
+        finally:
+            f.close()
+
+    def test_same_as_portable(self):
+        mbox = MmapMailbox(self.name)
+        self.assertEqual(list(mbox), self.portable_texts())
+        self.assertEqual(len(mbox), 3)
+        self.assertEqual(mbox[-1], mbox[2])
+        self.assertRaises(IndexError, mbox.__getitem__, 3)
+        mbox.close()
+
+    def test_offsets(self):
+        index = MboxIndex(self.name)
+        texts = self.portable_texts()
+        offset = MBOX.index("From alice")
+        for i in range(len(texts)):
+            self.assertEqual(index[i], (offset, len(texts[i])))
+            offset += len(texts[i])
+
+    def test_saved(self):
+        offsets = MboxIndex(self.name, save=True).offsets
+        self.assert_(os.path.exists(self.name + INDEX_SUFFIX))
+        class NoScanIndex(MboxIndex):
+            def _scan(self):
+                raise AssertionError("the mbox was scanned again")
+        self.assertEqual(NoScanIndex(self.name).offsets, offsets)
+
+    def test_not_saved(self):
+        MboxIndex(self.name)
+        MmapMailbox(self.name).close()
+        self.failIf(os.path.exists(self.name + INDEX_SUFFIX))
+
+    def test_changed(self):
+        MboxIndex(self.name, save=True)
+        # The same size, but a different time.
+        self.write(MBOX.replace("From carol", "XXXX carol"),
+                   os.path.getmtime(self.name) + 10)
+        self.assertEqual(len(MboxIndex(self.name)), 2)
+        # A different size, at the same time.
+        self.write(MBOX + "\nFrom dave@example.com\n\n",
+                   os.path.getmtime(self.name))
+        self.assertEqual(len(MboxIndex(self.name)), 4)
+
+    def test_damaged(self):
+        MboxIndex(self.name, save=True)
+        f = open(self.name + INDEX_SUFFIX, "wb")
+        f.write("rubbish")
+        f.close()
+        self.assertEqual(len(MboxIndex(self.name)), 3)
+
+    def test_empty(self):
+        self.write("")
+        mbox = MmapMailbox(self.name)
+        self.assertEqual(list(mbox), [])
+        self.assertEqual(list(mbox.shard(0, 2)), [])
+
+    def test_shards(self):
+        text = "".join(["From %d\n\nMessage %d\n" % (i, i) for i in range(10)])
+        self.write(text)
+        mbox = MmapMailbox(self.name)
+        for n in (1, 3, 4, 10, 12):
+            shards = [mbox.shard(i, n) for i in range(n)]
+            self.assertEqual(sum([list(shard) for shard in shards], []),
+                             list(mbox))
+            sizes = [len(shard) for shard in shards]
+            self.assert_(max(sizes) - min(sizes) <= 1)
+        self.assertEqual(list(mbox.shard(1, 2).shard(1, 5)), [mbox[6]])
+
+    def test_getmbox(self):
+        msgs = list(mboxutils.getmbox(self.name))
+        self.assertEqual([msg["Subject"] for msg in msgs],
+                         ["one", "two", "three"])
+        self.failIf(os.path.exists(self.name + INDEX_SUFFIX))
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (MboxIndexTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
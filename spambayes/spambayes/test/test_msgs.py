@@ -0,0 +1,193 @@
+# Test spambayes.msgs module.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes import msgs
+from spambayes.msgs import PACK_SUFFIX, INDEX_SUFFIX
+from spambayes.tokenizer import tokenize
+from spambayes.Options import options
+
+class MsgPackTest(unittest.TestCase):
+    def setUp(self):
+        self.parent = tempfile.mkdtemp("spambayestest")
+        self.directory = os.path.join(self.parent, "Set1")
+        os.mkdir(self.directory)
+        for i in range(20):
+            f = open(os.path.join(self.directory, "msg%02d" % (i,)), "wb")
+            f.write("Subject: message %d\n\n%s\n" % (i, "body " * i * 20))
+            f.close()
+        self.saved_parms = (msgs.HAMTRAIN, msgs.HAMTEST, msgs.SEED)
+        msgs._packs.clear()
+
+    def tearDown(self):
+        msgs.HAMTRAIN, msgs.HAMTEST, msgs.SEED = self.saved_parms
+        msgs._packs.clear()
+        shutil.rmtree(self.parent)
+
+    def contents(self, directory, keep=None):
+        return [(msg.tag, msg.guts)
+                for msg in msgs.MsgStream(directory, [directory], keep)]
+
+    def test_write_pack(self):
+        self.assertEqual(msgs.write_pack(self.directory), 20)
+        path = self.directory + PACK_SUFFIX
+        self.assert_(os.path.exists(path))
+        self.assert_(os.path.exists(path + INDEX_SUFFIX))
+        pack = msgs.MsgPack(path)
+        self.assertEqual(pack.listdir(), os.listdir(self.directory))
+        f = open(os.path.join(self.directory, "msg07"), "rb")
+        self.assertEqual(pack.read("msg07"), f.read())
+        f.close()
+
+    def test_compressed(self):
+        msgs.write_pack(self.directory, compress=True)
+        path = self.directory + PACK_SUFFIX
+        total = 0
+        for name in os.listdir(self.directory):
+            total += os.path.getsize(os.path.join(self.directory, name))
+        self.assert_(os.path.getsize(path) < total)
+        expected = [(tag.replace("Set1", "Set1" + PACK_SUFFIX), guts)
+                    for tag, guts in self.contents(self.directory)]
+        self.assertEqual(self.contents(path), expected)
+
+    def test_missing_directory(self):
+        expected = self.contents(self.directory)
+        msgs.write_pack(self.directory)
+        shutil.rmtree(self.directory)
+        msgs._packs.clear()
+        self.assertEqual(self.contents(self.directory), expected)
+
+    def test_keep(self):
+        msgs.setparms(5, 5, seed=12345)
+        stream = msgs.HamStream("test", [self.directory], train=1)
+        expected = [(msg.tag, msg.guts) for msg in stream]
+        self.assertEqual(len(expected), 5)
+        msgs.write_pack(self.directory)
+        shutil.rmtree(self.directory)
+        msgs._packs.clear()
+        stream = msgs.HamStream("test", [self.directory], train=1)
+        self.assertEqual([(msg.tag, msg.guts) for msg in stream], expected)
+
+    def test_empty(self):
+        empty = os.path.join(self.parent, "Set2")
+        os.mkdir(empty)
+        self.assertEqual(msgs.write_pack(empty), 0)
+        self.assertEqual(self.contents(empty + PACK_SUFFIX), [])
+
+class CorpusTokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp("spambayestest")
+        self.cache_file = os.path.join(self.directory, "tokens")
+        self.write("one", "Subject: one\n\nThe first message.\n")
+        self.write("two", "Subject: two\n\nThe second message.\n")
+        self.saved = (options["TestDriver", "token_cache_file"],
+                      options["Tokenizer", "mine_received_headers"])
+        options["TestDriver", "token_cache_file"] = self.cache_file
+        self.saved_tokenize = msgs.tokenize
+
+    def tearDown(self):
+        msgs.tokenize = self.saved_tokenize
+        if msgs._token_cache is not None:
+            msgs._token_cache.close()
+        msgs._token_cache = msgs._token_cache_option = None
+        options["TestDriver", "token_cache_file"], \
+            options["Tokenizer", "mine_received_headers"] = self.saved
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.directory, name), "wb")
+        f.write(text)
+        f.close()
+
+    def tokens(self, name):
+        return list(msgs.Msg(self.directory, name))
+
+    def reopen(self):
+        # Save the cache, and make the next message read it again.
+        msgs._token_cache.close()
+        msgs._token_cache = None
+
+    def no_tokenize(self, text):
+        self.fail("a cached message was tokenized")
+
+    def test_tokens(self):
+        for name in ("one", "two", "one"):
+            msg = msgs.Msg(self.directory, name)
+            self.assertEqual(list(msg), list(tokenize(msg.guts)))
+        self.assertEqual(msgs._token_cache.hits, 1)
+        self.assertEqual(msgs._token_cache.misses, 2)
+
+    def test_saved(self):
+        expected = [self.tokens("one"), self.tokens("two")]
+        self.reopen()
+        msgs.tokenize = self.no_tokenize
+        self.assertEqual([self.tokens("one"), self.tokens("two")], expected)
+
+    def test_changed_text(self):
+        self.tokens("one")
+        self.reopen()
+        self.write("one", "Subject: changed\n\nThe first message.\n")
+        msg = msgs.Msg(self.directory, "one")
+        self.assertEqual(list(msg), list(tokenize(msg.guts)))
+        self.assertEqual(msgs._token_cache.misses, 1)
+
+    def test_changed_options(self):
+        self.tokens("one")
+        self.reopen()
+        options["Tokenizer", "mine_received_headers"] = \
+            not options["Tokenizer", "mine_received_headers"]
+        self.tokens("one")
+        self.assertEqual(msgs._token_cache.misses, 1)
+        # Changing them while the cache is open empties it, too.
+        options["Tokenizer", "mine_received_headers"] = \
+            not options["Tokenizer", "mine_received_headers"]
+        self.tokens("one")
+        self.assertEqual(msgs._token_cache.misses, 2)
+
+    def test_damaged(self):
+        f = open(self.cache_file, "wb")
+        f.write("rubbish")
+        f.close()
+        text = "Subject: one\n\nThe first message.\n"
+        self.assertEqual(self.tokens("one"), list(tokenize(text)))
+
+    def test_disabled(self):
+        options["TestDriver", "token_cache_file"] = ""
+        self.tokens("one")
+        self.assertEqual(msgs._token_cache, None)
+        self.failIf(os.path.exists(self.cache_file))
+
+    def test_slurping(self):
+        # Each message has to be tokenized, to find the URL to slurp.
+        self.tokens("one")
+        tokenized = []
+        def tokenize(text):
+            tokenized.append(text)
+            return self.saved_tokenize(text)
+        msgs.tokenize = tokenize
+        saved = options["URLRetriever", "x-slurp_urls"]
+        options["URLRetriever", "x-slurp_urls"] = True
+        try:
+            self.tokens("one")
+        finally:
+            options["URLRetriever", "x-slurp_urls"] = saved
+        self.assertEqual(len(tokenized), 1)
+        self.assertEqual(msgs._token_cache.hits, 0)
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (MsgPackTest,
+                CorpusTokenCacheTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
@@ -26,6 +26,7 @@ from spambayes.Options import options
 from spambayes.classifier import Classifier
 from sb_imapfilter import run, BadIMAPResponseError, LoginFailure
 from sb_imapfilter import IMAPSession, IMAPMessage, IMAPFolder, IMAPFilter
+from sb_imapfilter import uid_set
 
 IMAP_PORT = 8143
 IMAP_USERNAME = "testu"
@@ -261,7 +262,7 @@ class TestIMAP4Server(Dibbler.BrighterAsyncChat):
 
     def onFetch(self, id, command, args, uid=False):
         msg_nums, msg_parts = args.split(None, 1)
-        msg_nums = msg_nums.split()
+        msg_nums = self.expand_message_set(msg_nums, uid)
         response = {}
         for msg in msg_nums:
             response[msg] = []
@@ -310,8 +311,26 @@ class TestIMAP4Server(Dibbler.BrighterAsyncChat):
                         simple.append('%s\r\n%s)' % (part[0], part[1]))
                 simple = " ".join(simple)
             response[msg] = "* %s %s" % (msg, simple)
-        response_text = "\r\n".join(response.values())
-        return "%s\r\n%s OK FETCH completed\r\n" % (response_text, id)
+        response_text = "".join(["%s\r\n" % (r,) for r in response.values()])
+        return "%s%s OK FETCH completed\r\n" % (response_text, id)
+
+    def expand_message_set(self, message_set, uid=False):
+        """Return the message numbers (or uids) in a message set."""
+        if uid:
+            existing = IMAP_MESSAGES.keys()
+        else:
+            existing = IMAP_UIDS.keys()
+        existing.sort()
+        msg_nums = []
+        for part in message_set.split(','):
+            if ':' in part:
+                first, last = [int(n) for n in part.split(':')]
+                msg_nums.extend([str(n) for n in existing
+                                 if first <= n <= last])
+            elif int(part) in existing:
+                # Like real servers, we ignore messages that don't exist.
+                msg_nums.append(part)
+        return msg_nums
 
     def onUID(self, id, command, args, uid=False):
         actual_command, args = args.split(None, 1)
@@ -569,6 +588,47 @@ class IMAPSessionTest(BaseIMAPFilterTest):
         finally:
             self.imap.file = saved_file
 
+    def test_extract_fetch_data_trailing_uid(self):
+        # Some servers send the UID after the literal.
+        headers = "Subject: Foo\r\n"
+        response = (("7 (RFC822.HEADER {%s}" % (len(headers),), headers),
+                    " UID 107)")
+        data = self.imap.extract_fetch_data(response)
+        self.assertEqual(data["7"]["RFC822.HEADER"], headers)
+        self.assertEqual(data["7"]["UID"], "107")
+
+    def test_uid_set(self):
+        self.assertEqual(uid_set([]), "")
+        self.assertEqual(uid_set(["7"]), "7")
+        self.assertEqual(uid_set(["12", "3", "8", "7", "9", "9"]),
+                         "3,7:9,12")
+
+    def test_fetch_many(self):
+        self.imap.login(IMAP_USERNAME, IMAP_PASSWORD)
+        self.imap.SelectFolder("Inbox")
+        saved = options["imap", "fetch_batch_size"], \
+                options["imap", "pipeline_depth"]
+        # Two batches of two, and one of one, pipelined two at a time.
+        # (103 has no blank line between the headers and the body
+        # that our test server can find, so we leave it out.)
+        options["imap", "fetch_batch_size"] = 2
+        options["imap", "pipeline_depth"] = 2
+        try:
+            uids = ["101", "102", "104", "200", "1"]
+            data = self.imap.fetch_many(uids, ("RFC822.HEADER",))
+        finally:
+            options["imap", "fetch_batch_size"], \
+                options["imap", "pipeline_depth"] = saved
+        # There are no messages with uids 200 and 1.
+        self.assertEqual(len(data), 3)
+        for uid in uids[:-2]:
+            headers = IMAP_MESSAGES[int(uid)].split('\r\n\r\n', 1)[0]
+            self.assertEqual(data[uid]["RFC822.HEADER"], headers)
+        # Nothing should be left behind to confuse the next command.
+        correct = IMAP_FOLDER_LIST[:]
+        correct.sort()
+        self.assertEqual(self.imap.folder_list(), correct)
+
 
 class IMAPMessageTest(BaseIMAPFilterTest):
     def setUp(self):
@@ -686,6 +746,33 @@ class IMAPFolderTest(BaseIMAPFilterTest):
             self.assertEqual(msg.as_string(), msg_correct.as_string())
             keys = keys[1:]
 
+    def test_batches(self):
+        saved = options["imap", "fetch_batch_size"]
+        options["imap", "fetch_batch_size"] = 1
+        try:
+            batches = list(self.folder.batches())
+        finally:
+            options["imap", "fetch_batch_size"] = saved
+        keys = self.folder.keys()
+        self.assertEqual([[msg.uid for msg in batch] for batch in batches],
+                         [keys[i:i+options["imap", "pipeline_depth"]]
+                          for i in range(0, len(keys),
+                                         options["imap", "pipeline_depth"])])
+        for batch in batches:
+            for msg in batch:
+                self.assertEqual(msg.id, self.folder[msg.uid].id)
+
+    def test_prefetch(self):
+        msg = self.folder[101]
+        self.folder.prefetch([msg])
+        self.assertEqual(msg.prefetched, IMAP_MESSAGES[101])
+        # The prefetched substance should be used, not fetched again
+        # (which would need the folder).
+        msg.folder = None
+        msg = msg.get_full_message()
+        self.assert_(msg.got_substance)
+        self.assertEqual(msg["Subject"], "Test")
+
     def test_keys(self):
         keys = self.folder.keys()
         # We get back UIDs, not IDs, so convert to check.
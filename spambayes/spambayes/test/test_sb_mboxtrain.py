@@ -0,0 +1,101 @@
+# Test sb_mboxtrain script.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes.Options import options
+from spambayes.storage import open_storage
+from spambayes.classifier import Classifier
+from spambayes.tokenizer import tokenize
+
+import sb_mboxtrain
+
+MESSAGE = """From spammer@example.com Mon Jan  1 00:00:00 2007
+From: spammer@example.com
+Subject: offer %(i)d
+
+Buy cheap watches now, buy cheap pills today.  Offer number %(i)d
+ends soon, so act fast and save big on everything.
+
+"""
+NMESSAGES = 20
+
+class MboxTrainTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp("spambayestest")
+        self.saved = (options["Classifier", "use_bigrams"],
+                      sb_mboxtrain.loud, sb_mboxtrain.batch,
+                      sb_mboxtrain.processes, sb_mboxtrain.pool,
+                      sb_mboxtrain.use_mmap, sb_mboxtrain.CHUNK_SIZE,
+                      sys.argv)
+        options["Classifier", "use_bigrams"] = True
+        # So that -j has several chunks to hand out.
+        sb_mboxtrain.CHUNK_SIZE = 7
+
+    def tearDown(self):
+        (options["Classifier", "use_bigrams"],
+         sb_mboxtrain.loud, sb_mboxtrain.batch,
+         sb_mboxtrain.processes, sb_mboxtrain.pool,
+         sb_mboxtrain.use_mmap, sb_mboxtrain.CHUNK_SIZE,
+         sys.argv) = self.saved
+        shutil.rmtree(self.directory)
+
+    def train(self, name, *args):
+        """Train a new pickle database on a new copy of the mbox, with
+        the given extra arguments, and return the database."""
+        mbox = os.path.join(self.directory, name + ".mbox")
+        f = open(mbox, "wb")
+        for i in range(NMESSAGES):
+            f.write(MESSAGE % {"i": i})
+        f.close()
+        db = os.path.join(self.directory, name + ".db")
+        sys.argv = ["sb_mboxtrain", "-q", "-p", db, "-s", mbox] + list(args)
+        sb_mboxtrain.processes = 1
+        sb_mboxtrain.pool = None
+        sb_mboxtrain.use_mmap = False
+        sb_mboxtrain.main()
+        return open_storage(db, "pickle", "r")
+
+    def counts(self, bayes):
+        counts = {}
+        for word in bayes._wordinfokeys():
+            record = bayes._wordinfoget(word)
+            counts[word] = (record.spamcount, record.hamcount)
+        return counts
+
+    def test_same_as_learn(self):
+        expected = Classifier()
+        for i in range(NMESSAGES):
+            msg = sb_mboxtrain.get_message(MESSAGE % {"i": i})
+            expected.learn(tokenize(msg), True)
+        self.assert_("bi:buy cheap" in expected._wordinfokeys())
+        for args in ((), ("-B",), ("-j", "2"),
+                     ("-m",), ("-m", "-j", "2")):
+            name = "train%s" % ("".join(args),)
+            bayes = self.train(name, *args)
+            self.assertEqual(sorted(bayes._wordinfokeys()),
+                             sorted(expected._wordinfokeys()))
+            self.assertEqual(self.counts(bayes), self.counts(expected))
+            self.assertEqual((bayes.nspam, bayes.nham), (NMESSAGES, 0))
+            # Every message was written back, marked as trained.
+            f = open(os.path.join(self.directory, name + ".mbox"), "rb")
+            text = f.read()
+            f.close()
+            header = options["Headers", "trained_header_name"] + ": "
+            self.assertEqual(text.count(header), NMESSAGES)
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (MboxTrainTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
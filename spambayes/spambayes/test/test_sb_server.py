@@ -4,8 +4,9 @@
 
 Given no command line options, carries out a test that the
 POP3 proxy can be connected to, that incoming mail is classified,
-that pipelining is removed from the CAPA[bility] query, and that the
-web ui is present.
+that pipelining is removed from the CAPA[bility] query, that many
+email clients can use the proxy at once, that large messages are
+streamed, and that the web ui is present.
 
 The -t option runs a fake POP3 server on port 8110.  This is the
 same server that test uses, and may be separately run for other
@@ -17,6 +18,12 @@ Usage:
 
         options:
             -t      : Runs a fake POP3 server on port 8110 (for testing).
+            -w N    : Classifies messages in N worker threads (see the
+                      pop3proxy classification_threads option).
+            -c N    : Runs N email clients at once in the load test
+                      (default 20).
+            -e NAME : Runs the proxy with the named event loop (select,
+                      poll or epoll; see the globals event_loop option).
             -h      : Displays this help message.
 """
 
@@ -103,6 +110,9 @@ HEADER_EXAMPLE = '%s: xxxxxxxxxxxxxxxxxxxx\r\n' % \
 # Our simulated slow POP3 server transmits about 100 characters per second.
 PER_CHAR_DELAY = 0.01
 
+# The number of email clients that use the proxy at once in the load test.
+LOAD_TEST_CLIENTS = 20
+
 class Listener(Dibbler.Listener):
     """Listener for TestPOP3Server.  Works on port 8110, to co-exist
     with real POP3 servers."""
@@ -253,7 +263,61 @@ class TestPOP3Server(Dibbler.BrighterAsyncChat):
         return "-ERR Unknown command: %s\r\n" % repr(command)
 
 
-def helper():
+def receive(sock, terminator):
+    """Reads from the socket until the data ends with the terminator,
+    or the socket is closed."""
+    response = ''
+    while not response.endswith(terminator):
+        packet = sock.recv(1000)
+        if not packet:
+            break
+        response += packet
+    return response
+
+def runClient(results):
+    """Behaves like an email client, retrieving all the messages through
+    the proxy.  Appends True to results if it all went as expected."""
+    proxy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    proxy.settimeout(30)
+    try:
+        proxy.connect(('localhost', 8111))
+        ok = receive(proxy, '\r\n').startswith("+OK")
+        proxy.sendall("stat\r\n")
+        count = int(receive(proxy, '\r\n').split()[1])
+        ok = count == 3 and ok
+        for i in range(1, count+1):
+            proxy.sendall("retr %d\r\n" % i)
+            response = receive(proxy, '\n.\r\n')
+            header = options["Headers", "classification_header_name"]
+            ok = response.startswith("+OK") and \
+                 response.find(header) >= 0 and ok
+        proxy.sendall("quit\r\n")
+        ok = receive(proxy, '\r\n').startswith("+OK") and ok
+        results.append(ok)
+    finally:
+        proxy.close()
+
+def loadTest(numClients):
+    """Runs numClients email clients against the proxy at once, and
+    checks that they all get all their messages, classified."""
+    import threading
+    results = []
+    clients = [threading.Thread(target=runClient, args=(results,))
+               for i in range(numClients)]
+    start = time.time()
+    for client in clients:
+        client.setDaemon(True)
+        client.start()
+        # The listeners only queue five connections, so don't all
+        # connect in exactly the same instant.
+        time.sleep(0.01)
+    for client in clients:
+        client.join(60)
+    print "%d clients retrieved their mail in %.2f seconds." % \
+          (numClients, time.time() - start)
+    assert results == [True] * numClients
+
+def helper(numClients=LOAD_TEST_CLIENTS):
     """Runs a self-test using TestPOP3Server, a minimal POP3 server
     that serves the example emails above.
     """
@@ -277,7 +341,7 @@ def helper():
         state.bayes.learn(tokenizer.tokenize(spam1), True)
         state.bayes.learn(tokenizer.tokenize(good1), False)
         proxyReady.set()
-        Dibbler.run()
+        Dibbler.run(poller=options["globals", "event_loop"])
 
     testServerThread = threading.Thread(target=runTestServer)
     testServerThread.setDaemon(True)
@@ -336,6 +400,18 @@ def helper():
             response = response + proxy.recv(1000)
         assert response.find(options["Headers", "classification_header_name"]) >= 0
 
+    # Have lots of email clients collect their mail at once.
+    loadTest(numClients)
+
+    # Check that a message longer than the streaming threshold is
+    # classified on its first part, and the rest proxies straight through.
+    options["pop3proxy", "streaming_threshold"] = 200
+    proxy.send("retr 1\r\n")
+    response = receive(proxy, '\n.\r\n')
+    assert response.find(options["Headers", "classification_header_name"]) >= 0
+    assert response.find(spam1.strip().split('\n')[-1]) >= 0
+    options["pop3proxy", "streaming_threshold"] = 0
+
     # Check that the proxy times out when it should.  The consequence here
     # is that the first packet we receive from the proxy will contain a
     # partial message, so we assert for that.  At 100 characters per second
@@ -372,13 +448,14 @@ def helper():
 def test_run():
     # Read the arguments.
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'ht')
+        opts, args = getopt.getopt(sys.argv[1:], 'htw:c:e:')
     except getopt.error, msg:
         print >>sys.stderr, str(msg) + '\n\n' + __doc__
         sys.exit()
 
     state.isTest = True
     runSelfTest = True
+    numClients = LOAD_TEST_CLIENTS
     for opt, arg in opts:
         if opt == '-h':
             print >>sys.stderr, __doc__
@@ -387,13 +464,19 @@ def test_run():
             state.isTest = True
             state.runTestServer = True
             runSelfTest = False
+        elif opt == '-w':
+            options["pop3proxy", "classification_threads"] = int(arg)
+        elif opt == '-c':
+            numClients = int(arg)
+        elif opt == '-e':
+            options["globals", "event_loop"] = arg
 
     state.createWorkers()
 
     if runSelfTest:
         print "\nRunning self-test...\n"
         state.buildServerStrings()
-        helper()
+        helper(numClients)
         print "Self-test passed."   # ...else it would have asserted.
 
     elif state.runTestServer:
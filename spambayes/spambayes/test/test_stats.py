@@ -8,9 +8,9 @@ import unittest
 import sb_test_support
 sb_test_support.fix_sys_path()
 
-from spambayes.Stats import Stats
+from spambayes.Stats import Stats, day_key, DAILY_STATS_KEPT
 from spambayes.Options import options
-from spambayes.message import MessageInfoPickle, Message
+from spambayes.message import MessageInfoPickle, Message, STATS_DAILY_KEY
 
 class StatsTest(unittest.TestCase):
     def setUp(self):
@@ -524,7 +524,82 @@ class StatsTest(unittest.TestCase):
         # Check that there are the right number of messages (assume that
         # the rest is right - if not it should be caught by other tests).
         self.assertEqual(self.s.GetStats()[0], "Messages classified: 3")
-        
+
+    def test_daily(self):
+        self.s.RecordClassification(0.0)
+        self.s.RecordClassification(1.0)
+        self.s.RecordClassification(1.0)
+        self.s.RecordTraining(True, 1.0)
+        daily = self.s.GetDailyStats()
+        self.assertEqual(len(daily), 1)
+        day, counts = daily[0]
+        self.assertEqual(day, day_key())
+        self.assertEqual(counts["num_ham"], 1)
+        self.assertEqual(counts["num_spam"], 2)
+        self.assertEqual(counts["num_unsure"], 0)
+        self.assertEqual(counts["num_trained_ham"], 1)
+        self.assertEqual(counts["num_trained_ham_fp"], 1)
+        # Check that it was stored, too.
+        self.messageinfo_db.close()
+        self.messageinfo_db = MessageInfoPickle(self.messageinfo_db_name)
+        self.s = Stats(options, self.messageinfo_db)
+        self.assertEqual(self.s.GetDailyStats(), daily)
+        self.assertEqual(self.s.totals["num_spam"], 2)
+
+    def test_daily_num_days(self):
+        self.s._Count("num_ham", time.mktime((2007, 1, 1, 12, 0, 0, 0, 1, -1)))
+        self.s._Count("num_ham", time.mktime((2007, 1, 3, 12, 0, 0, 0, 3, -1)))
+        self.s._Count("num_spam",
+                      time.mktime((2007, 1, 2, 12, 0, 0, 0, 2, -1)))
+        self.assertEqual([day for day, counts in self.s.GetDailyStats()],
+                         ["2007-01-01", "2007-01-02", "2007-01-03"])
+        self.assertEqual([day for day, counts in self.s.GetDailyStats(2)],
+                         ["2007-01-02", "2007-01-03"])
+        self.assertEqual(self.s.GetDailyStats(0), [])
+
+    def test_daily_pruned(self):
+        start = time.mktime((2007, 1, 1, 12, 0, 0, 0, 1, -1))
+        for i in xrange(DAILY_STATS_KEPT + 5):
+            self.s._Count("num_ham", start + i * 86400)
+        self.s.RecordClassification(0.0)
+        daily = self.s.GetDailyStats()
+        self.assertEqual(len(daily), DAILY_STATS_KEPT)
+        self.assertEqual(daily[-1][0], day_key())
+        self.assertEqual(self.messageinfo_db.get_daily_statistics(),
+                         self.s.daily)
+
+    def test_daily_reset(self):
+        self.s.RecordClassification(0.0)
+        self.s.ResetTotal(permanently=True)
+        self.assertEqual(self.s.totals["num_ham"], 0)
+        self.assertEqual(self.s.GetDailyStats()[0][1]["num_ham"], 1)
+
+    def test_calculate_daily(self):
+        self._stuff_with_persistent_data()
+        self.s.from_date = time.time() + 100
+        self.s.CalculatePersistentStats()
+        # The messages are too new for the totals, but not for the
+        # daily statistics.
+        self.assertEqual(self.s.GetStats(), ["Messages classified: 0"])
+        daily = self.s.GetDailyStats()
+        self.assertEqual(len(daily), 1)
+        self.assertEqual(daily[0][1]["num_ham"], 3)
+        self.assertEqual(daily[0][1]["num_unsure"], 4)
+        self.assertEqual(self.messageinfo_db.get_daily_statistics(),
+                         self.s.daily)
+
+    def test_totals_without_daily(self):
+        # Totals stored before there were daily statistics are used as
+        # they are, without going through the messages.
+        self._stuff_with_persistent_data()
+        self.s.ResetTotal()
+        self.s.totals["num_spam"] = 10
+        self.messageinfo_db.set_persistent_statistics(self.s.totals)
+        del self.messageinfo_db.db[STATS_DAILY_KEY]
+        self.s = Stats(options, self.messageinfo_db)
+        self.assertEqual(self.s.totals["num_spam"], 10)
+        self.assertEqual(self.s.GetDailyStats(), [])
+
 
 def suite():
     suite = unittest.TestSuite()
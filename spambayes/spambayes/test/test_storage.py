@@ -3,6 +3,7 @@
 import unittest, os, sys
 import glob
 import tempfile
+from array import array
 import cStringIO as StringIO
 
 import sb_test_support
@@ -10,6 +11,13 @@ sb_test_support.fix_sys_path()
 
 from spambayes.storage import ZODBClassifier, CDBClassifier
 from spambayes.storage import DBDictClassifier, PickledClassifier
+from spambayes.storage import PackedPickledClassifier, MmapClassifier
+from spambayes.storage import SQLClassifier, mySQLClassifier
+from spambayes import storage
+from spambayes.classifier import WordInfo
+from spambayes.Options import options
+from spambayes.bloom import BloomFilter
+from spambayes.packedwordinfo import PackedWordInfo, dict_memory_usage
 
 class _StorageTestBase(unittest.TestCase):
     # Subclass must define a concrete StorageClass.
@@ -66,6 +74,52 @@ class _StorageTestBase(unittest.TestCase):
             self.assertEqual(c.nham, count-i-1)
             self.assertEqual(c.nspam, 0)
 
+    def testLearnMany(self):
+        c = self.classifier
+        c.learn(["some", "old"], False)
+        c.learn_many([["some", "simple", "tokens", "some"],
+                      ["some", "other"],
+                      ["ones"]], True)
+        c.learn_many([["some"], ["old", "ones"]], False)
+        self.assertEqual(c.nspam, 3)
+        self.assertEqual(c.nham, 3)
+        self._checkAllWordCounts((("some", 2, 2),
+                                  ("old", 2, 0),
+                                  ("simple", 0, 1),
+                                  ("tokens", 0, 1),
+                                  ("other", 0, 1),
+                                  ("ones", 1, 1)), True)
+
+    def testBulkUpdate(self):
+        c = self.classifier
+        bulk = c.bulk_update()
+        bulk.__enter__()
+        c.learn(["some", "simple"], True)
+        c.learn(["some"], False)
+        # Nothing is applied until the end of the batch.
+        self._checkAllWordCounts((("some", 0, 0),), False)
+        bulk.__exit__(None, None, None)
+        self._checkAllWordCounts((("some", 1, 1),
+                                  ("simple", 0, 1)), True)
+
+        # A batch that fails is thrown away.
+        bulk = c.bulk_update()
+        bulk.__enter__()
+        c.learn(["some"], True)
+        bulk.__exit__(ValueError, ValueError(), None)
+        self.assertEqual(c.nspam, 1)
+        self._checkAllWordCounts((("some", 1, 1),), False)
+
+        # Untraining inside a batch applies the batch first.
+        bulk = c.bulk_update()
+        bulk.__enter__()
+        c.learn(["new"], True)
+        c.unlearn(["new"], True)
+        bulk.__exit__(None, None, None)
+        self.assertEqual(c.nspam, 1)
+        self._checkAllWordCounts((("some", 1, 1),
+                                  ("new", 0, 0)), True)
+
     def _checkWordCounts(self, word, expected_ham, expected_spam):
         assert word
         info = self.classifier._wordinfoget(word)
@@ -171,6 +225,209 @@ class _StorageTestBase(unittest.TestCase):
 class PickleStorageTestCase(_StorageTestBase):
     StorageClass = PickledClassifier
 
+class JournalledPickleStorageTestCase(_StorageTestBase):
+    StorageClass = PickledClassifier
+
+    def setUp(self):
+        self.saved = options["Storage", "pickle_journal"], \
+                     options["Storage", "pickle_journal_size"]
+        options["Storage", "pickle_journal"] = True
+        _StorageTestBase.setUp(self)
+
+    def tearDown(self):
+        _StorageTestBase.tearDown(self)
+        options["Storage", "pickle_journal"], \
+            options["Storage", "pickle_journal_size"] = self.saved
+
+    def testJournal(self):
+        c = self.classifier
+        c.learn(["some", "simple", "tokens"], True)
+        # The first store has to write the pickle.
+        c.store()
+        self.failIf(os.path.exists(c.journal_name))
+        size = os.path.getsize(self.db_name)
+        c.learn(["some", "other"], False)
+        c.unlearn(["some", "simple", "tokens"], True)
+        c.store()
+        self.assertEqual(os.path.getsize(self.db_name), size)
+        self.assert_(os.path.exists(c.journal_name))
+        # Another classifier sees the changes, without the journal having
+        # been folded in.
+        other = self.StorageClass(self.db_name)
+        self.assertEqual((other.nspam, other.nham), (0, 1))
+        self.assertEqual(other.wordinfo.get("simple"), None)
+        self.assertEqual(other.wordinfo["some"].hamcount, 1)
+        self.assertEqual(other.wordinfo["other"].hamcount, 1)
+        # Closing folds it in.
+        c.close()
+        self.failIf(os.path.exists(c.journal_name))
+        other.load()
+        self.assertEqual(other.wordinfo["other"].hamcount, 1)
+
+    def testCompact(self):
+        options["Storage", "pickle_journal_size"] = 1
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        c.learn(["some"], True)
+        c.store()
+        # The journal is now too big, so the next store writes the pickle.
+        c.learn(["more"], False)
+        c.store()
+        self.failIf(os.path.exists(c.journal_name))
+        self.classifier = self.StorageClass(self.db_name)
+        self._checkAllWordCounts((("some", 0, 2),
+                                  ("more", 1, 0)), False)
+
+    def testTruncatedJournal(self):
+        c = self.classifier
+        c.learn(["some"], True)
+        c.store()
+        c.learn(["tokens"], True)
+        c.store()
+        c.learn(["more"], True)
+        c.store()
+        fp = open(c.journal_name, "r+b")
+        fp.seek(-5, 2)
+        fp.truncate()
+        fp.close()
+        c.load()
+        self.assertEqual(c.nspam, 2)
+        self._checkAllWordCounts((("tokens", 0, 1),
+                                  ("more", 0, 0)), False)
+
+class PackedPickleStorageTestCase(_StorageTestBase):
+    StorageClass = PackedPickledClassifier
+
+    def testLoadPlainPickle(self):
+        # A pickle written by a PickledClassifier can be loaded, and is
+        # converted.
+        self.classifier.close()
+        c = PickledClassifier(self.db_name)
+        c.learn(["some", "simple", "tokens"], True)
+        c.store()
+        c.close()
+        self.classifier = self.StorageClass(self.db_name)
+        self.assert_(isinstance(self.classifier.wordinfo, PackedWordInfo))
+        self._checkAllWordCounts((("some", 0, 1),
+                                  ("simple", 0, 1),
+                                  ("tokens", 0, 1)), True)
+
+class PackedWordInfoTestCase(unittest.TestCase):
+    def _record(self, spamcount, hamcount):
+        record = WordInfo()
+        record.__setstate__((spamcount, hamcount))
+        return record
+
+    def testMapping(self):
+        expected = {}
+        packed = PackedWordInfo()
+        for i in xrange(1000):
+            word = "word%d" % (i,)
+            expected[word] = (i, i % 7)
+            packed[word] = self._record(i, i % 7)
+        # Delete and re-add enough words to force the table to be rebuilt.
+        for i in xrange(0, 1000, 3):
+            word = "word%d" % (i,)
+            del expected[word]
+            del packed[word]
+        self.assertRaises(KeyError, packed.__delitem__, "word0")
+        for i in xrange(0, 300, 9):
+            word = "word%d" % (i,)
+            expected[word] = (1, 2)
+            packed[word] = self._record(1, 2)
+        packed[u"unicode\xe9"] = self._record(3, 4)
+        expected[u"unicode\xe9".encode("utf-8")] = (3, 4)
+
+        self.assertEqual(len(packed), len(expected))
+        self.assertEqual(sorted(packed.keys()), sorted(expected.keys()))
+        for word, counts in expected.iteritems():
+            self.assert_(word in packed)
+            self.assertEqual(packed[word].__getstate__(), counts)
+        for word, record in packed.iteritems():
+            self.assertEqual(record.__getstate__(), expected[word])
+        self.assertEqual(packed.get("word3"), None)
+        self.assertRaises(KeyError, packed.__getitem__, "word3")
+
+    def testRecordsAreCopies(self):
+        packed = PackedWordInfo()
+        packed["word"] = self._record(1, 1)
+        record = packed["word"]
+        record.spamcount += 1
+        self.assertEqual(packed["word"].spamcount, 1)
+        packed["word"] = record
+        self.assertEqual(packed["word"].spamcount, 2)
+
+    def testPickledTable(self):
+        packed = PackedWordInfo()
+        for i in xrange(100):
+            packed["word%d" % (i,)] = self._record(i, 1)
+        state = packed.__getstate__()
+        copy = PackedWordInfo()
+        copy.__setstate__(state)
+        self.assertEqual(copy["word42"].__getstate__(), (42, 1))
+        # An old pickle's table was made with a different hash, so it is
+        # made again.
+        table = array('i')
+        table.fromstring(state[5])
+        table.reverse()
+        copy.__setstate__(state[:5] + (table.tostring(),))
+        self.assertEqual(len(copy), 100)
+        for i in xrange(100):
+            self.assertEqual(copy["word%d" % (i,)].__getstate__(), (i, 1))
+
+    def testPickleLeavesTable(self):
+        packed = PackedWordInfo()
+        for i in xrange(100):
+            packed["word%d" % (i,)] = self._record(i, 1)
+        for i in xrange(0, 100, 2):
+            del packed["word%d" % (i,)]
+        buffers = (packed._blob, packed._offsets, packed._spamcounts,
+                   packed._hamcounts, packed._table)
+        state = packed.__getstate__()
+        self.assertEqual((packed._blob, packed._offsets, packed._spamcounts,
+                          packed._hamcounts, packed._table), buffers)
+        copy = PackedWordInfo()
+        copy.__setstate__(state)
+        self.assertEqual(len(copy._spamcounts), 50)
+        self.assertEqual(sorted(copy.keys()), sorted(packed.keys()))
+
+    def testPickledElsewhere(self):
+        packed = PackedWordInfo()
+        for i in xrange(100):
+            packed["word%d" % (i,)] = self._record(i, 1)
+        state = packed.__getstate__()
+        other = {"little": "big", "big": "little"}[sys.byteorder]
+        # As pickled on a machine with the other byte order, and (where
+        # longs are longer than ints) on one with longer ints.
+        swapped = []
+        longer = []
+        for typecode, data in zip("IIIi", state[2:6]):
+            a = array(typecode)
+            a.fromstring(data)
+            longer.append(array({'I': 'L', 'i': 'l'}[typecode],
+                                a).tostring())
+            a.byteswap()
+            swapped.append(a.tostring())
+        elsewhere = [(swapped, other, array('i').itemsize)]
+        if array('l').itemsize != array('i').itemsize:
+            elsewhere.append((longer, sys.byteorder, array('l').itemsize))
+        for arrays, byteorder, itemsize in elsewhere:
+            copy = PackedWordInfo()
+            copy.__setstate__(state[:2] + tuple(arrays) +
+                              (state[6], byteorder, itemsize))
+            self.assertEqual(copy._table, packed._table)
+            for i in xrange(100):
+                self.assertEqual(copy["word%d" % (i,)].__getstate__(),
+                                 (i, 1))
+
+    def testMemoryUsage(self):
+        wordinfo = {}
+        for i in xrange(10000):
+            wordinfo["word%d" % (i,)] = self._record(i, i)
+        packed = PackedWordInfo(wordinfo)
+        self.assert_(packed.memory_usage() < dict_memory_usage(wordinfo) / 2)
+
 class DBStorageTestCase(_StorageTestBase):
     StorageClass = DBDictClassifier
 
@@ -195,22 +452,356 @@ class DBStorageTestCase(_StorageTestBase):
             if os.path.isfile(name):
                 os.remove(name)
 
+class BloomDBStorageTestCase(_StorageTestBase):
+    StorageClass = DBDictClassifier
+
+    def setUp(self):
+        self.saved = options["Storage", "use_bloom_filter"]
+        options["Storage", "use_bloom_filter"] = True
+        _StorageTestBase.setUp(self)
+
+    def tearDown(self):
+        _StorageTestBase.tearDown(self)
+        options["Storage", "use_bloom_filter"] = self.saved
+
+    def reopen(self):
+        self.classifier.close()
+        self.classifier = self.StorageClass(self.db_name)
+        return self.classifier
+
+    def testLookupsSaved(self):
+        c = self.classifier
+        c.learn(["some", "simple", "tokens"], True)
+        c.learn(["some", "simple"], False)
+        c.store()
+        c = self.reopen()
+        self.assert_(c.bloom.signature is not None)
+        self._checkAllWordCounts((("some", 1, 1),
+                                  ("tokens", 0, 1)), False)
+        for i in xrange(100):
+            self.assertEqual(c._wordinfoget("missing%d" % (i,)), None)
+        stats = c.bloom_stats
+        self.assertEqual(stats.saved + stats.false_positives, 100)
+        self.assert_(stats.false_positive_rate() < 0.1)
+
+    def testChangedDatabase(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        c.close()
+        # Something that doesn't know about the filter adds a word.
+        options["Storage", "use_bloom_filter"] = False
+        c = self.classifier = self.StorageClass(self.db_name)
+        c.learn(["more"], False)
+        c.store()
+        options["Storage", "use_bloom_filter"] = True
+        c = self.reopen()
+        self._checkAllWordCounts((("more", 1, 0),
+                                  ("tokens", 0, 1)), False)
+
+    def testReadOnly(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        reader = self.StorageClass(self.db_name, 'r')
+        c.learn(["more"], False)
+        c = self.reopen()
+        saved = open(c._bloom_filename(), "rb").read()
+        reader.close()
+        self.assertEqual(open(c._bloom_filename(), "rb").read(), saved)
+        self.assert_("more" in c.bloom)
+
+    def testOtherWriter(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        c = self.reopen()
+        other = self.StorageClass(self.db_name)
+        c.learn(["more"], False)
+        c = self.reopen()
+        # The other classifier's filter doesn't have "more", so it mustn't
+        # replace the one just saved.
+        other.close()
+        self.failIf(os.path.exists(c._bloom_filename()))
+
+    def testSavedByStore(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        reader = self.StorageClass(self.db_name, 'r')
+        try:
+            self.assert_(reader.bloom is not None)
+            self.assertEqual(reader._wordinfoget("some").spamcount, 1)
+        finally:
+            reader.close()
+
+    def testCountsNewWords(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.learn(["some", "tokens", "more"], True)
+        c.store()
+        c.learn(["some", "tokens", "more"], False)
+        self.assertEqual(c.bloom.count, 3)
+
+    def testReaderDoesNotRebuild(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        os.remove(c._bloom_filename())
+        test = self
+        class NoRebuild(self.StorageClass):
+            def _rebuild_bloom_filter(self):
+                test.fail("a read-only classifier rebuilt the filter")
+        reader = NoRebuild(self.db_name, 'r')
+        try:
+            self.assertEqual(reader.bloom, None)
+            self.assertEqual(reader._wordinfoget("tokens").spamcount, 1)
+        finally:
+            reader.close()
+
+    def testReaderSeesNewWords(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.store()
+        reader = self.StorageClass(self.db_name, 'r')
+        saved_interval = storage.BLOOM_CHECK_INTERVAL
+        storage.BLOOM_CHECK_INTERVAL = 0
+        try:
+            self.assertEqual(reader._wordinfoget("more"), None)
+            saved = reader.bloom_stats.saved
+            c.learn(["more", "more words"], False)
+            c.store()
+            # The reader's filter doesn't say "missing" any more (whether
+            # the word can be read depends on the dbm module); it has the
+            # writer's new one.
+            reader._wordinfoget("more")
+            self.assertEqual(reader.bloom_stats.saved, saved)
+            self.assert_("more words" in reader.bloom)
+        finally:
+            storage.BLOOM_CHECK_INTERVAL = saved_interval
+            reader.close()
+
+    def testRebuild(self):
+        c = self.classifier
+        c.learn(["some", "tokens"], True)
+        c.bloom.stale = c.bloom.capacity
+        c.store()
+        self.assertEqual(c.bloom.stale, 0)
+        self._checkAllWordCounts((("some", 0, 1),
+                                  ("tokens", 0, 1)), False)
+
+class CachedDBStorageTestCase(_StorageTestBase):
+    StorageClass = DBDictClassifier
+
+    def setUp(self):
+        self.saved = options["Storage", "dbm_cache_size"]
+        options["Storage", "dbm_cache_size"] = 2
+        _StorageTestBase.setUp(self)
+
+    def tearDown(self):
+        _StorageTestBase.tearDown(self)
+        options["Storage", "dbm_cache_size"] = self.saved
+
+    def testChangesNotEvicted(self):
+        c = self.classifier
+        c.learn(["one", "two", "three", "four"], True)
+        c.learn(["one", "two", "three", "four"], False)
+        # All four words are changed, so none can be evicted yet.
+        self.assertEqual(len(c.wordinfo), 4)
+        self.assertEqual(c.wordinfo_stats.evictions, 0)
+        c.store()
+        # Once they are stored, the cache shrinks back to its size as soon
+        # as something new is added.
+        self._checkAllWordCounts((("one", 1, 1),
+                                  ("five", 0, 0)), False)
+        c.learn(["five"], True)
+        c.learn(["five"], False)
+        self.assertEqual(len(c.wordinfo), 2)
+        self.assertEqual(c.wordinfo_stats.evictions, 3)
+        stats = c.wordinfo_stats
+        misses = stats.misses
+        c._wordinfoget("five")
+        self.assertEqual(stats.misses, misses)
+        self._checkAllWordCounts((("two", 1, 1),
+                                  ("four", 1, 1)), False)
+        self.assertEqual(stats.misses, misses + 2)
+
+class BloomFilterTestCase(unittest.TestCase):
+    def testNoFalseNegatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        words = ["word%d" % (i,) for i in xrange(1000)]
+        bloom.update(words)
+        self.assertEqual(bloom.count, 1000)
+        for word in words:
+            self.assert_(word in bloom)
+        self.failIf(bloom.is_full())
+        false_positives = [1 for i in xrange(10000)
+                           if "other%d" % (i,) in bloom]
+        self.assert_(len(false_positives) < 300)
+
+    def testCountsEveryWord(self):
+        # Once every bit is set, adding a word sets no new ones, but it
+        # still counts.
+        bloom = BloomFilter(1, 0.5)
+        words = ["word%d" % (i,) for i in xrange(100)]
+        bloom.update(words)
+        self.assertEqual(bloom.count, 100)
+        self.assert_(bloom.is_full())
+
 class CDBStorageTestCase(_StorageTestBase):
     StorageClass = CDBClassifier
 
+class MmapStorageTestCase(_StorageTestBase):
+    StorageClass = MmapClassifier
+
+    def testLookupsAreNotCached(self):
+        c = self.classifier
+        c.learn(["some", "simple", "tokens"], True)
+        c.store()
+        self.assertEqual(c.wordinfo, {})
+        self._checkAllWordCounts((("some", 0, 1),), False)
+        self.assertEqual(c.wordinfo, {})
+
+    def testSharedFile(self):
+        c = self.classifier
+        c.learn(["some", "simple", "tokens"], True)
+        c.store()
+        other = self.StorageClass(self.db_name)
+        try:
+            self.assertEqual(other.nspam, 1)
+            self.assertEqual(other._wordinfoget("some").spamcount, 1)
+            self.assertEqual(sorted(other._wordinfokeys()),
+                             ["simple", "some", "tokens"])
+        finally:
+            other.close()
+
+class _SQLiteCursor:
+    # Adapt the "format" parameter style that SQLClassifier uses to
+    # sqlite's "qmark" style, and count the queries.
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.cursor = classifier.db.cursor()
+
+    def execute(self, sql, params=()):
+        self.classifier.queries += 1
+        self.cursor.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql, seq_of_params):
+        self.classifier.queries += 1
+        self.cursor.executemany(sql.replace("%s", "?"), seq_of_params)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+class SQLiteClassifier(SQLClassifier):
+    # SQLClassifier has no concrete subclass that can be tested without a
+    # database server, so use sqlite.
+    table_definition = ("create table bayes ("
+                        "  word varchar(255) not null default '',"
+                        "  nspam integer not null default 0,"
+                        "  nham integer not null default 0,"
+                        "  primary key(word)"
+                        ")")
+
+    def load(self):
+        import sqlite3
+        self.queries = 0
+        self.db = sqlite3.connect(self.db_name)
+        self.db.text_factory = str
+        c = self.cursor()
+        c.execute("select count(*) from sqlite_master where name='bayes'")
+        if not c.fetchall()[0][0]:
+            self.create_bayes()
+        row = self._get_row(self.statekey)
+        if row:
+            unused, self.nspam, self.nham = self._unpack_row(row)
+        else:
+            self.nspam = self.nham = 0
+
+    def close(self):
+        self.db.close()
+
+    def cursor(self):
+        return _SQLiteCursor(self)
+
+    def fetchall(self, c):
+        return c.fetchall()
+
+    def commit(self, _c):
+        self.db.commit()
+
+    def _unpack_row(self, row):
+        return row
+
+class SQLStorageTestCase(_StorageTestBase):
+    StorageClass = SQLiteClassifier
+
+    def test_bug777026(self):
+        # There's no wordinfo dictionary to clone a record from.
+        pass
+
+    def testQueriesPerMessage(self):
+        c = self.classifier
+        words = ["word%d" % i for i in range(50)]
+        c.queries = 0
+        c.learn(words, True)
+        # One query to fetch the rows, and one to write each kind of
+        # change.
+        self.assertEqual(c.queries, 2)
+        c.queries = 0
+        c.learn(words[:25] + ["new"], False)
+        self.assertEqual(c.queries, 3)
+        c.queries = 0
+        c.unlearn(words[25:], True)
+        self.assertEqual(c.queries, 2)
+        self.assertEqual(sorted(c._wordinfokeys()),
+                         sorted(["new"] + words[:25]))
+        self.assertEqual(c._wordinfoget("word0").__getstate__(), (1, 1))
+        c.queries = 0
+        c.spamprob(words + ["unknown"])
+        self.assertEqual(c.queries, 1)
+
+class MySQLConnectionKeyTestCase(unittest.TestCase):
+    class Unloaded(mySQLClassifier):
+        # Don't connect to a server.
+        def load(self):
+            pass
+
+    def testConnectionKey(self):
+        key = self.Unloaded("host=db user=sb dbname=sb").connection_key()
+        for dsn in ("host=db user=sb dbname=sb pass=secret",
+                    "host=db user=sb dbname=sb port=3307",
+                    "host=db user=sb dbname=other"):
+            self.assertNotEqual(self.Unloaded(dsn).connection_key(), key)
+        self.assertEqual(self.Unloaded("host=db user=sb dbname=sb "
+                                       "port=3306").connection_key(), key)
+
 class ZODBStorageTestCase(_StorageTestBase):
     StorageClass = ZODBClassifier
 
 def suite():
     suite = unittest.TestSuite()
     clses = (PickleStorageTestCase,
+             JournalledPickleStorageTestCase,
+             PackedPickleStorageTestCase,
+             PackedWordInfoTestCase,
              CDBStorageTestCase,
+             MmapStorageTestCase,
+             BloomFilterTestCase,
+             MySQLConnectionKeyTestCase,
              )
+    try:
+        import sqlite3
+    except ImportError:
+        print "Skipping SQL tests, sqlite3 not available"
+    else:
+        clses += (SQLStorageTestCase,)
     import bsddb
     from spambayes.port import gdbm
     
     if gdbm or bsddb:
-        clses += (DBStorageTestCase,)
+        clses += (DBStorageTestCase, CachedDBStorageTestCase,
+                  BloomDBStorageTestCase)
     else:
         print "Skipping dbm tests, no dbm module available"
 
@@ -0,0 +1,190 @@
+# Test spambayes.tokenizer module.
+
+import os
+import sys
+import time
+import unittest
+import threading
+
+import sb_test_support
+sb_test_support.fix_sys_path()
+
+from spambayes import classifier
+from spambayes.Options import options
+from spambayes import tokenizer
+from spambayes.tokenizer import Tokenizer
+from spambayes.lrucache import LRUCache, CacheStats
+
+TEMP_DBM_NAME = os.path.join(os.path.dirname(__file__), "temp.tokcache")
+
+MESSAGE = """\
+From: someone@example.com
+To: someone.else@example.com
+Subject: Lunch
+
+Shall we meet for lunch tomorrow?  There's a new place on the corner.
+"""
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        c = LRUCache(3)
+        for key in "abc":
+            c[key] = key.upper()
+        # Using 'a' makes 'b' the least recently used.
+        self.assertEqual(c.get("a"), "A")
+        c["d"] = "D"
+        self.assertEqual(len(c), 3)
+        self.assert_("b" not in c)
+        self.assertEqual(c.popitem(), ("c", "C"))
+        self.assertEqual(c.get("b", "missing"), "missing")
+        del c["a"]
+        self.assertEqual(c.keys(), ["d"])
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertRaises(KeyError, c.popitem)
+
+    def test_pinned(self):
+        stats = CacheStats()
+        c = LRUCache(2, stats)
+        c["a"] = "A"
+        c.pin("a")
+        c["b"] = "B"
+        c["c"] = "C"
+        # 'a' is the least recently used, but is pinned.
+        self.assertEqual(sorted(c.keys()), ["a", "c"])
+        self.assertEqual(stats.evictions, 1)
+        c.pin("c")
+        c["d"] = "D"
+        # Everything is pinned, so the cache grows.
+        self.assertEqual(len(c), 3)
+        self.assertEqual(stats.evictions, 1)
+        c["a"] = "AA"
+        self.assertEqual(c["a"], "AA")
+        c.unpin_all()
+        self.assertEqual(len(c), 3)
+        # 'a' and 'c' are now more recently used than 'd'.
+        c["e"] = "E"
+        self.assertEqual(len(c), 2)
+        self.assert_("e" in c)
+        self.failIf("d" in c)
+        self.assertEqual(stats.evictions, 3)
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = options["Tokenizer", "x-token_cache_size"], \
+                     options["Tokenizer", "x-token_cache_file"], \
+                     options["Tokenizer", "mine_received_headers"]
+        options["Tokenizer", "x-token_cache_size"] = 2
+        self.tokenizer = Tokenizer()
+
+    def tearDown(self):
+        if self.tokenizer.token_cache is not None:
+            self.tokenizer.token_cache.close()
+        options["Tokenizer", "x-token_cache_size"], \
+            options["Tokenizer", "x-token_cache_file"], \
+            options["Tokenizer", "mine_received_headers"] = self.saved
+        for name in os.listdir(os.path.dirname(TEMP_DBM_NAME) or "."):
+            if name.startswith(os.path.basename(TEMP_DBM_NAME)):
+                os.remove(os.path.join(os.path.dirname(TEMP_DBM_NAME),
+                                       name))
+
+    def uncached(self, text):
+        return list(self.tokenizer._tokenize(text))
+
+    def test_hits(self):
+        t = self.tokenizer
+        expected = self.uncached(MESSAGE)
+        self.assertEqual(list(t.tokenize(MESSAGE)), expected)
+        self.assertEqual(list(t.tokenize(MESSAGE)), expected)
+        stats = t.token_cache.stats
+        self.assertEqual((stats.hits, stats.misses), (1, 1))
+        self.assertEqual(stats.hit_rate(), 0.5)
+
+    def test_size_limit(self):
+        t = self.tokenizer
+        texts = [MESSAGE.replace("Lunch", subject)
+                 for subject in ("One", "Two", "Three")]
+        for text in texts:
+            list(t.tokenize(text))
+        self.assertEqual(len(t.token_cache.tokens), 2)
+        list(t.tokenize(texts[0]))
+        self.assertEqual(t.token_cache.stats.hits, 0)
+
+    def test_options_change(self):
+        t = self.tokenizer
+        list(t.tokenize(MESSAGE))
+        options["Tokenizer", "mine_received_headers"] = \
+            not options["Tokenizer", "mine_received_headers"]
+        self.assertEqual(list(t.tokenize(MESSAGE)), self.uncached(MESSAGE))
+        stats = t.token_cache.stats
+        self.assertEqual((stats.hits, stats.misses, stats.invalidations),
+                         (0, 2, 1))
+
+    def test_slurp_option(self):
+        # Every message has to be tokenized while slurping, to find the
+        # URL to slurp.
+        t = self.tokenizer
+        list(t.tokenize(MESSAGE))
+        text = MESSAGE + "http://www.example.com/lunch\n"
+        saved = options["URLRetriever", "x-slurp_urls"], \
+                tokenizer.crack_urls
+        options["URLRetriever", "x-slurp_urls"] = True
+        tokenizer.crack_urls = tokenizer.SlurpingURLStripper().analyze
+        try:
+            for i in range(2):
+                classifier.slurp_wordstream = None
+                self.assertEqual(list(t.tokenize(text)),
+                                 self.uncached(text))
+                self.assertEqual(classifier.slurp_wordstream,
+                                 ("http", "www.example.com/lunch"))
+        finally:
+            options["URLRetriever", "x-slurp_urls"], \
+                tokenizer.crack_urls = saved
+            classifier.slurp_wordstream = None
+        stats = t.token_cache.stats
+        self.assertEqual((stats.hits, stats.misses), (0, 1))
+
+    def test_disk_cache(self):
+        options["Tokenizer", "x-token_cache_file"] = TEMP_DBM_NAME
+        t = self.tokenizer
+        expected = self.uncached(MESSAGE)
+        list(t.tokenize(MESSAGE))
+        t.token_cache.close()
+        # A new cache starts with nothing in memory, so the tokens must
+        # come from the file.
+        t = self.tokenizer = Tokenizer()
+        self.assertEqual(list(t.tokenize(MESSAGE)), expected)
+        self.assertEqual(t.token_cache.stats.hits, 1)
+
+    def test_one_cache_between_threads(self):
+        created = []
+        saved = tokenizer.TokenCache
+        class SlowTokenCache(saved):
+            def __init__(self, *args):
+                created.append(self)
+                # Give the other thread time to look for a cache too.
+                time.sleep(0.1)
+                saved.__init__(self, *args)
+        tokenizer.TokenCache = SlowTokenCache
+        try:
+            threads = [threading.Thread(target=self.tokenizer.tokenize,
+                                        args=(MESSAGE,))
+                       for i in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            tokenizer.TokenCache = saved
+        self.assertEqual(created, [self.tokenizer.token_cache])
+
+def suite():
+    suite = unittest.TestSuite()
+    for cls in (LRUCacheTest,
+                TokenCacheTest,
+               ):
+        suite.addTest(unittest.makeSuite(cls))
+    return suite
+
+if __name__=='__main__':
+    sb_test_support.unittest_main(argv=sys.argv + ['suite'])
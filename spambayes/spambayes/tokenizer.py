@@ -14,11 +14,22 @@ import os
 import binascii
 import urlparse
 import urllib
+import atexit
+import threading
+import cPickle as pickle
+from hashlib import md5
 
 from spambayes import classifier
+from spambayes import dbmstorage
 from spambayes.Options import options
+from spambayes.lrucache import LRUCache, CacheStats
 
-from spambayes.mboxutils import get_message
+from spambayes.mboxutils import get_message, as_string
+
+# Tokenizing reads the Tokenizer options many times for each message (and
+# some for each word), so we use a snapshot of them (which is kept up to
+# date) rather than looking each one up in options.
+tokenizer_options = options.snapshot("Tokenizer")
 
 try:
     from spambayes import dnscache
@@ -30,7 +41,6 @@ except (IOError, ImportError):
         def lookup(*args):
             return []
 else:
-    import atexit
     atexit.register(cache.close)
 
  
@@ -716,7 +726,7 @@ def tokenize_word(word, _len=len, maxword=options["Tokenizer",
             # rate, but is neutral for the f-p rate.  I don't know why!
             # XXX Figure out why, and/or see if some other way of summarizing
             # XXX this info has greater benefit.
-            if options["Tokenizer", "generate_long_skips"]:
+            if tokenizer_options.generate_long_skips:
                 yield "skip:%c %d" % (word[0], n // 10 * 10)
             if has_highbit_char(word):
                 hicount = 0
@@ -1034,7 +1044,7 @@ urlsep_re = re.compile(r"[;?:@&=+,$.]")
 class URLStripper(Stripper):
     def __init__(self):
         # The empty regexp matches anything at once.
-        if options["Tokenizer", "x-fancy_url_recognition"]:
+        if tokenizer_options.x_fancy_url_recognition:
             search = url_fancy_re.search
         else:
             search = url_re.search
@@ -1053,7 +1063,7 @@ class URLStripper(Stripper):
         tokens = ["proto:" + proto]
         pushclue = tokens.append
 
-        if options["Tokenizer", "x-pick_apart_urls"]:
+        if tokenizer_options.x_pick_apart_urls:
             url = proto + "://" + guts
 
             escapes = re.findall(r'%..', guts)
@@ -1074,7 +1084,7 @@ class URLStripper(Stripper):
             except ValueError:
                 pushclue("url:invalid-url")
             else:
-                if options["Tokenizer", "x-lookup_ip"]:
+                if tokenizer_options.x_lookup_ip:
                     ips = cache.lookup(netloc)
                     if not ips:
                         pushclue("url-ip:lookup error")
@@ -1224,6 +1234,112 @@ breaking_entity_re = re.compile(r"""
     >
 """, re.VERBOSE)
 
+def token_options():
+    """Return the options that the tokens depend on (that is, all of the
+    Tokenizer ones except those for caching tokens).  The caches aren't
+    used while x-slurp_urls is on."""
+    own = ("x-token_cache_size", "x-token_cache_file")
+    return [options.get_option("Tokenizer", name)
+            for name in options.options_in_section("Tokenizer")
+            if name not in own]
+
+class TokenCache:
+    """Remember the tokens generated for recently tokenized messages.
+
+    Messages are recognised by the MD5 digest of their text, and the most
+    recently used 'size' of them are kept in memory.  If a filename is
+    given, the tokens are also kept in a dbm database (without any limit
+    on its size), so that they can be reused in later sessions.
+
+    Everything is thrown away if any of the tokenizer options change,
+    since the tokens might then be different.  (Tokenizer doesn't use
+    the cache while x-slurp_urls is on.)
+
+    A TokenCache can be shared between threads (messages are tokenized
+    outside the lock, so they can be tokenized in parallel).
+    """
+    # Key for the option values the database's tokens were generated with.
+    # Digests are 32 characters long, so this can't clash with them.
+    OPTIONS_KEY = "options"
+
+    def __init__(self, size, filename=""):
+        self.size = size
+        self.filename = filename
+        self.stats = CacheStats()
+        self.tokens = LRUCache(size, self.stats)
+        self._lock = threading.RLock()
+        self._options = token_options()
+        self._fingerprint = self.fingerprint()
+        self.db = None
+        if filename:
+            self.db = dbmstorage.open(filename, "c")
+            if self.db.has_key(self.OPTIONS_KEY) and \
+               self.db[self.OPTIONS_KEY] != repr(self._fingerprint):
+                self.db.close()
+                self.db = dbmstorage.open(filename, "n")
+            self.db[self.OPTIONS_KEY] = repr(self._fingerprint)
+            atexit.register(self.close)
+
+    def fingerprint(self):
+        return tuple([opt.get() for opt in self._options])
+
+    def check_options(self):
+        """Throw everything away if the tokenizer options have changed."""
+        fingerprint = self.fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        self._fingerprint = fingerprint
+        self.tokens.clear()
+        self.stats.invalidations += 1
+        if self.db is not None:
+            self.db.close()
+            self.db = dbmstorage.open(self.filename, "n")
+            self.db[self.OPTIONS_KEY] = repr(fingerprint)
+
+    def get_tokens(self, obj, tokenize):
+        """Return a tuple of the tokens for obj (a string, file or
+        Message), calling tokenize(obj) to generate them if necessary."""
+        if hasattr(obj, "read"):
+            obj = obj.read()
+        text = as_string(obj)
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        key = md5(text).hexdigest()
+        self._lock.acquire()
+        try:
+            self.check_options()
+            tokens = self.tokens.get(key)
+            if tokens is not None:
+                self.stats.hits += 1
+                return tokens
+            if self.db is not None and self.db.has_key(key):
+                self.stats.hits += 1
+                tokens = pickle.loads(self.db[key])
+                self.tokens[key] = tokens
+                return tokens
+            self.stats.misses += 1
+        finally:
+            self._lock.release()
+        tokens = tuple(tokenize(obj))
+        self._lock.acquire()
+        try:
+            if self.db is not None:
+                self.db[key] = pickle.dumps(tokens, 2)
+            self.tokens[key] = tokens
+        finally:
+            self._lock.release()
+        return tokens
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+        finally:
+            self._lock.release()
+
+
 class Tokenizer:
 
     date_hms_re = re.compile(r' (?P<hour>[0-9][0-9])'
@@ -1256,7 +1372,32 @@ class Tokenizer:
     def get_message(self, obj):
         return get_message(obj)
 
+    token_cache = None
+    # Several threads may tokenize at once, but only one of them should
+    # open the cache (and its database).
+    _token_cache_lock = threading.Lock()
+
     def tokenize(self, obj):
+        size = tokenizer_options.x_token_cache_size
+        # Tokenizing a message also tells the classifier which URL to
+        # slurp (in classifier.slurp_wordstream), which cached tokens
+        # wouldn't do.
+        if size <= 0 or options["URLRetriever", "x-slurp_urls"]:
+            return self._tokenize(obj)
+        filename = tokenizer_options.x_token_cache_file
+        self._token_cache_lock.acquire()
+        try:
+            cache = self.token_cache
+            if cache is None or cache.size != size or \
+               cache.filename != filename:
+                if cache is not None:
+                    cache.close()
+                cache = self.token_cache = TokenCache(size, filename)
+        finally:
+            self._token_cache_lock.release()
+        return iter(cache.get_tokens(obj, self._tokenize))
+
+    def _tokenize(self, obj):
         msg = self.get_message(obj)
 
         for tok in self.tokenize_headers(msg):
@@ -1294,7 +1435,7 @@ class Tokenizer:
         # times, several headers with date/time information will become
         # the best discriminators.
         # (Not just Date, but Received and X-From_.)
-        if options["Tokenizer", "basic_header_tokenize"]:
+        if tokenizer_options.basic_header_tokenize:
             for k, v in msg.items():
                 k = k.lower()
                 for rx in self.basic_skip:
@@ -1305,11 +1446,11 @@ class Tokenizer:
                     for w in subject_word_re.findall(v):
                         for t in tokenize_word(w):
                             yield "%s:%s" % (k, t)
-            if options["Tokenizer", "basic_header_tokenize_only"]:
+            if tokenizer_options.basic_header_tokenize_only:
                 return
 
         # Habeas Headers - see http://www.habeas.com
-        if options["Tokenizer", "x-search_for_habeas_headers"]:
+        if tokenizer_options.x_search_for_habeas_headers:
             habeas_headers = [
 ("X-Habeas-SWE-1", "winter into spring"),
 ("X-Habeas-SWE-2", "brightly anticipated"),
@@ -1326,7 +1467,7 @@ class Tokenizer:
             for opt, val in habeas_headers:
                 habeas = msg.get(opt)
                 if habeas is not None:
-                    if options["Tokenizer", "x-reduce_habeas_headers"]:
+                    if tokenizer_options.x_reduce_habeas_headers:
                         if habeas == val:
                             valid_habeas += 1
                         else:
@@ -1336,7 +1477,7 @@ class Tokenizer:
                             yield opt.lower() + ":valid"
                         else:
                             yield opt.lower() + ":invalid"
-            if options["Tokenizer", "x-reduce_habeas_headers"]:
+            if tokenizer_options.x_reduce_habeas_headers:
                 # If there was any invalid line, we record as invalid.
                 # If all nine lines were correct, we record as valid.
                 # Otherwise we ignore.
@@ -1376,7 +1517,7 @@ class Tokenizer:
         #               # not significant), so leaving it out
         # To:, Cc:      # These can help, if your ham and spam are sourced
         #               # from the same location. If not, they'll be horrible.
-        for field in options["Tokenizer", "address_headers"]:
+        for field in tokenizer_options.address_headers:
             addrlist = msg.get_all(field, [])
             if not addrlist:
                 yield field + ":none"
@@ -1419,7 +1560,7 @@ class Tokenizer:
         # to yield a final token value of "pfxlen:04".  The length test
         # eliminates the bad case where the message was sent to a single
         # individual.
-        if options["Tokenizer", "summarize_email_prefixes"]:
+        if tokenizer_options.summarize_email_prefixes:
             all_addrs = []
             addresses = msg.get_all('to', []) + msg.get_all('cc', [])
             for name, addr in email.Utils.getaddresses(addresses):
@@ -1446,7 +1587,7 @@ class Tokenizer:
         #   To: "skip" <bugs@mojam.com>, <chris@mojam.com>,
         #       <concertmaster@mojam.com>, <concerts@mojam.com>,
         #       <design@mojam.com>, <rob@mojam.com>, <skip@mojam.com>
-        if options["Tokenizer", "summarize_email_suffixes"]:
+        if tokenizer_options.summarize_email_suffixes:
             all_addrs = []
             addresses = msg.get_all('to', []) + msg.get_all('cc', [])
             for name, addr in email.Utils.getaddresses(addresses):
@@ -1493,7 +1634,7 @@ class Tokenizer:
 
         # Received:
         # Neil Schemenauer reports good results from this.
-        if options["Tokenizer", "mine_received_headers"]:
+        if tokenizer_options.mine_received_headers:
             for header in msg.get_all("received", ()):
                 # everything here should be case insensitive and not be
                 # split across continuation lines, so normalize whitespace
@@ -1513,7 +1654,7 @@ class Tokenizer:
         # Lots of spam gets posted on Usenet.  If it is then gatewayed to a
         # mailing list perhaps the NNTP-Posting-Host info will yield some
         # useful clues.
-        if options["Tokenizer", "x-mine_nntp_headers"]:
+        if tokenizer_options.x_mine_nntp_headers:
             for clue in mine_nntp(msg):
                 yield clue
 
@@ -1533,7 +1674,7 @@ class Tokenizer:
         # For example, all-caps SUBJECT is a strong spam clue, while
         # X-Complaints-To a strong ham clue.
         x2n = {}
-        if options["Tokenizer", "count_all_header_lines"]:
+        if tokenizer_options.count_all_header_lines:
             for x in msg.keys():
                 x2n[x] = x2n.get(x, 0) + 1
         else:
@@ -1541,15 +1682,15 @@ class Tokenizer:
             # collected from different sources, the count of some header
             # lines can be a too strong a discriminator for accidental
             # reasons.
-            safe_headers = options["Tokenizer", "safe_headers"]
+            safe_headers = tokenizer_options.safe_headers
             for x in msg.keys():
                 if x.lower() in safe_headers:
                     x2n[x] = x2n.get(x, 0) + 1
         for x in x2n.items():
             yield "header:%s:%d" % x
-        if options["Tokenizer", "record_header_absence"]:
+        if tokenizer_options.record_header_absence:
             for k in x2n:
-                if not k.lower() in options["Tokenizer", "safe_headers"]:
+                if not k.lower() in tokenizer_options.safe_headers:
                     yield "noheader:" + k
 
     def tokenize_text(self, text, maxword=options["Tokenizer",
@@ -1577,7 +1718,7 @@ class Tokenizer:
                 elif n >= 3:
                     for t in tokenize_word(w):
                         yield t
-        if short_runs and options["Tokenizer", "x-short_runs"]:
+        if short_runs and tokenizer_options.x_short_runs:
             yield "short:%d" % int(log2(max(short_runs)))
 
     def tokenize_body(self, msg):
@@ -1588,7 +1729,7 @@ class Tokenizer:
         message body become tokens.
         """
 
-        if options["Tokenizer", "check_octets"]:
+        if tokenizer_options.check_octets:
             # Find, decode application/octet-stream parts of the body,
             # tokenizing the first few characters of each chunk.
             for part in octetparts(msg):
@@ -1602,11 +1743,11 @@ class Tokenizer:
                     yield "control: octet payload is None"
                     continue
 
-                yield "octet:%s" % text[:options["Tokenizer",
-                                                 "octet_prefix_size"]]
+                yield "octet:%s" % \
+                      text[:tokenizer_options.octet_prefix_size]
 
         parts = imageparts(msg)
-        if options["Tokenizer", "image_size"]:
+        if tokenizer_options.image_size:
             # Find image/* parts of the body, calculating the log(size) of
             # each image.
 
@@ -1625,8 +1766,8 @@ class Tokenizer:
             if total_len:
                 yield "image-size:2**%d" % round(log2(total_len))
 
-        if options["Tokenizer", "crack_images"]:
-            engine_name = options["Tokenizer", 'ocr_engine']
+        if tokenizer_options.crack_images:
+            engine_name = tokenizer_options.ocr_engine
             from spambayes.ImageStripper import crack_images
             text, tokens = crack_images(engine_name, parts)
             for t in tokens:
@@ -1656,7 +1797,7 @@ class Tokenizer:
             # Normalize case.
             text = text.lower()
 
-            if options["Tokenizer", "replace_nonascii_chars"]:
+            if tokenizer_options.replace_nonascii_chars:
                 # Replace high-bit chars and control chars with '?'.
                 text = text.translate(non_ascii_translate_tab)
 
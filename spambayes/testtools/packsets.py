@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+
+# Pack the classic Data/{Ham,Spam}/Set* directories into one data file and
+# an index each, which the test drivers read much faster than many small
+# files.  Will use the TestDriver directory options.
+
+"""Usage: %(program)s [options] -n nsets
+
+Where:
+    -h
+        Show usage and exit.
+    -n int
+        Number of Set directories (Data/Spam/Set1, ... and Data/Ham/Set1, ...).
+        This is required.
+    -z
+        Compress each message (with zlib) in the packs.
+    -r
+        Remove each Set directory once it has been packed.
+    -t
+        Don't pack anything; instead, time reading every message from the
+        Set directories and from their packs.
+    -o section:option:value
+        set [section, option] in the options database to value
+
+Data/Ham/Set1 is packed into Data/Ham/Set1.pack and Data/Ham/Set1.pack.idx.
+The test drivers read a pack in place of a Set directory if the directory
+doesn't exist (so after -r, they need no changes), or if the directory
+options name the packs, for example with
+    -o TestDriver:ham_directories:Data/Ham/Set%%d.pack
+Either way, the same messages are chosen by --ham-keep and so on.  Run
+this again after changing the messages in a Set directory.
+"""
+
+import os
+import sys
+import time
+import getopt
+import shutil
+
+sys.path.insert(-1, os.getcwd())
+sys.path.insert(-1, os.path.dirname(os.getcwd()))
+
+from spambayes.Options import options, get_pathname_option
+from spambayes import msgs
+
+program = sys.argv[0]
+
+def usage(code, msg=''):
+    """Print usage message and sys.exit(code)."""
+    if msg:
+        print >> sys.stderr, msg
+        print >> sys.stderr
+    print >> sys.stderr, __doc__ % globals()
+    sys.exit(code)
+
+def set_directories(nsets):
+    dirs = []
+    for option in ("ham_directories", "spam_directories"):
+        dirs.extend([get_pathname_option("TestDriver", option) % i
+                     for i in range(1, nsets+1)])
+    return dirs
+
+def pack(dirs, compress, remove):
+    for directory in dirs:
+        n = msgs.write_pack(directory, compress=compress)
+        print "%s: packed %d messages" % (directory, n)
+        if remove:
+            shutil.rmtree(directory)
+
+def read_all(dirs):
+    start = time.time()
+    n = size = 0
+    for msg in msgs.MsgStream("timing", dirs):
+        n += 1
+        size += len(msg.guts)
+    return n, size, time.time() - start
+
+def report(dirs):
+    n, size, elapsed = read_all(dirs)
+    print "Directories: %d messages, %d bytes in %.2f seconds" % \
+          (n, size, elapsed)
+    packn, packsize, packelapsed = read_all([d + msgs.PACK_SUFFIX
+                                             for d in dirs])
+    print "Packs:       %d messages, %d bytes in %.2f seconds" % \
+          (packn, packsize, packelapsed)
+    if (packn, packsize) != (n, size):
+        print "The packs don't match the directories; run %s again." % \
+              (program,)
+    elif elapsed:
+        print "Reading the packs took %.0f%% less time." % \
+              (100.0 * (elapsed - packelapsed) / elapsed)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:zrto:', ['option='])
+    except getopt.error, msg:
+        usage(1, msg)
+
+    nsets = None
+    compress = remove = timing = False
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(0)
+        elif opt == '-n':
+            nsets = int(arg)
+        elif opt == '-z':
+            compress = True
+        elif opt == '-r':
+            remove = True
+        elif opt == '-t':
+            timing = True
+        elif opt in ('-o', '--option'):
+            options.set_from_cmdline(arg, sys.stderr)
+
+    if args:
+        usage(1, "Positional arguments not supported")
+    if nsets is None:
+        usage(1, "-n is required")
+
+    dirs = set_directories(nsets)
+    if timing:
+        report(dirs)
+    else:
+        pack(dirs, compress, remove)
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,13 @@ Where:
         This is required.
     -o section:option:value
         set [section, option] in the options database to value
+    -j int
+        Run the tests in this many processes at once (Unix only).  Every
+        message is tokenized just once, but all the tokens are held in
+        memory.  The same messages must be used for training and testing
+        (that is, don't use --HamTrain etc. with different values to
+        --HamTest etc.).  Nothing is displayed until all the tests have
+        finished, but then the output is the same as without -j.
 
 If you only want to use some of the messages in each set,
 
@@ -71,7 +78,7 @@ def usage(code, msg=''):
     print >> sys.stderr, __doc__ % globals()
     sys.exit(code)
 
-def drive(nsets):
+def drive(nsets, processes=None):
     print options.display()
 
     hamdirs  = [get_pathname_option("TestDriver", "ham_directories") % \
@@ -79,7 +86,10 @@ def drive(nsets):
     spamdirs = [get_pathname_option("TestDriver", "spam_directories") % \
                 i for i in range(1, nsets+1)]
 
-    d = TestDriver.Driver()
+    if processes is None:
+        d = TestDriver.Driver()
+    else:
+        d = TestDriver.ParallelDriver(processes)
     # Train it on all sets except the first.
     d.train(msgs.HamStream("%s-%d" % (hamdirs[1], nsets),
                             hamdirs[1:], train=1),
@@ -128,7 +138,7 @@ def main():
     import getopt
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hn:s:o:',
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:s:o:j:',
                                    ['HamTrain=', 'SpamTrain=',
                                    'HamTest=', 'SpamTest=',
                                    'ham-keep=', 'spam-keep=',
@@ -136,7 +146,7 @@ def main():
     except getopt.error, msg:
         usage(1, msg)
 
-    nsets = seed = hamtrain = spamtrain = None
+    nsets = seed = hamtrain = spamtrain = processes = None
     hamtest = spamtest = hamkeep = spamkeep = None
     for opt, arg in opts:
         if opt == '-h':
@@ -145,6 +155,8 @@ def main():
             nsets = int(arg)
         elif opt == '-s':
             seed = int(arg)
+        elif opt == '-j':
+            processes = int(arg)
         elif opt == '--HamTest':
             hamtest = int(arg)
         elif opt == '--SpamTest':
@@ -169,7 +181,10 @@ def main():
         msgs.setparms(hamkeep, spamkeep, seed=seed)
     else:
         msgs.setparms(hamtrain, spamtrain, hamtest, spamtest, seed)
-    drive(nsets)
+    if processes is not None and (msgs.HAMTRAIN != msgs.HAMTEST or
+                                  msgs.SPAMTRAIN != msgs.SPAMTEST):
+        usage(1, "-j needs the same messages for training and testing")
+    drive(nsets, processes)
 
 if __name__ == "__main__":
     main()
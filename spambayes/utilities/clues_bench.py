@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+
+"""clues_bench.py
+
+Time how long the classifier takes to pick the clues for large messages,
+using its heap-based selection compared to sorting every candidate clue
+(which is what it used to do).
+
+Usage:
+    clues_bench.py [options] -g HAM -s SPAM
+
+        options:
+            -g FN  : mbox, directory or MH folder of ham
+            -s FN  : mbox, directory or MH folder of spam
+            -c N   : join N messages together to make each large message
+                     (default 50)
+            -b     : use bigrams
+            -h     : help
+
+The classifier is trained on all of the ham and spam, and the large
+messages are then made from the same messages, so that most of their
+tokens are known.
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import time
+import getopt
+
+from spambayes import classifier, tokenizer, mboxutils
+from spambayes.Options import options
+
+def load(name):
+    msgs = []
+    for msg in mboxutils.getmbox(name):
+        msgs.append(list(tokenizer.tokenize(msg)))
+    return msgs
+
+def sorted_clues(bayes, wordstream, use_bigrams):
+    """Pick clues the old way, by sorting all the candidates."""
+    mindist = options["Classifier", "minimum_prob_strength"]
+    raw = []
+    seen = {}
+    last_token = None
+    for i, token in enumerate(wordstream):
+        candidates = [(token, (i,))]
+        if use_bigrams and i:
+            candidates.append(("bi:%s %s" % (last_token, token), (i-1, i)))
+        last_token = token
+        for clue, indices in candidates:
+            if clue not in seen:
+                seen[clue] = 1
+                tup = bayes._worddistanceget(clue)
+                if tup[0] >= mindist:
+                    raw.append((tup, indices))
+    raw.sort()
+    raw.reverse()
+    clues = []
+    used = {}
+    for tup, indices in raw:
+        if not [i for i in indices if i in used]:
+            for i in indices:
+                used[i] = 1
+            clues.append(tup)
+    clues.reverse()
+    clues = clues[-options["Classifier", "max_discriminators"]:]
+    return [t[1:] for t in clues]
+
+def report(ham, spam, chunk, use_bigrams):
+    options["Classifier", "use_bigrams"] = use_bigrams
+    bayes = classifier.Classifier()
+    for msgs, is_spam in ((ham, False), (spam, True)):
+        for msg in msgs:
+            bayes.learn(msg, is_spam)
+
+    msgs = ham + spam
+    large = []
+    for i in range(0, len(msgs), chunk):
+        wordstream = []
+        for msg in msgs[i:i+chunk]:
+            wordstream.extend(msg)
+        large.append(wordstream)
+
+    # Fill the probability cache, so that neither run pays for that.
+    for wordstream in large:
+        bayes._getclues(wordstream)
+
+    start = time.time()
+    for wordstream in large:
+        old = sorted_clues(bayes, wordstream, use_bigrams)
+    sorting = (time.time() - start) / max(len(large), 1)
+    start = time.time()
+    for wordstream in large:
+        new = bayes._getclues(wordstream)
+    heap = (time.time() - start) / max(len(large), 1)
+    for wordstream in large:
+        if bayes._getclues(wordstream) != \
+           sorted_clues(bayes, wordstream, use_bigrams):
+            print >> sys.stderr, "Clues differ!"
+
+    print "Large messages:     %10d (%.0f tokens each)" % \
+          (len(large), float(sum(map(len, large))) / max(len(large), 1))
+    print "Sorting:            %10.1f usec per message" % (sorting * 1e6,)
+    print "Heap:               %10.1f usec per message" % (heap * 1e6,)
+    print "Saving:             %10.1f%%" % \
+          (100.0 * (sorting - heap) / max(sorting, 1e-9),)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hbg:s:c:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    ham = spam = None
+    chunk = 50
+    use_bigrams = False
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+        elif opt == '-g':
+            ham = load(arg)
+        elif opt == '-s':
+            spam = load(arg)
+        elif opt == '-c':
+            chunk = int(arg)
+        elif opt == '-b':
+            use_bigrams = True
+    if ham is None or spam is None:
+        print >> sys.stderr, __doc__
+        sys.exit(1)
+    report(ham, spam, chunk, use_bigrams)
+
+if __name__ == "__main__":
+    main()
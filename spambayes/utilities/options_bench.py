@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+
+"""options_bench.py
+
+Time how long tokenizing and scoring a message takes when the classifier
+and tokenizer read their options from snapshots (as they normally do)
+compared to looking each one up in the options object.
+
+Usage:
+    options_bench.py [options] -g HAM -s SPAM
+
+        options:
+            -g FN  : mbox, directory or MH folder of ham
+            -s FN  : mbox, directory or MH folder of spam
+            -n N   : score each message N times (default 3)
+            -h     : help
+
+Half of each of the ham and the spam is used for training and then all
+of it is scored, so that the options that are only read for known words
+are exercised as well.
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import time
+import getopt
+
+from spambayes import classifier, tokenizer, mboxutils
+from spambayes.Options import options
+
+class LookupOptions(object):
+    """Stands in for an OptionsSnapshot, but looks up every option."""
+    def __init__(self, section):
+        self.section = section
+
+    def __getattr__(self, name):
+        if name.startswith("x_"):
+            name = "x-" + name[2:]
+        return options[self.section, name]
+
+def load(name):
+    msgs = []
+    for msg in mboxutils.getmbox(name):
+        msgs.append(mboxutils.as_string(msg))
+    return msgs
+
+def score_all(bayes, msgs, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        for msg in msgs:
+            bayes.spamprob(tokenizer.tokenize(msg))
+    return (time.time() - start) / (repeat * max(len(msgs), 1))
+
+def report(ham, spam, repeat):
+    bayes = classifier.Classifier()
+    for msgs, is_spam in ((ham, False), (spam, True)):
+        for msg in msgs[:len(msgs) // 2]:
+            bayes.learn(tokenizer.tokenize(msg), is_spam)
+    msgs = ham + spam
+
+    # Warm up, so that neither run pays for filling caches.
+    score_all(bayes, msgs, 1)
+    snapshot = score_all(bayes, msgs, repeat)
+
+    saved = classifier.classifier_options, tokenizer.tokenizer_options
+    classifier.classifier_options = LookupOptions("Classifier")
+    tokenizer.tokenizer_options = LookupOptions("Tokenizer")
+    try:
+        lookup = score_all(bayes, msgs, repeat)
+    finally:
+        classifier.classifier_options, tokenizer.tokenizer_options = saved
+
+    print "Messages:           %10d (%d ham, %d spam)" % \
+          (len(msgs), len(ham), len(spam))
+    print "Option lookups:     %10.1f usec per message" % (lookup * 1e6,)
+    print "Option snapshots:   %10.1f usec per message" % (snapshot * 1e6,)
+    print "Saving:             %10.1f usec per message (%.1f%%)" % \
+          ((lookup - snapshot) * 1e6,
+           100.0 * (lookup - snapshot) / max(lookup, 1e-9))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hg:s:n:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    ham = spam = None
+    repeat = 3
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+        elif opt == '-g':
+            ham = load(arg)
+        elif opt == '-s':
+            spam = load(arg)
+        elif opt == '-n':
+            repeat = int(arg)
+    if ham is None or spam is None:
+        print >> sys.stderr, __doc__
+        sys.exit(1)
+    report(ham, spam, repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#! /usr/bin/env python
+
+"""proxy_bench.py
+
+Time the POP3 proxy with each of Dibbler's event loops (see the [globals]
+event_loop option): how many connections per second it can set up and
+close, and how long it takes to proxy a message, while a number of other
+email clients sit connected but idle.
+
+Usage:
+    proxy_bench.py [options]
+
+        options:
+            -e NAME : event loop to time; may be given more than once
+                      (default select, poll and epoll)
+            -i N,.. : numbers of idle connections to time with
+                      (default 0,200,800)
+            -c N    : number of connections to time (default 300)
+            -r N    : number of messages to retrieve (default 100)
+            -s N    : size of the message, in bytes (default 20000)
+            -h      : help
+
+The proxy talks to a fake POP3 server running in the same process (in
+its own thread and event loop).  Each proxied connection uses two sockets
+in the proxy, so "select" can't cope with more than about five hundred
+of them; those results are reported as failed.  sb_server.py needs to
+be importable (on PYTHONPATH, or installed).
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import time
+import socket
+import getopt
+import asyncore
+import asynchat
+import threading
+
+from spambayes import Dibbler
+
+import sb_server
+
+SERVER_PORT = 8210
+PROXY_PORT = 8211
+
+
+class FakePOP3Server(asynchat.async_chat):
+    """Answers everything with +OK, and RETR with the message."""
+
+    def __init__(self, clientSocket, message, socketMap):
+        asynchat.async_chat.__init__(self, clientSocket, socketMap)
+        self.message = message
+        self.request = ''
+        self.set_terminator('\r\n')
+        self.push("+OK ready\r\n")
+
+    def collect_incoming_data(self, data):
+        self.request = self.request + data
+
+    def found_terminator(self):
+        command = self.request.split(None, 1)[0].upper()
+        self.request = ''
+        if command == 'RETR':
+            self.push("+OK %d octets\r\n%s\r\n.\r\n" %
+                      (len(self.message), self.message))
+        else:
+            self.push("+OK\r\n")
+            if command == 'QUIT':
+                self.close_when_done()
+
+
+def make_message(size):
+    lines = ["From: bench@example.com",
+             "Subject: Proxy benchmark",
+             ""]
+    length = sum(map(len, lines)) + 2 * len(lines)
+    while length < size:
+        lines.append("Line %d of the body, with some words to tokenize." %
+                     (len(lines),))
+        length += len(lines[-1]) + 2
+    return "\r\n".join(lines)
+
+def run_server(message):
+    """Run the fake POP3 server in a thread of its own."""
+    serverMap = {}
+    Dibbler.Listener(SERVER_PORT, FakePOP3Server, (message, serverMap),
+                     socketMap=serverMap)
+    thread = threading.Thread(target=Dibbler.loop, args=(serverMap, "epoll"))
+    thread.setDaemon(True)
+    thread.start()
+
+def connect():
+    """Connect to the proxy and read the greeting."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(10)
+    s.connect(('localhost', PROXY_PORT))
+    receive(s, '\r\n')
+    return s
+
+def receive(s, terminator):
+    response = ''
+    while not response.endswith(terminator):
+        packet = s.recv(65536)
+        if not packet:
+            raise socket.error("connection closed")
+        response += packet
+    return response
+
+def time_connections(count):
+    start = time.time()
+    for i in xrange(count):
+        s = connect()
+        s.sendall("QUIT\r\n")
+        receive(s, '\r\n')
+        s.close()
+    return count / (time.time() - start)
+
+def time_retrievals(count):
+    s = connect()
+    times = []
+    for i in xrange(count):
+        start = time.time()
+        s.sendall("RETR 1\r\n")
+        receive(s, '\n.\r\n')
+        times.append(time.time() - start)
+    s.sendall("QUIT\r\n")
+    receive(s, '\r\n')
+    s.close()
+    times.sort()
+    return times[len(times) // 2], times[len(times) * 9 // 10]
+
+def time_engine(poller, idle, nconnections, nretrievals):
+    """Start the proxy with the given event loop, and return the
+    connections per second, and the median and 90th percentile proxy
+    latency, with each of the numbers of idle connections."""
+    listener = sb_server.BayesProxyListener('localhost', SERVER_PORT,
+                                            ('', PROXY_PORT))
+    thread = threading.Thread(target=Dibbler.run, kwargs={"poller": poller})
+    thread.setDaemon(True)
+    thread.start()
+    results = []
+    idlers = []
+    try:
+        for nidle in idle:
+            try:
+                while len(idlers) < nidle:
+                    idlers.append(connect())
+                results.append((nidle, time_connections(nconnections)) +
+                               time_retrievals(nretrievals))
+            except (socket.error, socket.timeout):
+                results.append((nidle, None, None, None))
+                break
+    finally:
+        # Stop the proxy (this makes its thread raise SystemExit), and
+        # close everything it left behind.
+        if thread.isAlive():
+            try:
+                s = connect()
+                s.sendall("KILL\r\n")
+                s.close()
+            except (socket.error, socket.timeout):
+                pass
+            thread.join(10)
+        for s in idlers:
+            s.close()
+        asyncore.close_all()
+    return results
+
+def report(pollers, idle, nconnections, nretrievals, size):
+    sb_server.state.isTest = True
+    sb_server.state.createWorkers()
+    print
+    run_server(make_message(size))
+    print "%-8s %6s %12s %12s %12s" % ("Loop", "Idle", "Connects/s",
+                                       "Median ms", "90% ms")
+    for poller in pollers:
+        for nidle, rate, median, ninety in time_engine(poller, idle,
+                                                       nconnections,
+                                                       nretrievals):
+            if rate is None:
+                print "%-8s %6d %12s" % (poller, nidle, "failed")
+            else:
+                print "%-8s %6d %12.1f %12.2f %12.2f" % \
+                      (poller, nidle, rate, median * 1000, ninety * 1000)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'he:i:c:r:s:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    pollers = []
+    idle = [0, 200, 800]
+    nconnections = 300
+    nretrievals = 100
+    size = 20000
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+        elif opt == '-e':
+            pollers.append(arg)
+        elif opt == '-i':
+            idle = [int(n) for n in arg.split(',')]
+        elif opt == '-c':
+            nconnections = int(arg)
+        elif opt == '-r':
+            nretrievals = int(arg)
+        elif opt == '-s':
+            size = int(arg)
+    report(pollers or ["select", "poll", "epoll"], idle, nconnections,
+           nretrievals, size)
+
+if __name__ == "__main__":
+    main()
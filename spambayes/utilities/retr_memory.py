@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+
+"""retr_memory.py
+
+Measure how much memory the POP3 proxy needs to retrieve a large message,
+and how long it takes, with a given streaming threshold (see the
+[pop3proxy] streaming_threshold option).
+
+Usage:
+    retr_memory.py [options]
+
+        options:
+            -s N    : size of the message, in bytes (default 20000000)
+            -t N    : streaming threshold, in bytes (default 0, which
+                      collects the whole message before classifying it)
+            -h      : help
+
+The message is first retrieved straight from a fake POP3 server running
+in the same process, and then through the proxy; the memory reported is
+how much higher the process's peak resident size went the second time.
+The peak never goes down again, so run this once for each threshold that
+you want to compare.  proxy_bench.py and sb_server.py need to be
+importable (on PYTHONPATH, or installed).
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import time
+import socket
+import getopt
+import resource
+import threading
+
+from spambayes import Dibbler
+from spambayes.Options import options
+
+import sb_server
+import proxy_bench
+
+
+def peak_memory():
+    """Returns the peak resident size of this process, in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def retrieve(port):
+    """Retrieves the message from the POP3 server (or proxy) on the given
+    port, and returns its length and the time that took."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(600)
+    s.connect(('localhost', port))
+    proxy_bench.receive(s, '\r\n')
+    start = time.time()
+    s.sendall("RETR 1\r\n")
+    # (Not proxy_bench.receive(), which keeps adding to a string.)
+    packets = []
+    tail = ''
+    while not tail.endswith('\n.\r\n'):
+        packet = s.recv(65536)
+        if not packet:
+            raise socket.error("connection closed")
+        packets.append(packet)
+        tail = (tail + packet)[-5:]
+    elapsed = time.time() - start
+    s.sendall("QUIT\r\n")
+    s.close()
+    return sum(map(len, packets)), elapsed
+
+def report(size, threshold):
+    sb_server.state.isTest = True
+    sb_server.state.createWorkers()
+    options["pop3proxy", "streaming_threshold"] = threshold
+    proxy_bench.run_server(proxy_bench.make_message(size))
+
+    length, elapsed = retrieve(proxy_bench.SERVER_PORT)
+    baseline = peak_memory()
+    print "Direct:  %d bytes in %.2f seconds (peak %d KB)" % \
+          (length, elapsed, baseline)
+
+    sb_server.BayesProxyListener('localhost', proxy_bench.SERVER_PORT,
+                                 ('', proxy_bench.PROXY_PORT))
+    thread = threading.Thread(target=Dibbler.run)
+    thread.setDaemon(True)
+    thread.start()
+    length, elapsed = retrieve(proxy_bench.PROXY_PORT)
+    print "Proxied: %d bytes in %.2f seconds (peak %d KB)" % \
+          (length, elapsed, peak_memory())
+    print "The proxy needed %d KB more, with a streaming threshold of %d." % \
+          (peak_memory() - baseline, threshold)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hs:t:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    size = 20000000
+    threshold = 0
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+        elif opt == '-s':
+            size = int(arg)
+        elif opt == '-t':
+            threshold = int(arg)
+    report(size, threshold)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+"""store_bench.py
+
+Time how long a pickle database takes to store after training a single
+message, writing the whole pickle each time compared to adding the
+changes to a journal.
+
+Usage:
+    store_bench.py [options]
+
+        options:
+            -w N   : number of words in the database (default 500000)
+            -n N   : number of messages to train and store (default 10)
+            -h     : help
+
+The database is made up of random words, and written to a temporary
+directory that is removed afterwards.
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import os
+import sys
+import time
+import random
+import getopt
+import shutil
+import tempfile
+
+from spambayes import storage
+from spambayes.Options import options
+
+def random_words(rand, count):
+    return ["word%d" % (rand.randrange(1000000000),) for i in xrange(count)]
+
+def time_stores(db_name, messages, journal):
+    options["Storage", "pickle_journal"] = journal
+    bayes = storage.PickledClassifier(db_name)
+    elapsed = 0.0
+    for i, msg in enumerate(messages):
+        bayes.learn(msg, i % 2)
+        start = time.time()
+        bayes.store()
+        elapsed += time.time() - start
+    start = time.time()
+    bayes.close()
+    closing = time.time() - start
+    return elapsed / max(len(messages), 1), closing
+
+def report(nwords, nmessages):
+    rand = random.Random(1)
+    dirname = tempfile.mkdtemp()
+    try:
+        db_name = os.path.join(dirname, "bench.db")
+        bayes = storage.PickledClassifier(db_name)
+        words = random_words(rand, nwords)
+        for i in xrange(0, len(words), 100):
+            bayes.learn(words[i:i+100], i % 200 == 0)
+        options["Storage", "pickle_journal"] = False
+        bayes.store()
+        messages = [random_words(rand, 50) + rand.sample(words, 50)
+                    for i in xrange(nmessages)]
+
+        print "Words:              %10d (%d bytes pickled)" % \
+              (len(bayes.wordinfo), os.path.getsize(db_name))
+        for journal in (False, True):
+            per_store, closing = time_stores(db_name, messages, journal)
+            print "%-20s%10.4f seconds per store, %.4f to close" % \
+                  (journal and "Journal:" or "Whole pickle:", per_store,
+                   closing)
+    finally:
+        shutil.rmtree(dirname)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hw:n:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    nwords = 500000
+    nmessages = 10
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+        elif opt == '-w':
+            nwords = int(arg)
+        elif opt == '-n':
+            nmessages = int(arg)
+    report(nwords, nmessages)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+"""wordinfo_memory.py
+
+Report how much memory a database's wordinfo takes when it is held in a
+dictionary of WordInfo records (as PickledClassifier does) compared to a
+packedwordinfo.PackedWordInfo (as PackedPickledClassifier does).
+
+Usage:
+    wordinfo_memory.py [options]
+
+        options:
+            -p FN  : name of pickled database file to use
+            -d FN  : name of dbm database file to use
+            -h     : help
+
+If neither -p nor -d is specified, then the values in your configuration
+file (or failing that, the defaults) will be used.
+
+The figures are estimates (based on sys.getsizeof) of the memory used by
+the words and counts themselves; they don't include interpreter overhead
+such as memory allocator slack.
+"""
+
+# This module is part of the spambayes project, which is Copyright 2002-2007
+# The Python Software Foundation and is covered by the Python Software
+# Foundation license.
+
+import sys
+import time
+import getopt
+
+from spambayes import storage
+from spambayes.packedwordinfo import PackedWordInfo, dict_memory_usage
+
+def report(db_name, db_type):
+    bayes = storage.open_storage(db_name, db_type, 'r')
+    words = bayes._wordinfokeys()
+    wordinfo = {}
+    for word in words:
+        wordinfo[word] = bayes._wordinfoget(word)
+    bayes.close()
+
+    start = time.time()
+    packed = PackedWordInfo(wordinfo)
+    elapsed = time.time() - start
+
+    dict_bytes = dict_memory_usage(wordinfo)
+    packed_bytes = packed.memory_usage()
+    print "Words:              %10d" % (len(wordinfo),)
+    print "Dictionary:         %10d bytes (%.1f per word)" % \
+          (dict_bytes, float(dict_bytes) / max(len(wordinfo), 1))
+    print "PackedWordInfo:     %10d bytes (%.1f per word)" % \
+          (packed_bytes, float(packed_bytes) / max(len(wordinfo), 1))
+    print "Reduction:          %10.1f%%" % \
+          (100.0 * (dict_bytes - packed_bytes) / max(dict_bytes, 1),)
+    print "Time to pack:       %10.2f seconds" % (elapsed,)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hd:p:')
+    except getopt.error, msg:
+        print >> sys.stderr, str(msg) + '\n\n' + __doc__
+        sys.exit(1)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print >> sys.stderr, __doc__
+            sys.exit()
+    db_name, db_type = storage.database_type(opts)
+    report(db_name, db_type)
+
+if __name__ == "__main__":
+    main()